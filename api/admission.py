@@ -0,0 +1,118 @@
+"""
+Per-token admission control for /messaging, shared by the Flask (message_api) and ASGI (async_message_api) variants
+of the API. Messages for a token are refused (with HTTP 429 and a Retry-After header) if:
+  - its registration is quarantined, because DMs to it keep being rejected (see ``db_manager.record_dm_failure()``);
+  - it already has ``MAX_QUEUED_PER_TOKEN`` messages waiting to be delivered;
+  - it has exceeded its rate limit of ``TOKEN_MESSAGE_RATE`` messages per second (with bursts of up to
+    ``TOKEN_MESSAGE_BURST``).
+
+Rate limits are kept per API process. Nothing in here touches the DB; the caller looks up the registration and
+the token's queue depth.
+"""
+import math
+import os
+import threading
+import time
+from dbmanager.ttl_cache import TtlCache
+from dbmodels.user_registration import UserRegistration
+from monitoring.metrics import REGISTRY
+
+TOKEN_MESSAGE_RATE = float(os.environ.get('FCOM_TOKEN_MESSAGE_RATE', 5))
+TOKEN_MESSAGE_BURST = int(os.environ.get('FCOM_TOKEN_MESSAGE_BURST', 100))
+MAX_QUEUED_PER_TOKEN = int(os.environ.get('FCOM_MAX_QUEUED_PER_TOKEN', 500))
+
+# Suggested wait when a token's queue is full; roughly how long the bot takes to deliver a backlog
+QUEUE_FULL_RETRY_AFTER = 10
+
+# Maximum number of tokens whose rate limits are tracked (the least recently active are forgotten first)
+RATE_LIMITER_SIZE = 10000
+
+QUARANTINED_DETAIL = ("Messages for this token are suspended, since they can't be delivered. "
+                      "Please check that the Discord user accepts DMs from the bot.")
+TOKEN_QUEUE_FULL_DETAIL = 'Too many messages are waiting to be delivered for this token. Please try again later.'
+RATE_LIMITED_DETAIL = 'Too many messages for this token. Please slow down.'
+
+ADMISSION_REJECTIONS = REGISTRY.counter('fcom_admission_rejections_total',
+                                        'Number of /messaging requests refused by per-token admission control',
+                                        ('reason',))
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket rate limiter, with a bucket per key. Thread-safe.
+
+    A request larger than the burst size is let through whenever the bucket is full, leaving the bucket in debt,
+    so that it's delayed rather than refused outright.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int):
+        """
+
+        :param rate:        Units per second added to each bucket
+        :param burst:       Capacity of each bucket
+        :param max_keys:    Maximum number of buckets kept
+        """
+        self.rate = rate
+        self.burst = burst
+
+        # key -> [units, last refill]. Each bucket expires once it would have refilled completely (see acquire()),
+        # since a full bucket behaves exactly like a new one.
+        self._buckets = TtlCache(max_size=max_keys, ttl=burst / rate)
+        self._lock = threading.Lock()
+
+    def acquire(self, key, units: int) -> float:
+        """
+        Takes the given number of units from the key's bucket, if it has them.
+
+        :param key:     Bucket key
+        :param units:   Number of units requested
+        :return:        0 if the units were taken, otherwise the number of seconds until they're available
+        """
+        now = time.monotonic()
+        needed = min(units, self.burst)
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [float(self.burst), now]
+            else:
+                bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] < needed:
+                return (needed - bucket[0]) / self.rate
+
+            # Kept until it's full again, which takes longer than burst / rate if it's in debt
+            bucket[0] -= units
+            self._buckets.set(key, bucket, ttl=(self.burst - bucket[0]) / self.rate)
+            return 0.0
+
+
+limiter = TokenBucketLimiter(TOKEN_MESSAGE_RATE, TOKEN_MESSAGE_BURST, RATE_LIMITER_SIZE)
+
+
+def check(registration: UserRegistration, queued: int, count: int) -> (str, int):
+    """
+    Decides whether to accept a /messaging request. If it's accepted, it's counted against the token's rate limit.
+
+    :param registration:    Registration the messages were submitted for
+    :param queued:          Number of messages already queued for the token (see ``db_manager.queued_messages()``)
+    :param count:           Number of (valid) messages in the request
+    :return:                None if the request is accepted, otherwise (error detail, Retry-After in seconds)
+    """
+    quarantine_remaining = registration.quarantine_remaining()
+    if quarantine_remaining > 0:
+        ADMISSION_REJECTIONS.inc(reason='quarantined')
+        return QUARANTINED_DETAIL, math.ceil(quarantine_remaining)
+
+    if queued + count > MAX_QUEUED_PER_TOKEN:
+        ADMISSION_REJECTIONS.inc(reason='queue_full')
+        return TOKEN_QUEUE_FULL_DETAIL, QUEUE_FULL_RETRY_AFTER
+
+    # Last, so that refused requests don't use up the token's rate limit
+    wait = limiter.acquire(registration.token, count)
+    if wait > 0:
+        ADMISSION_REJECTIONS.inc(reason='rate_limited')
+        return RATE_LIMITED_DETAIL, math.ceil(wait)
+
+    return None
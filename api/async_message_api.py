@@ -0,0 +1,167 @@
+"""
+ASGI variant of the message API (see message_api.py), built on Quart.
+
+Serves the same /api/v1/* routes with the same responses, but every request runs as a coroutine on a single
+event loop, and DB calls go through an async driver (see async_db_manager). A waiting request therefore only
+costs a coroutine rather than a worker, so each process can hold thousands of concurrent client connections.
+
+Usage (from the project root):
+    hypercorn api.async_message_api:app --bind 0.0.0.0:5000
+
+It can also be run in the same process as the bot (see main_combined.py).
+"""
+from quart import Quart, Response, g, request, jsonify
+from api import common
+from api.common import API_REQUESTS, API_REQUEST_DURATION, ApiError, ApiResponse, registration_message
+from dbmanager import async_db_manager
+from monitoring.log_pipeline import setup_logging
+from monitoring.metrics import REGISTRY, Registry
+import asyncio
+import time
+
+
+app = Quart(__name__)
+
+# Logging config (see monitoring/log_pipeline.py) #
+
+# Shared with api.common, which logs most of the requests
+setup_logging('api', 'api.log')
+
+# End logging config #
+
+
+@app.before_serving
+async def connect_db():
+    await async_db_manager.connect()
+
+
+@app.after_serving
+async def disconnect_db():
+    await async_db_manager.disconnect()
+
+
+# Metrics #
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+async def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    API_REQUESTS.inc(route=route, status=response.status_code)
+
+    start = g.get('request_start')
+    if start is not None:
+        API_REQUEST_DURATION.observe(time.perf_counter() - start, route=route)
+
+    return response
+
+# End metrics #
+
+
+@app.route('/api/v1/test', methods=['GET'])
+async def test():
+    """
+    Simple test endpoint for checking if the API is working.
+
+    :return: "Success"
+    """
+    return "Success"
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    """
+    Metrics for this API process, in the Prometheus text format.
+
+    :return: Metrics, as plain text
+    """
+    # Rendering queries the DB (for the queue depth) synchronously, so keep it off the event loop
+    body = await asyncio.get_running_loop().run_in_executor(None, REGISTRY.render)
+    return Response(body, content_type=Registry.CONTENT_TYPE)
+
+
+def to_response(response: ApiResponse):
+    """
+    :param response:    Response built by api.common
+    :return:            Quart response
+    """
+    body = jsonify(response.body) if isinstance(response.body, dict) else response.body
+    return body, response.status, response.headers
+
+
+@app.route('/api/v1/register', methods=['GET'])
+async def register_user():
+    """
+    Marks the user as registered in the registration DB, and returns info on the Discord user.
+
+    :return: JSON object containing the token, Discord ID, Discord name, and callsign.
+            If the token doesn't exist, an error is returned.
+    """
+    try:
+        token, callsign, client_version = common.parse_register_request(request.args, request.headers)
+
+        requested_user = await async_db_manager.get_user_registration(token)
+        common.check_registration(requested_user)
+
+        await async_db_manager.confirm_discord_user(token, callsign)
+        await async_db_manager.insert_message(registration_message(token, callsign, requested_user.last_updated,
+                                                                   requested_user.discord_id, client_version))
+
+        return to_response(common.register_response(token, callsign, requested_user))
+
+    except ApiError as e:
+        return to_response(e.response)
+
+
+@app.route('/api/v1/messaging', methods=['POST'])
+async def post_message():
+    """
+    Forwards one or more messages to a Discord user. Same request and response formats as ``message_api``.
+
+    :return: 'ok' on success, if a single message was submitted.
+             If multiple messages were submitted, a JSON object with a per-message result is returned instead
+             (HTTP 200 if at least one message was accepted, 400 otherwise).
+             A 400 error with details is returned if the request is in the incorrect format.
+             A 429 error with a Retry-After header is returned if the token is over its limits (see api/admission.py).
+    """
+    payload = None
+
+    try:
+        common.check_json_request(request.content_type)
+        payload = await request.get_json()
+
+        token, accepted, results = common.parse_messaging_request(payload)
+
+        # Check token - if it's not associated with any Discord user, return an error
+        discord_user = await async_db_manager.get_user_registration(token)
+        common.check_message_recipient(token, discord_user)
+        common.admit_messages(discord_user, await async_db_manager.queued_messages(token), accepted)
+
+        await async_db_manager.insert_messages(accepted)
+
+        return to_response(common.messaging_response(accepted, results))
+
+    except ApiError as e:
+        return to_response(e.response)
+
+    except Exception as e:
+        return to_response(common.messaging_error_response(e, payload))
+
+
+@app.route('/api/v1/deregister/<string:token>', methods=['DELETE'])
+async def deregister(token: str):
+    """
+    Deregisters a user via the API.
+    Has the same effect as the `remove` Discord bot command.
+    :return: 'ok' on success, 404 if it doesn't exist
+    """
+    try:
+        common.check_deregistration(token, await async_db_manager.get_user_registration(token))
+        return to_response(common.deregister_response(await async_db_manager.remove_discord_user(token)))
+
+    except ApiError as e:
+        return to_response(e.response)
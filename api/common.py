@@ -0,0 +1,395 @@
+"""
+Request handling shared by the Flask (message_api) and ASGI (async_message_api) variants of the API.
+
+Each endpoint is handled as a sequence of steps, between which the variant makes its own (blocking or async) DB calls.
+Nothing in here touches the DB or depends on the web framework: requests are passed in as plain values, and
+responses are returned as ``ApiResponse``, or raised as ``ApiError`` to end the request early. Each variant only
+converts them to its framework's response objects, so both variants produce identical responses.
+"""
+from api import admission
+from dbmodels.fsd_message import FsdMessage
+from dbmodels.user_registration import UserRegistration
+from dbmanager.memory_queue import QueueFullError
+from monitoring.metrics import REGISTRY
+from datetime import datetime, timedelta
+from typing import List, Mapping
+import logging
+import re
+
+try:
+    curr_version_file = open('../FcomServer/curr_client_version.txt')
+    curr_version = curr_version_file.read().replace('FcomClient/','').rstrip()
+
+    # Just in case curr_client_version.txt isn't in the format FcomClient/x.y.z
+    version_regex = '\d\.\d\.\d'    # x.y.z
+    if not re.match(version_regex, curr_version):
+        curr_version = '0.0.0'
+
+except FileNotFoundError:
+    curr_version = '0.0.0'
+
+
+# Request metrics, recorded by each variant's request hooks.
+# Labelled by route pattern (e.g. /api/v1/deregister/<string:token>), so that tokens don't end up in label values
+API_REQUESTS = REGISTRY.counter('fcom_api_requests_total', 'Number of API requests handled', ('route', 'status'))
+API_REQUEST_DURATION = REGISTRY.histogram('fcom_api_request_duration_seconds', 'Time spent handling API requests',
+                                          ('route',))
+
+# Upper bound on the number of messages accepted in a single POST request
+MAX_MESSAGES_PER_REQUEST = 100
+
+# Range of valid message timestamps (milliseconds since Unix epoch), i.e. that fit in a TIMESTAMP column:
+# 1970-01-01 00:00:01 to 2038-01-19 03:14:07 UTC
+MIN_TIMESTAMP = 1000
+MAX_TIMESTAMP = (2 ** 31 - 1) * 1000
+
+MISSING_PARAMETERS_DETAIL = ('Missing parameter(s). Requests should include a token, and an array of message objects.'
+                             'Each message object should include a timestamp, sender, receiver, and message '
+                             '(contents).')
+
+QUEUE_FULL_DETAIL = 'The server is busy. Please try again later.'
+
+UNKNOWN_ERROR_DETAIL = ('An unknown error occurred'
+                        'Please see request_body for your original request which resulted in this error.')
+
+# Logged via the API's logger (see setup_logging() in message_api / async_message_api)
+logger = logging.getLogger(__name__)
+
+
+class ApiResponse:
+    """Framework-independent response."""
+
+    def __init__(self, body, status: int = 200, headers: dict = None):
+        """
+
+        :param body:    JSON object (dict), or plain text (str)
+        :param status:  HTTP status
+        :param headers: Additional response headers
+        """
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+
+
+class ApiError(Exception):
+    """Raised by a request handling step to end the request with an error response."""
+
+    def __init__(self, status: int, detail: str = None, headers: dict = None, http_status: int = None, **fields):
+        """
+
+        :param status:      Status, both in the response body and as the HTTP status
+        :param detail:      Error message for the client
+        :param headers:     Additional response headers
+        :param http_status: HTTP status, if it differs from ``status``
+        :param fields:      Additional fields of the response body
+        """
+        super().__init__(detail)
+
+        body = {'status': status}
+        if detail is not None:
+            body['detail'] = detail
+        body.update(fields)
+
+        self.response = ApiResponse(body, status if http_status is None else http_status, headers)
+
+
+def registration_message(token: str, callsign: str, last_updated: datetime, discord_id: int,
+                         client_version: str) -> FsdMessage:
+    """
+    Builds the DM that confirms a callsign registration.
+
+    :param token:           Registration token
+    :param callsign:        Registered callsign
+    :param last_updated:    When the registration was created
+    :param discord_id:      Discord ID of the registered user
+    :param client_version:  FcomClient version of the registering client (e.g. "0.8.0")
+    :return:                Message to queue for the registered user
+    """
+    expiry_time = last_updated + timedelta(1.5)
+    expiry_time_string = f"{str(expiry_time)[:16]}"
+
+    curr_time = round(datetime.utcnow().timestamp())
+    message = f"Callsign **{callsign}** " +\
+              f"(expires **{expiry_time_string}** UTC)\n" +\
+              "To deregister, type `remove` here, or click on **Stop** inside the client."
+
+    # Error in parsing curr_client_version.txt
+    if curr_version == '0.0.0':
+        pass
+    # Client version is newer (suppresses "new version available" message)
+    elif float(client_version[0:3]) >= float(curr_version[0:3]):
+        pass
+    # Outdated client version
+    elif client_version != curr_version:
+        message = message + "\n\n**NEW CLIENT VERSION AVAILABLE**" +\
+                    f" - latest version is **{curr_version}** " +\
+                    "\nhttps://github.com/norrisng/FcomClient/releases"
+
+    return FsdMessage(token, curr_time, 'Registered', callsign, message, discord_id=discord_id)
+
+
+def parse_message(token: str, message: dict) -> (FsdMessage, str):
+    """
+    Validates a single message object from a POST request.
+
+    :param token:   Registration token that the message was submitted with
+    :param message: Message object; i.e. one element of the request's ``messages`` array
+    :return:        (FsdMessage, None) if the message is valid, otherwise (None, error detail)
+    """
+    try:
+        timestamp_raw = message['timestamp']
+        sender_raw = message['sender']
+        receiver_raw = message['receiver']
+        contents = message['message']
+    except (KeyError, TypeError):
+        return None, ('Missing parameter(s). Each message object should include a timestamp, sender, receiver, '
+                      'and message (contents).')
+
+    # Check timestamp
+    try:
+        timestamp = int(timestamp_raw)
+    except (ValueError, TypeError):
+        return None, 'Timestamp must be an integer.'
+
+    if not MIN_TIMESTAMP <= timestamp <= MAX_TIMESTAMP:
+        return None, 'Timestamp must be in milliseconds since the Unix epoch, and no later than 2038.'
+
+    # Check contents
+    if not isinstance(contents, str):
+        return None, 'Message contents must be a string.'
+
+    # Check sender (the whole field, since the DB column is VARCHAR(20))
+    sender_regex = r'[\w-]{1,20}'
+
+    if isinstance(sender_raw, str) and re.fullmatch(sender_regex, sender_raw, re.ASCII):
+        sender = sender_raw
+    else:
+        return None, ('Sender field must be 20 characters or less,'
+                      'and can only contain letters, numbers, dashes, and underscores.')
+
+    # Check receiver (we also have to accept frequencies; e.g. @22800)
+    receiver_regex = r'@\d{5}|[\w-]{1,20}'
+
+    if isinstance(receiver_raw, str) and re.fullmatch(receiver_regex, receiver_raw, re.ASCII):
+
+        # Parse @xxyyy into 1xx.yyy MHz
+        # if receiver_raw.startswith('@') and len(receiver_raw) == 6:
+        #     receiver = f'{receiver_raw[:3]}.{receiver_raw[3:]} MHz'
+        # else:
+        receiver = receiver_raw
+    else:
+        return None, ('Receiver field must be 20 characters or less, '
+                      'and can only contain letters, numbers, dashes, and underscores.'
+                      'Alternatively, if it is a frequency message, it may begin with an '
+                      '"@" and contain precisely 5 numerical digits.')
+
+    return FsdMessage(token, timestamp, sender, receiver, contents), None
+
+
+def parse_messages(token: str, messages: list) -> (list, list):
+    """
+    Validates every message object in a POST request.
+
+    :param token:       Registration token that the messages were submitted with
+    :param messages:    The request's ``messages`` array
+    :return:            (valid messages, per-message results for the response). Each result's status is an HTTP
+                        status code: 200 if the message is valid, 400 (with a detail) otherwise.
+    :raises KeyError:   If ``messages`` isn't a non-empty array
+    """
+    if not isinstance(messages, list) or len(messages) == 0:
+        raise KeyError('messages')
+
+    accepted = []
+    results = []
+
+    for index, message in enumerate(messages):
+        msg, error_detail = parse_message(token, message)
+
+        if msg is None:
+            results.append({'index': index, 'status': 400, 'detail': error_detail})
+        else:
+            accepted.append(msg)
+            results.append({'index': index, 'status': 200})
+
+    return accepted, results
+
+
+# /api/v1/register #
+
+
+def parse_register_request(args: Mapping, headers: Mapping) -> (str, str, str):
+    """
+    :param args:        Query string parameters
+    :param headers:     Request headers
+    :return:            (token, callsign, client version)
+    :raises ApiError:   If the token or callsign is missing
+    """
+    token = args.get('token')
+    callsign = args.get('callsign')
+    client_version = (headers.get('User-Agent') or '').replace('FcomClient/', '')
+
+    logger.info(f'Registration:\t{token} ({callsign})')
+
+    if token is None:
+        raise ApiError(400, 'Missing token')
+    elif callsign is None:
+        raise ApiError(400, 'Missing callsign')
+
+    return token, callsign.upper(), client_version
+
+
+def check_registration(registration: UserRegistration):
+    """
+    :param registration:    Registration looked up by the request's token
+    :raises ApiError:       If the token isn't registered
+    """
+    if registration is None:
+        raise ApiError(400, 'Provided token is not registered to any Discord user')
+
+
+def register_response(token: str, callsign: str, registration: UserRegistration) -> ApiResponse:
+    """
+    :param token:           Registration token
+    :param callsign:        Registered callsign
+    :param registration:    The (now confirmed) registration
+    :return:                Info on the Discord user
+    """
+    return ApiResponse({'token': token, 'discord_id': registration.discord_id,
+                        'discord_name': registration.discord_name, 'callsign': callsign})
+
+
+# /api/v1/messaging #
+
+
+def check_json_request(content_type: str):
+    """
+    :param content_type:    Content-Type of the request
+    :raises ApiError:       If the body isn't JSON
+    """
+    if content_type != 'application/json':
+        raise ApiError(400, 'Only JSON is supported at this time.')
+
+
+def parse_messaging_request(payload) -> (str, List[FsdMessage], List[dict]):
+    """
+    Validates a POST request, and each message in it.
+
+    :param payload:     Request body, parsed from JSON
+    :return:            (token, valid messages, per-message results for the response)
+    :raises ApiError:   If the request is malformed, or none of its messages are valid
+    """
+    try:
+        token = payload['token']
+        messages = payload['messages']
+
+        if isinstance(messages, list) and len(messages) > MAX_MESSAGES_PER_REQUEST:
+            raise ApiError(400, f'A request may contain at most {MAX_MESSAGES_PER_REQUEST} messages.')
+
+        accepted, results = parse_messages(token, messages)
+    except (KeyError, TypeError):
+        raise ApiError(400, MISSING_PARAMETERS_DETAIL)
+
+    for msg in accepted:
+        logger.info(f'Message:\t\t{token}, {msg.sender} > {msg.receiver}',
+                    extra={'rate_limit': 'message', 'token': token, 'sender': msg.sender, 'receiver': msg.receiver})
+
+    if len(accepted) == 0:
+        # Single message: keep the original response format, which older clients expect
+        if len(results) == 1:
+            raise ApiError(400, results[0]['detail'])
+        else:
+            raise ApiError(400, accepted=0, rejected=len(results), results=results)
+
+    return token, accepted, results
+
+
+def check_message_recipient(token: str, registration: UserRegistration):
+    """
+    :param token:           Token the messages were submitted with
+    :param registration:    Registration looked up by the token
+    :raises ApiError:       If the token isn't registered
+    """
+    if registration is None:
+        logger.info(f'Token not found:\t\t\t({token})', extra={'rate_limit': 'token_not_found', 'token': token})
+        raise ApiError(400, "Provided token isn't registered!")
+
+
+def admit_messages(registration: UserRegistration, queued: int, accepted: List[FsdMessage]):
+    """
+    Applies per-token admission control (see api/admission.py), and addresses the messages to the registration's
+    Discord user if they're admitted.
+
+    :param registration:    Registration the messages were submitted for
+    :param queued:          Number of messages already queued for the token
+    :param accepted:        Valid messages in the request
+    :raises ApiError:       (429, with a Retry-After header) if the messages are refused
+    """
+    rejection = admission.check(registration, queued, len(accepted))
+    if rejection is not None:
+        detail, retry_after = rejection
+        logger.info(f'Messages refused:\t{registration.token} ({len(accepted)}): {detail}',
+                    extra={'rate_limit': 'admission', 'token': registration.token, 'retry_after': retry_after})
+        raise ApiError(429, detail, headers={'Retry-After': str(retry_after)})
+
+    for msg in accepted:
+        msg.discord_id = registration.discord_id
+
+
+def messaging_response(accepted: List[FsdMessage], results: List[dict]) -> ApiResponse:
+    """
+    :param accepted:    Messages that were queued
+    :param results:     Per-message results (see ``parse_messages()``)
+    :return:            'ok' if a single message was submitted, otherwise the per-message results
+    """
+    if len(results) == 1:
+        return ApiResponse('ok')
+    else:
+        return ApiResponse({'status': 200, 'accepted': len(accepted), 'rejected': len(results) - len(accepted),
+                            'results': results})
+
+
+def messaging_error_response(error: Exception, payload) -> ApiResponse:
+    """
+    :param error:   Unexpected exception raised while handling a POST request
+    :param payload: Request body, parsed from JSON (None if it couldn't be parsed)
+    :return:        503 if the (in-process) message queue is full, otherwise 500
+    """
+    # Only raised by the in-process queue (see main_combined.py)
+    if isinstance(error, QueueFullError):
+        return ApiResponse({'status': 503, 'detail': QUEUE_FULL_DETAIL}, 503)
+
+    logger.error(f'[Error] {payload}')
+    return ApiResponse({'status': 500, 'detail': UNKNOWN_ERROR_DETAIL, 'request_body': payload}, 500)
+
+
+# /api/v1/deregister #
+
+
+def check_deregistration(token: str, registration: UserRegistration):
+    """
+    :param token:           Token to deregister
+    :param registration:    Registration looked up by the token
+    :raises ApiError:       If the token isn't registered
+    """
+    if registration is None:
+        logger.info(f'Deregister request: [Not found] {token}')
+        raise deregister_not_found()
+
+    logger.info(f'Deregister token {token}')
+
+
+def deregister_response(removed: bool) -> ApiResponse:
+    """
+    :param removed: Whether the registration was removed
+    :return:        'ok' if it was
+    :raises ApiError:   If it wasn't (e.g. it was removed concurrently)
+    """
+    if not removed:
+        raise deregister_not_found()
+
+    return ApiResponse('ok')
+
+
+def deregister_not_found() -> ApiError:
+    # Sent with HTTP 200, as it always has been
+    return ApiError(404, 'The requested token was not found.', http_status=200)
@@ -1,41 +1,41 @@
-from flask import Flask, request, jsonify
-from dbmodels.fsd_message import FsdMessage
+from flask import Flask, Response, g, request, jsonify
+from api import common
+from api.common import API_REQUESTS, API_REQUEST_DURATION, ApiError, ApiResponse, registration_message
 from dbmanager import db_manager
-import logging
-from logging.handlers import TimedRotatingFileHandler
-import os
-import re
-from datetime import datetime, timedelta
+from monitoring.log_pipeline import setup_logging
+from monitoring.metrics import REGISTRY, Registry
+import time
 
 
 app = Flask(__name__)
 
-# Logging config #
+# Logging config (see monitoring/log_pipeline.py) #
 
-if not os.path.exists('logs'):
-    os.mkdir('logs')
+# Shared with api.common, which logs most of the requests
+setup_logging('api', 'api.log')
 
-formatter = logging.Formatter(fmt='%(asctime)s: %(message)s')
-handler = TimedRotatingFileHandler(f'logs/api.log', when='midnight', backupCount=15)
-handler.setFormatter(formatter)
+# End logging config #
 
-logger = logging.getLogger(__name__)
-logger.addHandler(handler)
-logger.setLevel(logging.INFO)
+# Metrics #
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
 
-# End logging config #
 
-try:
-    curr_version_file = open('../FcomServer/curr_client_version.txt')
-    curr_version = curr_version_file.read().replace('FcomClient/','').rstrip()
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    API_REQUESTS.inc(route=route, status=response.status_code)
 
-    # Just in case curr_client_version.txt isn't in the format FcomClient/x.y.z
-    version_regex = '\d\.\d\.\d'    # x.y.z
-    if not re.match(version_regex, curr_version):
-        curr_version = '0.0.0'
+    start = g.get('request_start')
+    if start is not None:
+        API_REQUEST_DURATION.observe(time.perf_counter() - start, route=route)
 
-except FileNotFoundError:
-    curr_version = '0.0.0'
+    return response
+
+# End metrics #
 
 
 @app.route('/api/v1/test', methods=['GET'])
@@ -48,6 +48,26 @@ def test():
     return "Success"
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Metrics for this API worker, in the Prometheus text format.
+    Each worker process keeps its own metrics, so every worker must be scraped separately.
+
+    :return: Metrics, as plain text
+    """
+    return Response(REGISTRY.render(), content_type=Registry.CONTENT_TYPE)
+
+
+def to_response(response: ApiResponse):
+    """
+    :param response:    Response built by api.common
+    :return:            Flask response
+    """
+    body = jsonify(response.body) if isinstance(response.body, dict) else response.body
+    return body, response.status, response.headers
+
+
 @app.route('/api/v1/register', methods=['GET'])
 def register_user():
     """
@@ -56,133 +76,57 @@ def register_user():
     :return: JSON object containing the token, Discord ID, Discord name, and callsign.
             If the token doesn't exist, an error is returned.
     """
-    callsign = request.args.get('callsign').upper()
-    token = request.args.get('token')
-    client_version = request.headers.get('User-Agent').replace('FcomClient/','')
-
-    logger.info(f'Registration:\t{token} ({callsign})')
-
-    if token is None:
-        return jsonify(status=400, detail='Missing token'), 400
-
-    elif callsign is None:
-        return jsonify(status=400, detail='Missing callsign'), 400
+    try:
+        token, callsign, client_version = common.parse_register_request(request.args, request.headers)
 
-    else:
         requested_user = db_manager.get_user_registration(token)
-        if requested_user is None:
-            return jsonify(status=400, detail="Provided token is not registered to any Discord user"), 400
-        else:
-            db_manager.confirm_discord_user(token, callsign.upper())
-
-            expiry_time = requested_user.last_updated + timedelta(1.5)
-            expiry_time_string = f"{str(expiry_time)[:16]}"
-
-            curr_time = round(datetime.utcnow().timestamp())
-            message = f"Callsign **{callsign}** " +\
-                      f"(expires **{expiry_time_string}** UTC)\n" +\
-                      "To deregister, type `remove` here, or click on **Stop** inside the client."
-
-            # Error in parsing curr_client_version.txt
-            if curr_version == '0.0.0':
-                pass
-            # Client version is newer (suppresses "new version available" message)
-            elif float(client_version[0:3]) >= float(curr_version[0:3]):
-                pass
-            # Outdated client version
-            elif client_version != curr_version:
-                message = message + "\n\n**NEW CLIENT VERSION AVAILABLE**" +\
-                            f" - latest version is **{curr_version}** " +\
-                            "\nhttps://github.com/norrisng/FcomClient/releases"
+        common.check_registration(requested_user)
 
-            db_manager.insert_message(FsdMessage(token, curr_time, 'Registered', callsign, message))
+        db_manager.confirm_discord_user(token, callsign)
+        db_manager.insert_message(registration_message(token, callsign, requested_user.last_updated,
+                                                       requested_user.discord_id, client_version))
 
-            discord_id = requested_user.discord_id
-            discord_name = requested_user.discord_name
+        return to_response(common.register_response(token, callsign, requested_user))
 
-            return_string = jsonify(token=token, discord_id=discord_id, discord_name=discord_name, callsign=callsign)
-            return return_string
+    except ApiError as e:
+        return to_response(e.response)
 
 
 @app.route('/api/v1/messaging', methods=['POST'])
 def post_message():
     """
-    Forwards a message to a Discord user.
+    Forwards one or more messages to a Discord user.
 
-    :return: 'ok' on success. A 400 error with details is returned if the request is in the incorrect format.
-    """
-    if request.content_type != 'application/json':
-        return jsonify(status=400, detail='Only JSON is supported at this time.'), 400
+    All messages in the request are validated individually, and the valid ones are queued in a single batch.
 
-    payload = request.get_json()
+    :return: 'ok' on success, if a single message was submitted.
+             If multiple messages were submitted, a JSON object with a per-message result is returned instead
+             (HTTP 200 if at least one message was accepted, 400 otherwise).
+             A 400 error with details is returned if the request is in the incorrect format.
+             A 429 error with a Retry-After header is returned if the token is over its limits (see api/admission.py).
+    """
+    payload = None
 
     try:
-        # token, list of messages
-        token = payload['token']
-
-        # TODO: support parsing of multiple messages per POST request
-        message = payload['messages'][0]
-
-        timestamp_raw = message['timestamp']
-        sender_raw = message['sender']
-        receiver_raw = message['receiver']
-        message = message['message']
-
-        # Check timestamp
-        try:
-            timestamp = int(timestamp_raw)
-        except ValueError:
-            return jsonify(status=400, detail='Timestamp must be an integer.'), 400
-
-        # Check sender
-        sender_regex = '(\w|\d|_|-)+'
-
-        if re.match(sender_regex, sender_raw, re.ASCII):
-            sender = sender_raw
-        else:
-            error_detail = ('Sender field must be 20 characters or less,'
-                            'and can only contain letters, numbers, dashes, and underscores.')
-            return jsonify(status=400, detail=error_detail), 400
-
-        # Check receiver (we also have to accept frequencies; e.g. @22800)
-        receiver_regex = '(@\d{5})|(\w|\d|_|-)+'
-
-        if re.match(receiver_regex, receiver_raw, re.ASCII):
-
-            # Parse @xxyyy into 1xx.yyy MHz
-            # if receiver_raw.startswith('@') and len(receiver_raw) == 6:
-            #     receiver = f'{receiver_raw[:3]}.{receiver_raw[3:]} MHz'
-            # else:
-            receiver = receiver_raw
-        else:
-            error_detail = ('Receiver field must be 20 characters or less, '
-                            'and can only contain letters, numbers, dashes, and underscores.'
-                            'Alternatively, if it is a frequency message, it may begin with an '
-                            '"@" and contain precisely 5 numerical digits.')
-            return jsonify(status=400, detail=error_detail), 400
-
-        logger.info(f'Message:\t\t{token}, {sender} > {receiver}')
+        common.check_json_request(request.content_type)
+        payload = request.get_json()
+
+        token, accepted, results = common.parse_messaging_request(payload)
 
         # Check token - if it's not associated with any Discord user, return an error
         discord_user = db_manager.get_user_registration(token)
-        if discord_user is None:
-            logger.info(f'Token not found:\t\t\t({token})')
-            return jsonify(status=400, detail="Provided token isn't registered!"), 400
+        common.check_message_recipient(token, discord_user)
+        common.admit_messages(discord_user, db_manager.queued_messages(token), accepted)
+
+        db_manager.insert_messages(accepted)
 
-        db_manager.insert_message(FsdMessage(token, timestamp, sender, receiver, message))
+        return to_response(common.messaging_response(accepted, results))
 
-        return 'ok'
+    except ApiError as e:
+        return to_response(e.response)
 
-    except KeyError:
-        error_detail = ('Missing parameter(s). Requests should include a token, and an array of message objects.'
-                        'Each message object should include a timestamp, sender, receiver, and message (contents).')
-        return jsonify(status=400, detail=error_detail), 400
-    
-    except:
-        logger.error(f'[Error] {payload}')
-        error_detail = ('An unknown error occurred'
-                        'Please see request_body for your original request which resulted in this error.')
-        return jsonify(status=500, detail=error_detail, request_body=payload), 500
+    except Exception as e:
+        return to_response(common.messaging_error_response(e, payload))
 
 
 @app.route('/api/v1/deregister/<string:token>', methods=['DELETE'])
@@ -192,17 +136,9 @@ def deregister(token: str):
     Has the same effect as the `remove` Discord bot command.
     :return: 'ok' on success, 404 if it doesn't exist
     """
+    try:
+        common.check_deregistration(token, db_manager.get_user_registration(token))
+        return to_response(common.deregister_response(db_manager.remove_discord_user(token)))
 
-    error_msg = jsonify(status=404, detail='The requested token was not found.')
-
-    discord_user = db_manager.get_user_registration(token)
-    if discord_user is None:
-        logger.info(f'Deregister request: [Not found] {token}')
-        return error_msg
-    else:
-        logger.info(f'Deregister token {token}')
-
-        if db_manager.remove_discord_user(token):
-            return 'ok'
-        else:
-            return error_msg
+    except ApiError as e:
+        return to_response(e.response)
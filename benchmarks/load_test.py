@@ -0,0 +1,341 @@
+"""
+End-to-end load test for the message API.
+
+Serves the Flask app on a local port, backed by a throwaway SQLite database, and drives a configurable mix of
+/register, /messaging and /deregister requests against it over HTTP.
+Throughput and latency percentiles are reported per endpoint, and saved as JSON.
+
+Per-token admission control (see api/admission.py) would otherwise throttle the few hundred tokens used here, so its
+limits (FCOM_TOKEN_MESSAGE_RATE, FCOM_TOKEN_MESSAGE_BURST and FCOM_MAX_QUEUED_PER_TOKEN) are raised far beyond what
+the test can reach, unless already set in the environment. Throttled requests (429) are counted separately from
+errors, so that a run with the limits in effect still shows how many requests were admitted.
+
+Usage (from the project root):
+    python -m benchmarks.load_test [--concurrency 16] [--duration 30] [--output results.json]
+    python -m benchmarks.load_test --compare old.json new.json
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ENDPOINTS = ['register', 'messaging', 'deregister']
+
+# Request outcomes
+OK = 'ok'
+THROTTLED = 'throttled'
+ERROR = 'error'
+
+# Admission control limits used unless set in the environment; high enough to never be reached
+ADMISSION_LIMITS = {
+    'FCOM_TOKEN_MESSAGE_RATE': '1000000',
+    'FCOM_TOKEN_MESSAGE_BURST': '1000000',
+    'FCOM_MAX_QUEUED_PER_TOKEN': '1000000',
+}
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """
+    :param sorted_values:   Samples, in ascending order
+    :param fraction:        e.g. 0.95 for p95
+    :return:                The nearest-rank percentile, or 0 if there are no samples
+    """
+    if len(sorted_values) == 0:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class LoadTest:
+    """Shared state for a single load test run."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.rng_lock = threading.Lock()
+
+        # Keeps message contents unique, since the API drops resubmitted messages
+        self.message_sequence = itertools.count()
+
+        # Registration tokens that clients can currently use
+        self.tokens = []
+        self.tokens_lock = threading.Lock()
+        self.next_discord_id = 1
+
+        # endpoint -> list of latencies (in seconds), and error / throttled request counts
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.throttled = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.results_lock = threading.Lock()
+
+        self.host = '127.0.0.1'
+        self.port = None
+
+    # Setup #
+
+    def add_registration(self):
+        """Registers a new (fake) Discord user directly in the DB, bypassing the bot."""
+        from dbmanager import db_manager
+
+        with self.tokens_lock:
+            discord_id = self.next_discord_id
+            self.next_discord_id += 1
+
+        token = db_manager.add_discord_user(discord_id, f'loadtest #{discord_id:04d}', None)
+        with self.tokens_lock:
+            self.tokens.append(token)
+
+    def pick_token(self, remove: bool = False) -> str:
+        with self.tokens_lock:
+            with self.rng_lock:
+                index = self.rng.randrange(len(self.tokens))
+            if remove:
+                return self.tokens.pop(index)
+            else:
+                return self.tokens[index]
+
+    def choose_endpoint(self) -> str:
+        with self.rng_lock:
+            return self.rng.choices(ENDPOINTS, weights=self.args.mix)[0]
+
+    # Requests #
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None) -> int:
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        finally:
+            conn.close()
+
+    @staticmethod
+    def outcome(status: int, *ok_statuses: int) -> str:
+        """
+        :param status:      HTTP status of the response
+        :param ok_statuses: Statuses that count as success
+        :return:            ``OK``, ``THROTTLED`` or ``ERROR``
+        """
+        if status in ok_statuses:
+            return OK
+        elif status == 429:
+            return THROTTLED
+        else:
+            return ERROR
+
+    def do_register(self) -> str:
+        token = self.pick_token()
+        status = self.request('GET', f'/api/v1/register?token={token}&callsign=LOADTEST',
+                              headers={'User-Agent': 'FcomClient/9.9.9'})
+        return self.outcome(status, 200)
+
+    def do_messaging(self) -> str:
+        token = self.pick_token()
+        now = int(time.time() * 1000)
+
+        with self.rng_lock:
+            batch_size = self.rng.randint(1, self.args.max_batch)
+
+        messages = [{'timestamp': now, 'sender': 'LOADTEST_CTR', 'receiver': 'LOADTEST',
+                     'message': f'load test message {next(self.message_sequence)}'} for _ in range(batch_size)]
+        body = json.dumps({'token': token, 'messages': messages}).encode()
+
+        status = self.request('POST', '/api/v1/messaging', body=body, headers={'Content-Type': 'application/json'})
+
+        # Another worker may have just deregistered this token
+        return self.outcome(status, 200, 400)
+
+    def do_deregister(self) -> str:
+        token = self.pick_token(remove=True)
+        status = self.request('DELETE', f'/api/v1/deregister/{token}')
+
+        # Keep the number of registrations constant (not timed)
+        self.add_registration()
+        return self.outcome(status, 200)
+
+    def worker(self, deadline: float):
+        actions = {'register': self.do_register, 'messaging': self.do_messaging, 'deregister': self.do_deregister}
+
+        while time.monotonic() < deadline:
+            endpoint = self.choose_endpoint()
+
+            start = time.perf_counter()
+            try:
+                outcome = actions[endpoint]()
+            except (OSError, http.client.HTTPException):
+                outcome = ERROR
+            elapsed = time.perf_counter() - start
+
+            with self.results_lock:
+                self.latencies[endpoint].append(elapsed)
+                if outcome == ERROR:
+                    self.errors[endpoint] += 1
+                elif outcome == THROTTLED:
+                    self.throttled[endpoint] += 1
+
+    def drain_queue(self, stop: threading.Event):
+        """Stands in for the bot, so that the message queue doesn't grow without bound."""
+        from dbmanager import db_manager
+
+        while not stop.is_set():
+            claimed = db_manager.claim_messages()
+            ids = [message_id for msg in claimed for message_id in msg.message_ids]
+            db_manager.ack_messages(ids)
+            if len(claimed) == 0:
+                stop.wait(0.05)
+
+    # Run #
+
+    def run(self) -> dict:
+        from werkzeug.serving import make_server
+        from api.message_api import app
+
+        for _ in range(self.args.registrations):
+            self.add_registration()
+
+        server = make_server(self.host, 0, app, threaded=True)
+        self.port = server.server_port
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        stop_draining = threading.Event()
+        if not self.args.no_drain:
+            threading.Thread(target=self.drain_queue, args=(stop_draining,), daemon=True).start()
+
+        start = time.monotonic()
+        deadline = start + self.args.duration
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            for _ in range(self.args.concurrency):
+                executor.submit(self.worker, deadline)
+        duration = time.monotonic() - start
+
+        stop_draining.set()
+        server.shutdown()
+
+        return self.report(duration)
+
+    def report(self, duration: float) -> dict:
+        endpoints = {}
+        total_requests = 0
+
+        for endpoint in ENDPOINTS:
+            samples = sorted(self.latencies[endpoint])
+            total_requests += len(samples)
+            endpoints[endpoint] = {
+                'requests': len(samples),
+                'errors': self.errors[endpoint],
+                'throttled': self.throttled[endpoint],
+                'throughput_rps': len(samples) / duration,
+                'p50_ms': percentile(samples, 0.50) * 1000,
+                'p95_ms': percentile(samples, 0.95) * 1000,
+                'p99_ms': percentile(samples, 0.99) * 1000,
+                'max_ms': (samples[-1] if samples else 0.0) * 1000,
+            }
+
+        return {
+            'commit': git_commit(),
+            'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+            'config': {
+                'concurrency': self.args.concurrency,
+                'duration': self.args.duration,
+                'mix': dict(zip(ENDPOINTS, self.args.mix)),
+                'max_batch': self.args.max_batch,
+                'registrations': self.args.registrations,
+                'seed': self.args.seed,
+                'drain': not self.args.no_drain,
+            },
+            'duration_seconds': duration,
+            'total_throughput_rps': total_requests / duration,
+            'endpoints': endpoints,
+        }
+
+
+def print_report(report: dict):
+    print(f"Commit {report['commit']}: {report['total_throughput_rps']:.1f} req/s overall "
+          f"({report['config']['concurrency']} workers, {report['duration_seconds']:.1f}s)")
+    print(f"{'endpoint':<12}{'requests':>10}{'errors':>8}{'throttled':>11}{'req/s':>10}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, stats in report['endpoints'].items():
+        print(f"{endpoint:<12}{stats['requests']:>10}{stats['errors']:>8}{stats['throttled']:>11}"
+              f"{stats['throughput_rps']:>10.1f}"
+              f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+
+
+def compare(old_path: str, new_path: str):
+    """Prints the relative change in throughput and latency percentiles between two saved runs."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def change(before, after):
+        if before == 0:
+            return '    n/a'
+        return f'{(after - before) / before * 100:+7.1f}%'
+
+    print(f"{old['commit']} -> {new['commit']}")
+    print(f"{'endpoint':<12}{'req/s':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for endpoint in ENDPOINTS:
+        before = old['endpoints'].get(endpoint)
+        after = new['endpoints'].get(endpoint)
+        if before is None or after is None:
+            continue
+        print(f"{endpoint:<12}{change(before['throughput_rps'], after['throughput_rps']):>10}"
+              f"{change(before['p50_ms'], after['p50_ms']):>10}"
+              f"{change(before['p95_ms'], after['p95_ms']):>10}"
+              f"{change(before['p99_ms'], after['p99_ms']):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the FCOM message API.')
+    parser.add_argument('--concurrency', type=int, default=16, help='number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=30, help='test duration, in seconds')
+    parser.add_argument('--mix', type=float, nargs=3, default=[5, 90, 5],
+                        metavar=('REGISTER', 'MESSAGING', 'DEREGISTER'), help='relative weights of each endpoint')
+    parser.add_argument('--max-batch', type=int, default=1, help='maximum number of messages per /messaging request')
+    parser.add_argument('--registrations', type=int, default=200, help='number of registered tokens')
+    parser.add_argument('--seed', type=int, default=0, help='random seed, for reproducible request mixes')
+    parser.add_argument('--no-drain', action='store_true', help="don't consume the message queue during the test")
+    parser.add_argument('--output', help='path to save the results to, as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved results instead')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # Must be configured before db_manager (and the API) is first imported
+    db_dir = tempfile.mkdtemp(prefix='fcom-loadtest-')
+    os.environ['FCOM_DB_BACKEND'] = 'sqlite'
+    os.environ['FCOM_SQLITE_PATH'] = os.path.join(db_dir, 'loadtest.sqlite3')
+    for name, value in ADMISSION_LIMITS.items():
+        os.environ.setdefault(name, value)
+
+    report = LoadTest(args).run()
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved to {args.output}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""
+Round-trip budget check for the registration and messaging flows.
+
+Runs each flow against a throwaway SQLite database, counting the SQL statements it issues (each of which is a round
+trip to the server on MariaDB) and the connections it checks out of the pool. Each flow is measured with cold and
+with warm caches (see ``CACHE_STATES``), against a separate budget for each. Exits with a non-zero status if any flow
+exceeds its budget, so that an extra query sneaking into one of them is caught. Also run (in a subprocess) by the
+test suite (``tests/test_round_trips.py``).
+
+Transaction control (BEGIN/COMMIT) and connection setup (PRAGMA) aren't counted, since they're SQLite-specific:
+the MariaDB backend runs in autocommit mode, with its settings applied once per connection.
+
+Usage (from the project root):
+    python -m benchmarks.round_trips
+"""
+import os
+import sys
+import tempfile
+import threading
+from datetime import datetime
+
+# Cache states each flow is measured in:
+#   cold:   the registration and queue depth caches are empty, e.g. the first request for a token after a restart,
+#           or once its cache entries have expired
+#   warm:   the token's registration and queue depth are already cached, i.e. a client that's sending messages
+CACHE_STATES = ('cold', 'warm')
+
+# (flow, maximum number of statements when cold, maximum number of statements when warm)
+BUDGETS = [
+    ('register (bot)', 1, 1),           # INSERT IGNORE
+    ('register (API)', 3, 2),           # (cached) lookup, UPDATE, registration message INSERT
+    ('messaging (API)', 3, 1),          # (cached) lookup, (cached) queue depth, INSERT
+    ('deregister (API)', 2, 1),         # (cached) lookup, DELETE ... RETURNING
+    ('remove (bot)', 1, 1),             # DELETE ... RETURNING
+    ('expire registrations', 1, 1),     # DELETE ... RETURNING
+]
+
+# Not issued by the flows themselves; see above
+UNCOUNTED_PREFIXES = ('PRAGMA', 'BEGIN', 'COMMIT', 'ROLLBACK')
+
+
+class StatementCounter:
+    """Counts the statements executed on every connection it's attached to (from any thread)."""
+
+    def __init__(self):
+        self.statements = 0
+        self._lock = threading.Lock()
+
+    def trace(self, statement: str):
+        if not statement.lstrip().upper().startswith(UNCOUNTED_PREFIXES):
+            with self._lock:
+                self.statements += 1
+
+    def attach(self, backend_class):
+        """
+        Wraps the backend's connection factory, so that every new connection is traced.
+
+        :param backend_class:   ``SqliteBackend``
+        """
+        connect = backend_class._connect
+
+        def traced_connect(backend):
+            conn = connect(backend)
+            conn.set_trace_callback(self.trace)
+            return conn
+
+        backend_class._connect = traced_connect
+
+
+def measure(counter: StatementCounter, db_manager, flow) -> tuple:
+    """
+    :param counter:     Attached statement counter
+    :param db_manager:  ``dbmanager.db_manager``
+    :param flow:        Called with no arguments
+    :return:            (statements, connections checked out) used by the flow
+    """
+    statements = counter.statements
+    acquired = db_manager.backend.pool.stats()['acquired']
+
+    flow()
+
+    return counter.statements - statements, db_manager.backend.pool.stats()['acquired'] - acquired
+
+
+def run_flows(counter: StatementCounter, cache_state: str, first_discord_id: int) -> dict:
+    """
+    :param counter:             Statement counter, attached before the backend was created
+    :param cache_state:         One of ``CACHE_STATES``
+    :param first_discord_id:    Discord IDs used by the flows start from this, so that runs don't interfere
+    :return:                    flow -> (statements, connections checked out)
+    """
+    from dbmanager import db_manager
+    from dbmodels.fsd_message import FsdMessage
+
+    def message(token: str, text: str) -> FsdMessage:
+        return FsdMessage(token, int(datetime.utcnow().timestamp() * 1000), 'SERVER', 'TEST', text)
+
+    def prepare(token: str = None):
+        """Puts the caches in the cache state being measured, before each flow."""
+        db_manager.registration_cache.clear()
+        db_manager.queue_depths.clear()
+
+        if cache_state == 'warm' and token is not None:
+            db_manager.get_user_registration(token)
+            db_manager.queued_messages(token)
+
+    # Shared between flows
+    state = {}
+
+    # Same sequence of calls as the corresponding bot command / API endpoint
+    def register_bot():
+        state['token'] = db_manager.add_discord_user(first_discord_id, 'user#0001', None)
+
+    def register_api():
+        token = state['token']
+        user = db_manager.get_user_registration(token)
+        db_manager.confirm_discord_user(token, 'TEST')
+        db_manager.insert_message(message(token, f'Registered {user.discord_name}'))
+
+    def messaging_api():
+        token = state['token']
+        if db_manager.get_user_registration(token) is not None:
+            db_manager.queued_messages(token)
+            db_manager.insert_message(message(token, 'Hello'))
+
+    def deregister_api():
+        token = state['token']
+        if db_manager.get_user_registration(token) is not None:
+            db_manager.remove_discord_user(token)
+
+    def remove_bot():
+        db_manager.remove_discord_user(first_discord_id + 1)
+
+    def expire_registrations():
+        db_manager.expire_registrations([state['stale_token']])
+
+    results_by_flow = {}
+
+    prepare()
+    results_by_flow['register (bot)'] = measure(counter, db_manager, register_bot)
+
+    prepare(state['token'])
+    results_by_flow['register (API)'] = measure(counter, db_manager, register_api)
+
+    prepare(state['token'])
+    results_by_flow['messaging (API)'] = measure(counter, db_manager, messaging_api)
+
+    prepare(state['token'])
+    results_by_flow['deregister (API)'] = measure(counter, db_manager, deregister_api)
+
+    db_manager.add_discord_user(first_discord_id + 1, 'user#0002', None)
+    prepare()
+    results_by_flow['remove (bot)'] = measure(counter, db_manager, remove_bot)
+
+    # Backdated, so that it's already stale
+    state['stale_token'] = db_manager.add_discord_user(first_discord_id + 2, 'user#0003', None)
+    with db_manager.backend.pool.connection() as conn:
+        conn.execute("UPDATE registration SET last_updated = datetime('now', '-1 hour') WHERE token=?",
+                     (state['stale_token'],))
+    prepare(state['stale_token'])
+    results_by_flow['expire registrations'] = measure(counter, db_manager, expire_registrations)
+
+    return results_by_flow
+
+
+def measure_all() -> dict:
+    """
+    Creates a throwaway SQLite database, and measures every flow in every cache state.
+    Must be called before ``db_manager`` is first imported, and only once per process.
+
+    :return:    (flow, cache state) -> (statements, connections checked out)
+    """
+    db_dir = tempfile.mkdtemp(prefix='fcom-roundtrips-')
+    os.environ['FCOM_DB_BACKEND'] = 'sqlite'
+    os.environ['FCOM_SQLITE_PATH'] = os.path.join(db_dir, 'roundtrips.sqlite3')
+
+    from dbmanager.backends.sqlite_backend import SqliteBackend
+
+    counter = StatementCounter()
+    counter.attach(SqliteBackend)
+
+    results = {}
+    for i, cache_state in enumerate(CACHE_STATES):
+        for flow, result in run_flows(counter, cache_state, 1000 * (i + 1)).items():
+            results[(flow, cache_state)] = result
+
+    return results
+
+
+def main() -> int:
+    results = measure_all()
+
+    failed = False
+    print(f'{"flow":<24}{"caches":>8}{"statements":>12}{"budget":>8}{"connections":>13}')
+    for flow, *budgets in BUDGETS:
+        for cache_state, budget in zip(CACHE_STATES, budgets):
+            statements, connections = results[(flow, cache_state)]
+            over = statements > budget
+            failed = failed or over
+            print(f'{flow:<24}{cache_state:>8}{statements:>12}{budget:>8}{connections:>13}'
+                  f'{"  OVER BUDGET" if over else ""}')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,13 +3,16 @@ from discord.ext import commands, tasks
 from discord import DMChannel, errors as discordpy_error
 from aiohttp import ClientError
 from websockets import exceptions as websocket_error
-from bot import bot_user_commands
-from dbmanager import db_manager
-from logging.handlers import TimedRotatingFileHandler
+from bot import bot_user_commands, dm_formatter
+from bot.expiry_scheduler import ExpiryScheduler
+from bot.send_scheduler import SendScheduler
+from dbmanager import db_manager, db_executor, queue_notify
+from monitoring import log_pipeline, metrics
 import asyncio
 import logging
 import os
 import discord_credentials
+import time
 import traceback
 
 description = 'FCOM bot'
@@ -17,32 +20,143 @@ bot = commands.Bot(command_prefix='!', description=description)
 
 token = discord_credentials.TOKEN
 
-# Logging config #
-
-if not os.path.exists('logs'):
-    os.mkdir('logs')
-
-formatter = logging.Formatter(fmt='%(asctime)s: %(message)s')
-handler = TimedRotatingFileHandler(f'logs/bot.log', when='midnight', backupCount=15)
-handler.setFormatter(formatter)
-
-logger = logging.getLogger(__name__)
-logger.addHandler(handler)
-logger.setLevel(logging.INFO)
+# Maximum number of DMs being sent at once. DMs to the same recipient are never sent concurrently.
+DM_SEND_CONCURRENCY = int(os.environ.get('FCOM_DM_SEND_CONCURRENCY', 10))
+
+# The API wakes up the bot whenever it queues messages (see queue_notify).
+# The queue is also polled at this interval (in seconds), in case a notification is lost.
+QUEUE_POLL_INTERVAL = float(os.environ.get('FCOM_QUEUE_POLL_INTERVAL', 30))
+
+# Sharding: the bot can run as FCOM_BOT_PROCESS_COUNT processes (see main_bot.py), numbered from 0.
+# Each process connects the gateway shards where (shard ID % process count) == its index,
+# and only delivers messages in its own partition of the queue (see db_manager.queue_partition()).
+# Registration commands arrive on shard 0, and stale registrations are pruned by process 0 only.
+BOT_PROCESS_COUNT = db_manager.QUEUE_PARTITION_COUNT
+BOT_PROCESS_INDEX = int(os.environ.get('FCOM_BOT_PROCESS_INDEX', 0))
+BOT_SHARD_COUNT = int(os.environ.get('FCOM_BOT_SHARD_COUNT', BOT_PROCESS_COUNT))
+
+if not 0 <= BOT_PROCESS_INDEX < BOT_PROCESS_COUNT:
+    raise ValueError(f'FCOM_BOT_PROCESS_INDEX must be between 0 and {BOT_PROCESS_COUNT - 1}')
+if BOT_SHARD_COUNT < BOT_PROCESS_COUNT:
+    raise ValueError('FCOM_BOT_SHARD_COUNT must be at least FCOM_BOT_PROCESS_COUNT')
+
+# Discord rate limits, enforced by the send scheduler (see send_scheduler.py).
+# The global limit is shared by every process, and by the bot's other API calls (e.g. opening DM channels),
+# so each process gets an equal share of slightly less than Discord's 50 requests per second.
+DISCORD_GLOBAL_RATE = float(os.environ.get('FCOM_DISCORD_GLOBAL_RATE', 45)) / BOT_PROCESS_COUNT
+DISCORD_CHANNEL_RATE = float(os.environ.get('FCOM_DISCORD_CHANNEL_RATE', 1))
+DISCORD_CHANNEL_BURST = float(os.environ.get('FCOM_DISCORD_CHANNEL_BURST', 5))
+
+# Registrations are expired individually as they come due (see expire_registrations()), in batches of up to this many.
+# New registrations must be confirmed within 5 minutes (see remove_expired_users() in the storage backends).
+REGISTRATION_EXPIRY_BATCH_SIZE = int(os.environ.get('FCOM_REGISTRATION_EXPIRY_BATCH_SIZE', 100))
+UNVERIFIED_REGISTRATION_LIFETIME = 5 * 60
+
+# Metrics are served over plain HTTP at this address (see monitoring/metrics.py).
+# Each bot process uses FCOM_BOT_METRICS_PORT + its index. Set FCOM_BOT_METRICS_PORT to 0 to disable.
+BOT_METRICS_HOST = os.environ.get('FCOM_BOT_METRICS_HOST', '127.0.0.1')
+BOT_METRICS_PORT = int(os.environ.get('FCOM_BOT_METRICS_PORT', 9102))
+
+DMS_SENT = metrics.REGISTRY.counter('fcom_dms_sent_total', 'Number of DMs successfully sent')
+DM_SEND_ERRORS = metrics.REGISTRY.counter('fcom_discord_send_errors_total', 'Number of DMs that could not be sent',
+                                          ('error',))
+DELIVERY_LAG = metrics.REGISTRY.histogram('fcom_delivery_lag_seconds',
+                                          'Time from a message being queued to it being sent as a DM',
+                                          buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+SEND_SCHEDULER_STATS = metrics.REGISTRY.gauge('fcom_send_scheduler', 'Discord send scheduler state', ('stat',))
+SCHEDULED_EXPIRIES = metrics.REGISTRY.gauge('fcom_scheduled_registration_expiries',
+                                            'Number of registrations awaiting expiry')
+
+# Logging config (see monitoring/log_pipeline.py) #
+
+# Every process needs its own file, since they'd otherwise all try to rotate it
+log_filename = 'bot.log' if BOT_PROCESS_COUNT == 1 else f'bot-{BOT_PROCESS_INDEX}.log'
+logger = log_pipeline.setup_logging(__name__, log_filename)
 
 # End logging config #
 
 
 # https://github.com/Rapptz/discord.py/blob/master/examples/background_task.py
-class BotClient(discord.Client):
+class BotClient(discord.AutoShardedClient):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.send_scheduler = SendScheduler(DISCORD_GLOBAL_RATE, DISCORD_CHANNEL_RATE, DISCORD_CHANNEL_BURST,
+                                            DM_SEND_CONCURRENCY)
+        SEND_SCHEDULER_STATS.set_function(
+            lambda: {(stat,): value for stat, value in self.send_scheduler.stats().items()})
+        self.queue_wakeup = asyncio.Event()
+        self.queue_listener = None
+        self.metrics_server = None
+        self.channel_prewarm = None
+        self.registration_expiry = ExpiryScheduler()
+        self.registration_expiry_wakeup = asyncio.Event()
+        SCHEDULED_EXPIRIES.set_function(lambda: len(self.registration_expiry))
+
+        # start_bot() creates a new client on every retry, and channels cached by the previous one are bound to its
+        # closed connection. They're reopened by prewarm_channels().
+        db_manager.pm_channels.clear()
 
     async def on_ready(self):
-        logger.info(f'Now logged in as {self.user.name} ({self.user.id})')
-        self.forward_messages.start()
-        self.prune_registrations.start()
+        logger.info(f'Now logged in as {self.user.name} ({self.user.id}), '
+                    f'process {BOT_PROCESS_INDEX}/{BOT_PROCESS_COUNT}, shards {sorted(self.shards.keys())}')
+
+        if self.queue_listener is None:
+            try:
+                self.queue_listener = await queue_notify.listen(self.queue_wakeup, BOT_PROCESS_INDEX)
+            except OSError:
+                logger.error(f'Could not listen for queue notifications; polling every {QUEUE_POLL_INTERVAL}s instead')
+                logger.error(f'{traceback.format_exc()}')
+
+        if self.metrics_server is None and BOT_METRICS_PORT != 0:
+            metrics_port = BOT_METRICS_PORT + BOT_PROCESS_INDEX
+            try:
+                self.metrics_server = await metrics.start_http_server(BOT_METRICS_HOST, metrics_port)
+            except OSError:
+                logger.error(f'Could not serve metrics on {BOT_METRICS_HOST}:{metrics_port}')
+                logger.error(f'{traceback.format_exc()}')
+
+        # In the background, since it can take a while; messages are forwarded in the meantime
+        if self.channel_prewarm is None:
+            self.channel_prewarm = asyncio.create_task(self.prewarm_channels())
+
+        # on_ready is dispatched again whenever the gateway session is re-established,
+        # by which time the tasks are already running
+        if not self.forward_messages.is_running():
+            self.forward_messages.start()
+
+        if BOT_PROCESS_INDEX == 0 and not self.expire_registrations.is_running():
+            self.expire_registrations.start()
+
+    async def prewarm_channels(self):
+        """
+        Caches the DM channels of currently verified users in this process's queue partition (most recently
+        registered first), so that the first message to each of them after a restart doesn't wait on
+        Discord API calls.
+        """
+        start = time.monotonic()
+
+        try:
+            discord_ids = await db_executor.run(db_manager.get_verified_discord_ids)
+        except Exception:
+            logger.error(f'{traceback.format_exc()}')
+            return
+
+        discord_ids = [discord_id for discord_id in discord_ids
+                       if db_manager.queue_partition(discord_id) == BOT_PROCESS_INDEX]
+        discord_ids = discord_ids[:db_manager.PM_CHANNEL_CACHE_SIZE]
+
+        # One at a time, so that any API calls (fetching users, opening DM channels) trickle out rather than competing
+        # with DMs. Each one also takes a token from the send scheduler's global bucket (see db_manager.get_channel()).
+        cached = 0
+        for discord_id in discord_ids:
+            try:
+                await db_manager.get_channel(self, discord_id)
+                cached += 1
+            except discordpy_error.HTTPException:
+                logger.info(f'Could not open DM channel for {discord_id}')
+
+        logger.info(f'Prewarmed {cached}/{len(discord_ids)} DM channels in {time.monotonic() - start:.1f}s')
 
     async def on_message(self, message):
         """
@@ -64,11 +178,12 @@ class BotClient(discord.Client):
         # register
         elif message.content.lower() == 'register':
 
-            fcom_api_token = bot_user_commands.register_user(message.channel)
+            fcom_api_token = await bot_user_commands.register_user(message.channel)
 
             if fcom_api_token is None:
                 msg = "You're already registered! To reset your registration, type `remove` before typing `register` again."
             else:
+                self.schedule_expiry(fcom_api_token, UNVERIFIED_REGISTRATION_LIFETIME)
                 msg = f"Here's your Discord code: ```{fcom_api_token}```" + \
                       "\nPlease enter it into the client within the next 5 minutes.\n"
                 logger.info(
@@ -95,7 +210,7 @@ class BotClient(discord.Client):
         # remove
         elif message.content.lower() == 'remove':
 
-            if bot_user_commands.remove_user(message.channel.recipient.id):
+            if await bot_user_commands.remove_user(message.channel.recipient.id):
                 msg = "Successfully deregistered! You'll no longer receive forwarded messages."
                 logger.info(f'Deregister user:\t{message.channel.recipient.id} '
                             f'({message.channel.recipient.name} #{message.channel.recipient.discriminator})')
@@ -105,75 +220,224 @@ class BotClient(discord.Client):
             await message.channel.send(msg)
 
     # Reference: https://github.com/Rapptz/discord.py/blob/master/examples/background_task.py
-    @tasks.loop(seconds=3)
+    @tasks.loop(seconds=0)
     async def forward_messages(self):
         """
         Background task that retrieves submitted PMs from the DB and forwards them to the registered Discord user.
+        Runs whenever the API signals that new messages were queued, or every ``QUEUE_POLL_INTERVAL`` seconds.
+        DMs to different recipients are sent concurrently (up to ``DM_SEND_CONCURRENCY`` at a time, and paced to
+        stay within Discord's rate limits), while DMs to the same recipient are always sent in arrival order.
         """
-        # while not bot.is_closed():
-        messages = db_manager.get_messages()
+        try:
+            await asyncio.wait_for(self.queue_wakeup.wait(), timeout=QUEUE_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+        # Clear before dequeuing, so that messages queued from here on trigger another iteration
+        self.queue_wakeup.clear()
+
+        messages = await db_executor.run(db_manager.claim_messages, partition=BOT_PROCESS_INDEX)
 
-        # Iterate through queued messages (if any), and forward them via Discord DM
-        if messages is not None:
+        # Iterate through claimed messages (if any), and forward them via Discord DM
+        if len(messages) > 0:
+
+            # Group by recipient, preserving arrival order within each group
+            messages_by_token = {}
             for msg in messages:
+                messages_by_token.setdefault(msg.token, []).append(msg)
+
+            results = await asyncio.gather(*[self.forward_to_recipient(recipient_token, recipient_messages)
+                                             for recipient_token, recipient_messages in messages_by_token.items()],
+                                           return_exceptions=True)
+
+            # Only remove handled messages from the queue.
+            # Anything else is retried once its claim expires.
+            handled_ids = []
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(''.join(traceback.format_exception(type(result), result, result.__traceback__)))
+                else:
+                    handled_ids.extend(result)
 
-                dm_user = await db_manager.get_user_record(msg.token, self)
+            await db_executor.run(db_manager.ack_messages, handled_ids)
 
-                if dm_user is not None:
+            # A full batch means there are probably more messages waiting
+            if sum(len(msg.message_ids) for msg in messages) >= db_manager.QUEUE_CLAIM_BATCH_SIZE:
+                self.queue_wakeup.set()
 
-                    # if it's a frequency message (i.e. @xxyyy), parse it into a user-friendly format
-                    if msg.receiver.startswith('@'):
-                        freq = msg.receiver.replace('@', '1')[:3] + '.' + msg.receiver[3:]
-                        dm_contents = f'**{msg.sender}** ({freq} MHz):\n{msg.message}'
+    async def forward_to_recipient(self, recipient_token: str, messages: list) -> list:
+        """
+        Sequentially forwards the given messages to the Discord user registered to the given token,
+        packed into as few DMs as possible (see ``dm_formatter``).
 
-                    else:
-                        dm_contents = f'**{msg.sender}**:\n{msg.message}'
+        :param recipient_token: Registration token of the recipient
+        :param messages:        Messages for this recipient, in the order they should be sent
+        :return:                IDs of the queued messages that have been handled,
+                                i.e. delivered, or which can never be delivered.
+        """
+        handled_ids = []
 
-                    dm_channel = dm_user.channel_object
-                    try:
-                        await dm_channel.send(dm_contents)
-                    except discordpy_error.Forbidden:
-                        logger.info(f'[HTTP 403] Could not send DM to {dm_user.discord_name} ({dm_user.discord_id})')
-                    except discordpy_error.HTTPException as e:
-                        logger.error(f'{traceback.format_exc()}')
+        try:
+            dm_user = await db_manager.get_user_record(recipient_token, self)
+        except Exception:
+            # Possibly transient (DB, pool or Discord lookup error), so nothing is acked:
+            # the messages are retried once their claim expires
+            logger.error(f'{traceback.format_exc()}', extra={'rate_limit': 'recipient_lookup_error'})
+            return handled_ids
+
+        if dm_user is None:
+            # NOTE: the API now checks if a token's registered before inserting messages
+            logger.info(f'Token {recipient_token} is not registered!',
+                        extra={'rate_limit': 'token_not_registered', 'token': recipient_token})
+            for msg in messages:
+                handled_ids.extend(msg.message_ids)
+            return handled_ids
+
+        dm_channel = dm_user.channel_object
+        delivered = False
+
+        # As few DMs as possible, each within Discord's length limit
+        for dm_contents, completed_messages in dm_formatter.pack_messages(messages):
+            try:
+                await self.send_scheduler.send(dm_channel, dm_contents)
+            except discordpy_error.Forbidden as e:
+                DM_SEND_ERRORS.inc(error=type(e).__name__)
+                logger.info(f'[HTTP 403] Could not send DM to {dm_user.discord_name} ({dm_user.discord_id})',
+                            extra={'rate_limit': 'send_forbidden', 'discord_id': dm_user.discord_id})
+
+                # Repeated failures quarantine the registration, so that the API stops queueing messages for it
+                try:
+                    await db_executor.run(db_manager.record_dm_failure, recipient_token)
+                except Exception:
+                    logger.error(f'{traceback.format_exc()}')
+
+                # The user doesn't accept DMs from the bot, so none of the remaining messages can be delivered either
+                return [message_id for msg in messages for message_id in msg.message_ids]
+            except discordpy_error.NotFound as e:
+                DM_SEND_ERRORS.inc(error=type(e).__name__)
+                logger.info(f'[HTTP 404] DM channel for {dm_user.discord_id} not found',
+                            extra={'rate_limit': 'send_not_found', 'discord_id': dm_user.discord_id})
+
+                # e.g. the user's DM channel is gone. Reopened once the rest of the messages are retried.
+                db_manager.pm_channels.pop(dm_user.discord_id)
+                break
+            except discordpy_error.HTTPException as e:
+                DM_SEND_ERRORS.inc(error=type(e).__name__)
+
+                # Can be one per recipient during a Discord outage
+                logger.error(f'{traceback.format_exc()}', extra={'rate_limit': 'send_error', 'status': e.status})
+
+                # Server-side errors and rate limits are transient, so leave the rest of this recipient's
+                # messages queued, to be retried (in order) once the claim expires
+                if e.status == 429:
+                    self.send_scheduler.rate_limited_for(dm_channel.id,
+                                                         float(e.response.headers.get('Retry-After', 1)))
+                    break
+                elif e.status >= 500:
+                    break
+            else:
+                DMS_SENT.inc()
+                delivered = True
+                for msg in completed_messages:
+                    if msg.insert_time is not None:
+                        DELIVERY_LAG.observe(time.time() - float(msg.insert_time))
 
-                else:
-                    # NOTE: the API now checks if a token's registered before inserting messages
-                    logger.info(f'Token {msg.token} is not registered!')
+            for msg in completed_messages:
+                handled_ids.extend(msg.message_ids)
+
+        # The user accepts DMs again, so earlier failures (and any quarantine) no longer count
+        if delivered and dm_user.dm_failures > 0:
+            try:
+                await db_executor.run(db_manager.clear_dm_failures, recipient_token)
+            except Exception:
+                logger.error(f'{traceback.format_exc()}')
 
-            # await asyncio.sleep(3)
+        return handled_ids
 
     @forward_messages.before_loop
     async def before_forward_messages(self):
         await self.wait_until_ready()
 
-    @tasks.loop(minutes=5)
-    async def prune_registrations(self):
+    def schedule_expiry(self, token: str, seconds: float):
+        """
+        :param token:   Registration token
+        :param seconds: Seconds until the registration expires
+        """
+        self.registration_expiry.schedule(token, time.monotonic() + seconds)
+
+        # The expiry loop may be sleeping until a later deadline
+        self.registration_expiry_wakeup.set()
+
+    @tasks.loop(seconds=0)
+    async def expire_registrations(self):
         """
         Remove registrations that are either unconfirmed and older than 5 minutes,
         or confirmed and older than 24 hours.
 
+        Each registration is removed shortly after it expires, in small batches of indexed lookups
+        (rather than by periodically sweeping the whole table).
+        Registrations confirmed in the meantime are checked again once their new expiry comes due.
         """
-        db_manager.remove_stale_users()
-        await asyncio.sleep(60*5)
+        try:
+            await asyncio.wait_for(self.registration_expiry_wakeup.wait(),
+                                   timeout=self.registration_expiry.delay(time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
+        self.registration_expiry_wakeup.clear()
+
+        due = self.registration_expiry.pop_due(time.monotonic(), REGISTRATION_EXPIRY_BATCH_SIZE)
+        if len(due) == 0:
+            return
+
+        try:
+            remaining = await db_executor.run(db_manager.expire_registrations, due)
+        except Exception:
+            logger.error(f'{traceback.format_exc()}')
+
+            # Try again later, rather than in a tight loop
+            for token in due:
+                self.schedule_expiry(token, UNVERIFIED_REGISTRATION_LIFETIME)
+            return
+
+        for token, seconds in remaining:
+            self.schedule_expiry(token, float(seconds))
 
-    @prune_registrations.before_loop
-    async def before_prune_registrations(self):
+    @expire_registrations.before_loop
+    async def before_expire_registrations(self):
         await self.wait_until_ready()
 
+        # Registrations created (or confirmed) while the bot wasn't running.
+        # Anything that's already expired comes due straight away.
+        for token, seconds in await db_executor.run(db_manager.get_registration_expiries):
+            self.schedule_expiry(token, float(seconds))
 
-def start_bot():
+
+def get_shard_ids() -> list:
     """
-    Starts the bot
-    :return:
+    :return:    IDs of the gateway shards that this bot process connects
     """
-    # bot.loop.create_task(forward_messages())
-    # bot.loop.create_task(prune_registrations())
+    return [shard_id for shard_id in range(BOT_SHARD_COUNT) if shard_id % BOT_PROCESS_COUNT == BOT_PROCESS_INDEX]
+
 
+def create_client() -> BotClient:
+    """
+    :return:    A bot client for this process's shards. Not yet connected.
+    """
     intents = discord.Intents.default()
     intents.messages = True
     intents.members = True
 
+    return BotClient(intents=intents, shard_count=BOT_SHARD_COUNT, shard_ids=get_shard_ids())
+
+
+def start_bot():
+    """
+    Starts the bot (or, when sharded, this process's share of it)
+    :return:
+    """
+    # bot.loop.create_task(forward_messages())
+    # bot.loop.create_task(prune_registrations())
+
     retry = True
 
     # Based on https://gist.github.com/Hornwitser/93aceb86533ed3538b6f
@@ -184,7 +448,7 @@ def start_bot():
         max_wait_interval = 5 * 60      # 5-minute max interval between retries
 
         try:
-            client = BotClient(intents=intents)
+            client = create_client()
             client.run(token)
             # bot.run(token)
 
@@ -216,6 +480,3 @@ def start_bot():
 
         else:
             break
-
-
-start_bot()
@@ -0,0 +1,101 @@
+from dbmodels.fsd_message import FsdMessage
+from typing import List, Tuple
+
+# Discord rejects messages longer than this (HTTP 400)
+DM_MAX_LENGTH = 2000
+
+# Separates consecutive messages within a single DM
+MESSAGE_SEPARATOR = '\n\n'
+
+# Messages that need splitting anyway are only started at the end of a partially-filled DM
+# if at least this many characters of them fit
+MIN_SPLIT_LENGTH = 200
+
+
+def format_header(msg: FsdMessage, continued: bool = False) -> str:
+    """
+    :param msg:         Message to format
+    :param continued:   Whether this header precedes the continuation of a message split across DMs
+    :return:            Sender line of the message; e.g. "**BAW123** (122.800 MHz):"
+    """
+    # if it's a frequency message (i.e. @xxyyy), parse it into a user-friendly format
+    if msg.receiver.startswith('@'):
+        freq = msg.receiver.replace('@', '1')[:3] + '.' + msg.receiver[3:]
+        header = f'**{msg.sender}** ({freq} MHz)'
+    else:
+        header = f'**{msg.sender}**'
+
+    if continued:
+        header = f'{header} (cont.)'
+
+    return f'{header}:'
+
+
+def split_text(text: str, max_length: int) -> Tuple[str, str]:
+    """
+    Splits off as much of the text as fits in ``max_length`` characters,
+    preferably at a line break, then at a space, and otherwise mid-word.
+
+    :param text:        Text longer than ``max_length``
+    :param max_length:  Maximum length of the first part
+    :return:            (first part, remainder)
+    """
+    # Only split at a line break or space if that doesn't leave the first part mostly empty
+    for delimiter in ('\n', ' '):
+        index = text.rfind(delimiter, max_length // 2, max_length + 1)
+        if index != -1:
+            return text[:index], text[index + 1:]
+
+    return text[:max_length], text[max_length:]
+
+
+def pack_messages(messages: List[FsdMessage], max_length: int = DM_MAX_LENGTH) -> List[Tuple[str, List[FsdMessage]]]:
+    """
+    Packs messages for a single recipient into as few DMs as possible, preserving their order.
+    Each message keeps its own sender line. Messages too long for a single DM are split across several.
+
+    :param messages:    Messages for a single recipient, in the order they should be sent
+    :param max_length:  Maximum length of a single DM
+    :return:            (DM contents, messages completed by that DM) for each DM, in the order they should be sent.
+                        A message that's split across DMs is only listed under the last of them,
+                        so it's only considered delivered once all of its parts are.
+    """
+    dms = []
+    contents = ''
+    completed = []
+
+    for msg in messages:
+        body = msg.message or ''
+        continued = False
+
+        while True:
+            header = format_header(msg, continued)
+            block = f'{header}\n{body}'
+            separator = MESSAGE_SEPARATOR if contents else ''
+            room = max_length - len(contents) - len(separator)
+
+            # Fits in the current DM
+            if len(block) <= room:
+                contents = contents + separator + block
+                completed.append(msg)
+                break
+
+            # Start a new DM, rather than splitting a message that would fit in one,
+            # or splitting off a fragment too short to be worth it
+            if contents and (len(block) <= max_length or room - len(header) - 1 < MIN_SPLIT_LENGTH):
+                dms.append((contents, completed))
+                contents = ''
+                completed = []
+                continue
+
+            # Too long for a DM of its own: fill the current DM, and carry the rest over
+            first_part, body = split_text(body, room - len(header) - 1)
+            dms.append((contents + separator + f'{header}\n{first_part}', completed))
+            contents = ''
+            completed = []
+            continued = True
+
+    if contents:
+        dms.append((contents, completed))
+
+    return dms
@@ -0,0 +1,74 @@
+import heapq
+
+
+class ExpiryScheduler:
+    """
+    Min-heap of keys ordered by deadline, for expiring items individually as they come due.
+
+    Rescheduling or cancelling a key leaves its old heap entry in place; stale entries are skipped (and discarded)
+    once they reach the top. Not thread-safe; only used from the event loop.
+    """
+
+    def __init__(self):
+        # (deadline, key), including stale entries
+        self._heap = []
+
+        # key -> current deadline
+        self._deadlines = {}
+
+    def schedule(self, key, deadline: float):
+        """
+        Schedules the key to expire at the given deadline, replacing its previous deadline (if any).
+
+        :param key:         Key to schedule
+        :param deadline:    When the key expires, in ``time.monotonic()`` seconds
+        """
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+
+        # Stale entries would otherwise pile up if keys are rescheduled over and over
+        if len(self._heap) > 2 * len(self._deadlines) + 1000:
+            self._heap = [(deadline, key) for key, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    def _discard_stale(self):
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def delay(self, now: float) -> float:
+        """
+        :param now: Current ``time.monotonic()``
+        :return:    Seconds until the next key is due (0 if one is already due), or None if nothing is scheduled
+        """
+        self._discard_stale()
+        if not self._heap:
+            return None
+        else:
+            return max(0.0, self._heap[0][0] - now)
+
+    def pop_due(self, now: float, limit: int) -> list:
+        """
+        Removes and returns keys whose deadline has passed, earliest first.
+
+        :param now:     Current ``time.monotonic()``
+        :param limit:   Maximum number of keys to return
+        :return:        Due keys
+        """
+        due = []
+
+        while len(due) < limit:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+
+            deadline, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            due.append(key)
+
+        return due
+
+    def __len__(self):
+        return len(self._deadlines)
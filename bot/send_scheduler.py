@@ -0,0 +1,204 @@
+import asyncio
+import time
+from typing import TYPE_CHECKING
+
+# Only needed for type hints, so that the scheduler can be tested without discord.py installed
+if TYPE_CHECKING:
+    from discord import abc
+
+
+class TokenBucket:
+    """
+    Allows ``rate`` events per second on average, with bursts of up to ``capacity`` events.
+    Not thread-safe; only used from the event loop.
+    """
+
+    def __init__(self, rate: float, capacity: float, now: float = None):
+        """
+
+        :param rate:        Tokens added per second
+        :param capacity:    Maximum number of tokens (i.e. burst size). The bucket starts full.
+        :param now:         Current ``time.monotonic()``, if already known
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """
+        :param now: Current ``time.monotonic()``
+        :return:    Seconds until a token is available (0 if one is available now)
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        else:
+            return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def drain(self, now: float, seconds: float):
+        """
+        Empties the bucket so that the next token is only available after ``seconds``; e.g. after an HTTP 429.
+        """
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def available(self, now: float) -> float:
+        """
+        :param now: Current ``time.monotonic()``
+        :return:    Number of tokens currently available (negative if drained)
+        """
+        self._refill(now)
+        return self.tokens
+
+
+class SendScheduler:
+    """
+    Paces outgoing DMs to stay within Discord's rate limits, instead of relying on discord.py's reactive 429 handling
+    (which stalls every send sharing the exhausted bucket until it resets).
+
+    Every send takes a token from the global bucket (shared by all channels) and from its channel's bucket.
+    A send that has to wait only sleeps its own coroutine, so sends to other channels keep going.
+    """
+
+    # Channel buckets are only tracked while they're not full; full ones are dropped every this many sends
+    PRUNE_INTERVAL = 1000
+
+    def __init__(self, global_rate: float, channel_rate: float, channel_burst: float, max_concurrency: int,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        """
+
+        :param global_rate:     Sends per second across all channels (also the global burst size)
+        :param channel_rate:    Sends per second to a single channel
+        :param channel_burst:   Sends in a burst to a single channel
+        :param max_concurrency: Maximum number of sends in flight at once
+        :param clock:           Returns the current time in seconds (e.g. a fake clock, for testing)
+        :param sleep:           Coroutine function that waits for the given number of seconds on ``clock``
+        """
+        self.clock = clock
+        self.sleep = sleep
+        self.global_bucket = TokenBucket(global_rate, global_rate, clock())
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.channel_buckets = {}
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+        self.waiting = 0
+        self.sends = 0
+        self.throttled = 0
+        self.throttle_seconds = 0.0
+        self.rate_limited = 0
+        self.other_requests = 0
+
+    def _channel_bucket(self, channel_id: int) -> TokenBucket:
+        bucket = self.channel_buckets.get(channel_id)
+        if bucket is None:
+            bucket = TokenBucket(self.channel_rate, self.channel_burst, self.clock())
+            self.channel_buckets[channel_id] = bucket
+        return bucket
+
+    async def acquire(self, channel_id: int):
+        """
+        Waits until a send to the given channel is allowed by both the global and the channel's bucket,
+        then takes a token from each.
+
+        :param channel_id:  ID of the channel being sent to
+        """
+        start = self.clock()
+        throttled = False
+
+        self.waiting += 1
+        try:
+            while True:
+                # Looked up every time, since the bucket may have been pruned while waiting
+                bucket = self._channel_bucket(channel_id)
+                now = self.clock()
+                delay = max(bucket.delay(now), self.global_bucket.delay(now))
+                if delay == 0:
+                    break
+                throttled = True
+                await self.sleep(delay)
+        finally:
+            self.waiting -= 1
+
+        # No await since the check above, so no other send can have taken these tokens in the meantime
+        bucket.consume(now)
+        self.global_bucket.consume(now)
+
+        if throttled:
+            self.throttled += 1
+            self.throttle_seconds += now - start
+
+        self.sends += 1
+        if self.sends % self.PRUNE_INTERVAL == 0:
+            self._prune(now)
+
+    async def acquire_global(self):
+        """
+        Waits until the global bucket allows another request, then takes a token from it.
+        For Discord API calls other than sends (e.g. fetching a user, or opening a DM channel),
+        which count towards the same global limit.
+        """
+        while True:
+            now = self.clock()
+            delay = self.global_bucket.delay(now)
+            if delay == 0:
+                break
+            await self.sleep(delay)
+
+        self.global_bucket.consume(now)
+        self.other_requests += 1
+
+    def rate_limited_for(self, channel_id: int, retry_after: float):
+        """
+        Records that Discord rate limited a send anyway (e.g. because of other traffic on the same token),
+        so that subsequent sends to the channel are held back accordingly.
+
+        :param channel_id:  ID of the rate-limited channel
+        :param retry_after: Seconds until Discord allows another send
+        """
+        self.rate_limited += 1
+        self._channel_bucket(channel_id).drain(self.clock(), retry_after)
+
+    async def send(self, channel: 'abc.Messageable', content: str):
+        """
+        Sends a message once the rate limits allow it.
+
+        :param channel: Channel to send to
+        :param content: Message contents
+        :return:        The sent ``discord.Message``
+        """
+        await self.acquire(channel.id)
+        async with self.semaphore:
+            return await channel.send(content)
+
+    def _prune(self, now: float):
+        # A full bucket behaves exactly like a new one, so it can be dropped
+        self.channel_buckets = {channel_id: bucket for channel_id, bucket in self.channel_buckets.items()
+                                if bucket.available(now) < bucket.capacity}
+
+    def stats(self) -> dict:
+        """
+        :return:    Bucket state and throttling counters, for monitoring
+        """
+        now = self.clock()
+        return {
+            'global_tokens': self.global_bucket.available(now),
+            'global_capacity': self.global_bucket.capacity,
+            'tracked_channels': len(self.channel_buckets),
+            'exhausted_channels': sum(1 for bucket in self.channel_buckets.values() if bucket.delay(now) > 0),
+            'waiting': self.waiting,
+            'sends': self.sends,
+            'throttled': self.throttled,
+            'throttle_seconds': self.throttle_seconds,
+            'rate_limited': self.rate_limited,
+            'other_requests': self.other_requests,
+        }
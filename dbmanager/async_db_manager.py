@@ -0,0 +1,140 @@
+"""
+Coroutine versions of the ``db_manager`` functions used by the API, for the ASGI API (api/async_message_api.py).
+
+Shares ``db_manager``'s storage backend selection, registration cache, queue partitioning and metrics,
+so that both API variants behave identically.
+"""
+import asyncio
+from dbmanager import db_executor, db_manager
+from dbmanager.backends import load_async_backend
+from dbmanager.db_manager import DB_CALL_DURATION, REGISTRATION_CACHE_NEGATIVE_TTL, pm_channels, registration_cache, \
+    filter_duplicates, remember_messages, _NOT_CACHED
+from dbmodels.user_registration import UserRegistration
+from dbmodels.fsd_message import FsdMessage
+from typing import List
+
+backend = load_async_backend(db_manager.DB_BACKEND, db_manager.backend)
+
+
+async def connect():
+    """
+    Opens the DB connections. Must be awaited (on the serving event loop) before any other function is called.
+    """
+    await backend.open()
+
+
+async def disconnect():
+    await backend.close()
+
+
+@DB_CALL_DURATION.time(function='async_get_user_registration')
+async def get_user_registration(req_token: str) -> UserRegistration:
+    """
+    Retrieves the specified user from the registration DB. See ``db_manager.get_user_registration()``.
+
+    :param req_token:   The token associated with the registered Discord user.
+    :return:            User registration entry in the DB. Returns ``None`` if specified token doesn't exist.
+                        ``UserRegistration.channel_object`` will be ``None``!
+    """
+    cached = registration_cache.get(req_token, _NOT_CACHED)
+    if cached is not _NOT_CACHED:
+        return cached
+
+    result = await backend.get_user_record_tuple(req_token)
+
+    if result is None:
+        registration_cache.set(req_token, None, ttl=REGISTRATION_CACHE_NEGATIVE_TTL)
+        return None
+
+    last_updated, token, discord_id, discord_name, is_verified, callsign, dm_failures, quarantine_seconds = result
+
+    user = UserRegistration(last_updated, token, discord_id, discord_name, is_verified, callsign, None,
+                            dm_failures, quarantine_seconds)
+    registration_cache.set(req_token, user)
+    return user
+
+
+@DB_CALL_DURATION.time(function='async_confirm_discord_user')
+async def confirm_discord_user(token: str, callsign: str) -> bool:
+    """
+    Marks the specified token as confirmed, and saves the callsign to the Discord user.
+
+    :param token:    the token associated with a given user
+    :param callsign: the callsign that the Discord user wants to register
+    :return:         True if success, False otherwise
+    """
+    if await backend.confirm_user(token, callsign):
+        registration_cache.pop(token)
+        return True
+    else:
+        return False
+
+
+@DB_CALL_DURATION.time(function='async_remove_discord_user')
+async def remove_discord_user(token: str) -> bool:
+    """
+    Removes the specified user from the DB. See ``db_manager.remove_discord_user()``.
+
+    :param token:   Token of the registration to remove
+    :return:        True on success, False otherwise
+    """
+    # Both the token and Discord ID are returned, so that we can delete their cache entries
+    removed = await backend.remove_user(token)
+
+    if removed is None:
+        return False
+    else:
+        token, discord_id = removed
+
+        # The channel cache is only used when the bot runs in the same process (see main_combined.py)
+        pm_channels.pop(discord_id)
+        registration_cache.pop(token)
+
+        return True
+
+
+async def insert_message(msg: FsdMessage):
+    await insert_messages([msg])
+
+
+@DB_CALL_DURATION.time(function='async_insert_messages')
+async def insert_messages(msgs: List[FsdMessage]):
+    """
+    Queues the given messages, returning once they've been committed.
+    Batched and deduplicated as in ``db_manager.insert_messages()``.
+
+    :param msgs:    Messages to queue, in arrival order
+    """
+    msgs = filter_duplicates(msgs)
+    if len(msgs) == 0:
+        return
+
+    message_queue = db_manager.message_queue
+
+    # Shares the synchronous API's write buffer, whose writer thread never blocks the event loop
+    if message_queue is None:
+        await asyncio.wrap_future(db_manager.write_buffer.submit(msgs))
+
+    # Without a journal, the in-process queue never blocks, so it's called directly
+    elif message_queue.journal_path is None:
+        remember_messages(msgs, message_queue.insert_messages(msgs))
+    else:
+        remember_messages(msgs, await db_executor.run(message_queue.insert_messages, msgs))
+
+
+async def queued_messages(token: str) -> int:
+    """
+    Number of messages queued for the given token. See ``db_manager.queued_messages()``.
+
+    :param token:   Registration token
+    :return:        Number of queued messages
+    """
+    if db_manager.message_queue is not None:
+        return db_manager.message_queue.queued_messages(token)
+
+    depth = db_manager.queue_depths.get(token)
+    if depth is None:
+        depth = await db_executor.run(db_manager.backend.queued_messages, token)
+        db_manager.queue_depths.set(token, depth)
+
+    return depth
@@ -0,0 +1,42 @@
+from dbmanager.backends.base import AsyncStorageBackend, StorageBackend
+
+
+def load_backend(name: str) -> StorageBackend:
+    """
+    Instantiates the specified storage backend.
+    Backends are imported lazily, so that only the selected backend's dependencies need to be installed.
+
+    :param name:    'mariadb' or 'sqlite'
+    :return:        The storage backend
+    """
+    if name == 'mariadb':
+        from dbmanager.backends.mariadb_backend import MariaDbBackend
+        return MariaDbBackend()
+
+    elif name == 'sqlite':
+        from dbmanager.backends.sqlite_backend import SqliteBackend
+        return SqliteBackend()
+
+    else:
+        raise ValueError(f"Unknown storage backend '{name}' (expected 'mariadb' or 'sqlite')")
+
+
+def load_async_backend(name: str, backend: StorageBackend) -> AsyncStorageBackend:
+    """
+    Instantiates the async counterpart of the specified storage backend.
+    Backends without a native async driver run the synchronous backend's calls on the DB executor instead.
+
+    :param name:    'mariadb' or 'sqlite'
+    :param backend: The (synchronous) storage backend already in use by this process
+    :return:        The async storage backend. ``open()`` must be awaited before it's used.
+    """
+    if name == 'mariadb':
+        from dbmanager.backends.async_mariadb_backend import AsyncMariaDbBackend
+        return AsyncMariaDbBackend()
+
+    elif name == 'sqlite':
+        from dbmanager.backends.executor_backend import ExecutorBackend
+        return ExecutorBackend(backend)
+
+    else:
+        raise ValueError(f"Unknown storage backend '{name}' (expected 'mariadb' or 'sqlite')")
@@ -0,0 +1,60 @@
+import aiomysql
+import asyncio
+from pymysql.constants import CLIENT
+from dbmanager.backends.base import AsyncStorageBackend
+from dbmanager.backends.mariadb_backend import DB_URI, DB_USERNAME, DB_PASSWORD, DB_NAME, DB_POOL_SIZE, \
+    DB_POOL_TIMEOUT, DB_POOL_HEALTH_CHECK_INTERVAL, CONFIRM_USER, remove_user_query, user_record_query
+from dbmanager.connection_pool import PoolTimeoutError
+
+
+class AsyncMariaDbBackend(AsyncStorageBackend):
+    """
+    MariaDB backend using a native async driver (aiomysql), so that waiting on the DB never ties up a thread.
+    Uses the same pool settings, and issues the same statements, as ``MariaDbBackend``.
+    """
+
+    def __init__(self):
+        self.pool = None
+
+    async def open(self):
+        # Autocommit and FOUND_ROWS, for the same reasons as MariaDbBackend.
+        # Connections idle for longer than the health check interval are reconnected rather than pinged.
+        self.pool = await aiomysql.create_pool(host=DB_URI, user=DB_USERNAME, password=DB_PASSWORD, db=DB_NAME,
+                                               minsize=1, maxsize=DB_POOL_SIZE, autocommit=True,
+                                               client_flag=CLIENT.FOUND_ROWS,
+                                               pool_recycle=int(DB_POOL_HEALTH_CHECK_INTERVAL))
+
+    async def close(self):
+        self.pool.close()
+        await self.pool.wait_closed()
+
+    async def _execute(self, cmd: str, params, fetch: bool = False):
+        """
+        :param cmd:     Statement to execute
+        :param params:  Statement parameters
+        :param fetch:   Whether to return the first row of the result
+        :return:        The first row if ``fetch`` is set, otherwise the number of affected rows
+        """
+        try:
+            conn = await asyncio.wait_for(self.pool.acquire(), timeout=DB_POOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise PoolTimeoutError(f'Timed out after {DB_POOL_TIMEOUT}s waiting for a DB connection')
+
+        try:
+            async with conn.cursor() as cursor:
+                await cursor.execute(cmd, params)
+                if fetch:
+                    return await cursor.fetchone()
+                else:
+                    return cursor.rowcount
+        finally:
+            self.pool.release(conn)
+
+    async def get_user_record_tuple(self, param) -> tuple:
+        return await self._execute(user_record_query(param), (param,), fetch=True)
+
+    async def confirm_user(self, token: str, callsign: str) -> bool:
+        return await self._execute(CONFIRM_USER, (callsign, token)) == 1
+
+    async def remove_user(self, param) -> tuple:
+        return await self._execute(remove_user_query(param), (param,), fetch=True)
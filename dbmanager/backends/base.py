@@ -0,0 +1,172 @@
+from typing import Iterator, List
+from dbmodels.fsd_message import FsdMessage
+
+# Claimed messages are read from the DB this many rows at a time (see StorageBackend.claim_messages())
+CLAIM_FETCH_SIZE = 100
+
+
+class StorageBackend:
+    """
+    Interface implemented by every storage backend.
+
+    Backends only execute SQL: token generation, caching, message aggregation and queue notifications
+    are all handled by ``db_manager``.
+    Registration records are returned as tuples of
+    ``(last_updated, token, discord_id, discord_name, is_verified, callsign, dm_failures, quarantine_seconds)``,
+    where ``quarantine_seconds`` is the number of seconds until the registration's quarantine ends
+    (None if it has never been quarantined, negative if the quarantine is over).
+    """
+
+    def get_user_record_tuple(self, param) -> tuple:
+        """
+        :param param:   Discord ID (int) or token (str)
+        :return:        Registration record, or None if it doesn't exist
+        """
+        raise NotImplementedError
+
+    def add_user(self, token: str, discord_id: int, discord_name: str) -> bool:
+        """
+        Adds an unverified registration.
+
+        :param token:           Newly-generated token
+        :param discord_id:      Discord ID
+        :param discord_name:    Discord user name, including the discriminator
+        :return:                True on success, False if the Discord user is already registered
+        """
+        raise NotImplementedError
+
+    def confirm_user(self, token: str, callsign: str) -> bool:
+        """
+        Marks the registration as verified, and saves the callsign.
+
+        :param token:       Registration token
+        :param callsign:    Callsign to register
+        :return:            True on success, False if the token doesn't exist
+        """
+        raise NotImplementedError
+
+    def remove_user(self, param) -> tuple:
+        """
+        :param param:   Discord ID (int) or token (str) of the registration to delete
+        :return:        (token, discord_id) of the deleted registration, or None if it didn't exist
+        """
+        raise NotImplementedError
+
+    def remove_expired_users(self, tokens: List[str]) -> List[tuple]:
+        """
+        Deletes those of the given registrations that are stale:
+        unconfirmed ones older than 5 minutes, and confirmed ones older than 24 hours.
+
+        :param tokens:  Tokens of the registrations to check
+        :return:        (token, discord_id) of each deleted registration
+        """
+        raise NotImplementedError
+
+    def get_registration_expiries(self, tokens: List[str] = None) -> List[tuple]:
+        """
+        Expiry is calculated by the DB, so that it agrees with ``remove_expired_users()``.
+
+        :param tokens:  Tokens of the registrations to look up. Defaults to all registrations.
+        :return:        (token, seconds until the registration becomes stale) of each registration found
+        """
+        raise NotImplementedError
+
+    def record_dm_failure(self, token: str, quarantine_after: int, quarantine_seconds: int):
+        """
+        Counts a rejected DM against the registration, and quarantines it once enough of them are consecutive.
+        Doesn't change ``last_updated`` (i.e. the registration's expiry).
+
+        :param token:               Registration token
+        :param quarantine_after:    Number of consecutive rejected DMs that quarantines the registration
+        :param quarantine_seconds:  How long the registration is quarantined for
+        """
+        raise NotImplementedError
+
+    def clear_dm_failures(self, token: str):
+        """
+        Resets the registration's rejected DM count, and lifts its quarantine (if any).
+        Doesn't change ``last_updated`` (i.e. the registration's expiry).
+
+        :param token:   Registration token
+        """
+        raise NotImplementedError
+
+    def get_verified_discord_ids(self) -> List[int]:
+        """
+        :return:    Discord IDs of all verified registrations, most recently updated first
+        """
+        raise NotImplementedError
+
+    def insert_messages(self, msgs: List[FsdMessage]) -> int:
+        """
+        Queues the given messages in a single transaction.
+        Messages whose ``dedup_hash`` matches that of a message still in the queue are skipped.
+
+        :param msgs:    Messages to queue, in arrival order
+        :return:        Number of messages actually queued, or ``len(msgs)`` if the backend can't tell
+        """
+        raise NotImplementedError
+
+    def claim_messages(self, claim_id: int, limit: int, lease: int, partition: int = None,
+                       partition_count: int = 1) -> Iterator[tuple]:
+        """
+        Claims up to ``limit`` unclaimed (or expired) queued messages.
+        Implemented as a generator that reads ``CLAIM_FETCH_SIZE`` rows at a time, so that only a few rows are held
+        in memory at once. It holds a pooled connection until exhausted, so it must always be iterated to the end.
+
+        :param claim_id:        Unique ID for this claim
+        :param limit:           Maximum number of messages to claim
+        :param lease:           Number of seconds after which claimed messages may be claimed again
+        :param partition:       If set, only claim messages whose ``discord_id % partition_count`` equals this.
+                                Messages without a ``discord_id`` belong to partition 0.
+        :param partition_count: Total number of partitions
+        :return:                Claimed messages (the messages are claimed as soon as iteration starts) as
+                                ``(id, token, time_received, sender, receiver, message, insert_time)`` tuples,
+                                in queue order. ``insert_time`` is in seconds since the Unix epoch.
+        """
+        raise NotImplementedError
+
+    def ack_messages(self, message_ids: List[int]):
+        """
+        :param message_ids: IDs of the queued messages to delete
+        """
+        raise NotImplementedError
+
+    def queue_depth(self) -> int:
+        """
+        :return:    Number of messages in the queue (claimed or not)
+        """
+        raise NotImplementedError
+
+    def queued_messages(self, token: str) -> int:
+        """
+        :param token:   Registration token
+        :return:        Number of messages in the queue (claimed or not) for the given token
+        """
+        raise NotImplementedError
+
+
+class AsyncStorageBackend:
+    """
+    Coroutine-based counterpart of ``StorageBackend``, used by the ASGI API (see api/async_message_api.py).
+    Only covers the operations the API performs, apart from queueing messages (which goes through
+    ``db_manager.write_buffer``). Arguments and results are the same as ``StorageBackend``'s.
+    """
+
+    async def open(self):
+        """
+        Opens the backend's connections. Must be called from the event loop that will use the backend.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    async def get_user_record_tuple(self, param) -> tuple:
+        raise NotImplementedError
+
+    async def confirm_user(self, token: str, callsign: str) -> bool:
+        raise NotImplementedError
+
+    async def remove_user(self, param) -> tuple:
+        raise NotImplementedError
@@ -0,0 +1,31 @@
+from dbmanager import db_executor
+from dbmanager.backends.base import AsyncStorageBackend, StorageBackend
+
+
+class ExecutorBackend(AsyncStorageBackend):
+    """
+    Async wrapper for backends without a native async driver (i.e. SQLite).
+    Calls are run on the DB executor, so concurrency is capped at ``FCOM_DB_EXECUTOR_WORKERS``.
+    """
+
+    def __init__(self, backend: StorageBackend):
+        """
+
+        :param backend: The synchronous backend to wrap
+        """
+        self.backend = backend
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get_user_record_tuple(self, param) -> tuple:
+        return await db_executor.run(self.backend.get_user_record_tuple, param)
+
+    async def confirm_user(self, token: str, callsign: str) -> bool:
+        return await db_executor.run(self.backend.confirm_user, token, callsign)
+
+    async def remove_user(self, param) -> tuple:
+        return await db_executor.run(self.backend.remove_user, param)
@@ -0,0 +1,268 @@
+import mysql.connector as mariadb
+from mysql.connector.constants import ClientFlag
+import os
+from typing import Iterator, List
+from dbmanager.backends.base import CLAIM_FETCH_SIZE, StorageBackend
+from dbmanager.connection_pool import ConnectionPool
+from dbmodels.fsd_message import FsdMessage
+
+# MariaDB
+DB_URI = 'localhost'
+DB_USERNAME = os.environ['FCOM_DB_USERNAME']
+DB_PASSWORD = os.environ['FCOM_DB_PASSWORD']
+DB_NAME = 'fcom'
+
+# Connection pool settings.
+# Each process (i.e. every API worker, and the bot) gets its own pool.
+DB_POOL_SIZE = int(os.environ.get('FCOM_DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('FCOM_DB_POOL_TIMEOUT', 10))
+DB_POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get('FCOM_DB_POOL_HEALTH_CHECK_INTERVAL', 30))
+
+
+def _connect():
+    # Autocommit, so that a pooled connection never carries a stale read snapshot over to its next user.
+    # Multi-statement work must be wrapped in conn.start_transaction() / conn.commit().
+    # Buffered cursors, so that a partially-read result set can't leave the connection unusable
+    # (except where a large result is streamed; see claim_messages()).
+    # FOUND_ROWS: an UPDATE's rowcount is the number of rows matched (rather than changed), so that it tells
+    # whether the row exists without a separate SELECT.
+    return mariadb.connect(host=DB_URI, user=DB_USERNAME, password=DB_PASSWORD, database=DB_NAME,
+                           autocommit=True, buffered=True, client_flags=[ClientFlag.FOUND_ROWS])
+
+
+# Statements issued by MariaDbBackend (and AsyncMariaDbBackend).
+# The hot ones are also EXPLAINed by migrations.check_query_plans(), so they're only written once here.
+
+# Registrations that are unconfirmed and older than 5 minutes, or confirmed and older than 24 hours.
+# Plain comparisons (rather than IS TRUE/FALSE), so that the (is_verified, last_updated) index is used.
+STALE_REGISTRATION = """(is_verified = 1 and last_updated < DATE_SUB(now(), interval 24 hour)) OR
+                        (is_verified = 0 and last_updated < DATE_SUB(now(), interval 5 minute))"""
+
+USER_RECORD_BY_TOKEN = """SELECT last_updated, token, discord_id, discord_name, is_verified, callsign,
+                                 dm_failures, TIMESTAMPDIFF(SECOND, NOW(), quarantined_until)
+                          FROM registration WHERE token=%s"""
+USER_RECORD_BY_DISCORD_ID = """SELECT last_updated, token, discord_id, discord_name, is_verified, callsign,
+                                      dm_failures, TIMESTAMPDIFF(SECOND, NOW(), quarantined_until)
+                               FROM registration WHERE discord_id=%s"""
+
+# IGNORE: nothing is inserted if the user is already registered (discord_id is unique)
+ADD_USER = "INSERT IGNORE INTO registration(token, discord_id, discord_name, is_verified) VALUES (%s,%s,%s,0)"
+
+CONFIRM_USER = "UPDATE registration SET callsign=%s, is_verified=1 WHERE token=%s"
+
+# Removals are followed by REMOVED_USER, which is left out when EXPLAINed since it doesn't change the plan
+REMOVE_USER_BY_TOKEN = "DELETE FROM registration WHERE token=%s"
+REMOVE_USER_BY_DISCORD_ID = "DELETE FROM registration WHERE discord_id=%s"
+REMOVE_EXPIRED_USERS = f"DELETE FROM registration WHERE token IN ({{placeholders}}) AND ({STALE_REGISTRATION})"
+REMOVED_USER = "RETURNING token, discord_id"
+
+REGISTRATION_EXPIRIES = """SELECT token,
+                                  TIMESTAMPDIFF(SECOND, NOW(),
+                                                last_updated + INTERVAL IF(is_verified = 1, 24 * 60, 5) MINUTE)
+                           FROM registration"""
+
+VERIFIED_DISCORD_IDS = "SELECT discord_id FROM registration WHERE is_verified = 1 ORDER BY last_updated DESC"
+
+# Messages already in the queue (i.e. with the same dedup_hash, the only unique key besides the auto-increment id)
+# are left as they are. Unlike IGNORE, this doesn't turn any other error (e.g. truncated data) into a warning.
+INSERT_MESSAGES = """INSERT INTO
+                         messages(token, time_received, sender, receiver, message, discord_id, dedup_hash)
+                     VALUES
+                         {values}
+                     ON DUPLICATE KEY UPDATE id=id"""
+INSERT_MESSAGES_ROW = '(%s, FROM_UNIXTIME(%s / 1000), %s, %s, %s, %s, %s)'
+
+# Rows are claimed in PK order, so this only ever reads the head of the queue
+CLAIM_MESSAGES = """UPDATE messages
+                    SET claim_id=%s, claimed_at=NOW()
+                    WHERE (claim_id IS NULL OR claimed_at < DATE_SUB(NOW(), INTERVAL %s SECOND))
+                        {partition_filter}
+                    ORDER BY id
+                    LIMIT %s"""
+CLAIM_PARTITION_FILTER = 'AND MOD(COALESCE(discord_id, 0), %s) = %s'
+
+# Covered by the (claim_id, id) index
+READ_CLAIMED_MESSAGES = """SELECT id, token, time_received, sender, receiver, message, UNIX_TIMESTAMP(insert_time)
+                           FROM messages
+                           WHERE claim_id=%s
+                           ORDER BY id"""
+
+ACK_MESSAGES = "DELETE FROM messages WHERE id IN ({placeholders})"
+
+QUEUED_MESSAGES = "SELECT COUNT(*) FROM messages WHERE token=%s"
+
+
+def placeholders(count: int) -> str:
+    """
+    :param count:   Number of parameters
+    :return:        That many comma-separated placeholders, e.g. for an IN list
+    """
+    return ', '.join(['%s'] * count)
+
+
+def user_record_query(param) -> str:
+    """
+    :param param:   Discord ID (int) or token (str)
+    :return:        Query for the registration record; takes ``param`` as its only parameter
+    """
+    return USER_RECORD_BY_DISCORD_ID if isinstance(param, int) else USER_RECORD_BY_TOKEN
+
+
+def remove_user_query(param) -> str:
+    """
+    :param param:   Discord ID (int) or token (str)
+    :return:        DELETE statement returning the removed (token, discord_id); takes ``param`` as its only parameter
+    """
+    cmd = REMOVE_USER_BY_DISCORD_ID if isinstance(param, int) else REMOVE_USER_BY_TOKEN
+    return f'{cmd} {REMOVED_USER}'
+
+
+def insert_messages_query(msgs: List[FsdMessage]) -> (str, list):
+    """
+    :param msgs:    Messages to queue
+    :return:        (multi-row INSERT statement, parameters)
+    """
+    params = []
+    for msg in msgs:
+        params.extend((msg.token, msg.timestamp, msg.sender, msg.receiver, msg.message, msg.discord_id,
+                       msg.dedup_hash))
+
+    return INSERT_MESSAGES.format(values=', '.join([INSERT_MESSAGES_ROW] * len(msgs))), params
+
+
+class MariaDbBackend(StorageBackend):
+    """MariaDB storage backend. Connections are pooled (see ``ConnectionPool``)."""
+
+    def __init__(self):
+        self.pool = ConnectionPool(_connect, max_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+                                   health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL)
+
+    def get_user_record_tuple(self, param) -> tuple:
+        with self.pool.connection() as conn:
+            db = conn.cursor()
+            db.execute(user_record_query(param), (param,))
+            return db.fetchone()
+
+    def add_user(self, token: str, discord_id: int, discord_name: str) -> bool:
+        with self.pool.connection() as conn:
+            db = conn.cursor()
+            db.execute(ADD_USER, (token, discord_id, discord_name))
+            return db.rowcount == 1
+
+    def confirm_user(self, token: str, callsign: str) -> bool:
+        with self.pool.connection() as conn:
+            db = conn.cursor()
+
+            # Matched rows (see _connect()), so 0 only if the token doesn't exist
+            db.execute(CONFIRM_USER, (callsign, token))
+            return db.rowcount == 1
+
+    def remove_user(self, param) -> tuple:
+        with self.pool.connection() as conn:
+            db = conn.cursor()
+            db.execute(remove_user_query(param), (param,))
+            return db.fetchone()
+
+    def remove_expired_users(self, tokens: List[str]) -> List[tuple]:
+        cmd = REMOVE_EXPIRED_USERS.format(placeholders=placeholders(len(tokens)))
+
+        with self.pool.connection() as conn:
+            db = conn.cursor()
+            db.execute(f'{cmd} {REMOVED_USER}', tuple(tokens))
+            return db.fetchall()
+
+    def get_registration_expiries(self, tokens: List[str] = None) -> List[tuple]:
+        with self.pool.connection() as conn:
+            db = conn.cursor()
+            if tokens is None:
+                db.execute(REGISTRATION_EXPIRIES)
+            else:
+                db.execute(f"{REGISTRATION_EXPIRIES} WHERE token IN ({placeholders(len(tokens))})", tuple(tokens))
+            return db.fetchall()
+
+    def record_dm_failure(self, token: str, quarantine_after: int, quarantine_seconds: int):
+        # Assignments are evaluated left to right (each seeing the previous ones), hence dm_failures + 1 before it's
+        # incremented. last_updated is set explicitly, since it's otherwise bumped on every update.
+        cmd = '''UPDATE registration
+                 SET quarantined_until = IF(dm_failures + 1 >= %s, NOW() + INTERVAL %s SECOND, quarantined_until),
+                     dm_failures = dm_failures + 1,
+                     last_updated = last_updated
+                 WHERE token=%s'''
+
+        with self.pool.connection() as conn:
+            db = conn.cursor()
+            db.execute(cmd, (quarantine_after, quarantine_seconds, token))
+
+    def clear_dm_failures(self, token: str):
+        cmd = '''UPDATE registration SET dm_failures = 0, quarantined_until = NULL, last_updated = last_updated
+                 WHERE token=%s'''
+
+        with self.pool.connection() as conn:
+            db = conn.cursor()
+            db.execute(cmd, (token,))
+
+    def get_verified_discord_ids(self) -> List[int]:
+        with self.pool.connection() as conn:
+            db = conn.cursor()
+            db.execute(VERIFIED_DISCORD_IDS)
+            return [row[0] for row in db.fetchall()]
+
+    def insert_messages(self, msgs: List[FsdMessage]) -> int:
+        cmd, params = insert_messages_query(msgs)
+
+        with self.pool.connection() as conn:
+            db = conn.cursor()
+            db.execute(cmd, params)
+
+            # Each skipped message counts as a matched row (see _connect()), so inserted and skipped messages can't be
+            # told apart: every message is reported as queued, and db-layer duplicates aren't counted.
+            return len(msgs)
+
+    def claim_messages(self, claim_id: int, limit: int, lease: int, partition: int = None,
+                       partition_count: int = 1) -> Iterator[tuple]:
+        if partition is None:
+            cmd = CLAIM_MESSAGES.format(partition_filter='')
+            params = (claim_id, lease, limit)
+        else:
+            cmd = CLAIM_MESSAGES.format(partition_filter=CLAIM_PARTITION_FILTER)
+            params = (claim_id, lease, partition_count, partition, limit)
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(cmd, params)
+
+            if cursor.rowcount == 0:
+                return
+
+            # Unbuffered, so that rows are read from the server CLAIM_FETCH_SIZE at a time,
+            # rather than the whole claim up front
+            cursor = conn.cursor(buffered=False)
+            try:
+                cursor.execute(READ_CLAIMED_MESSAGES, (claim_id,))
+
+                rows = cursor.fetchmany(CLAIM_FETCH_SIZE)
+                while rows:
+                    yield from rows
+                    rows = cursor.fetchmany(CLAIM_FETCH_SIZE)
+            finally:
+                # Any unread rows (e.g. if the caller stopped early) must be discarded before the connection
+                # goes back to the pool
+                if conn.unread_result:
+                    conn.consume_results()
+
+    def ack_messages(self, message_ids: List[int]):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(ACK_MESSAGES.format(placeholders=placeholders(len(message_ids))), tuple(message_ids))
+
+    def queue_depth(self) -> int:
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM messages")
+            return cursor.fetchone()[0]
+
+    def queued_messages(self, token: str) -> int:
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(QUEUED_MESSAGES, (token,))
+            return cursor.fetchone()[0]
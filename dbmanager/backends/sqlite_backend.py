@@ -0,0 +1,297 @@
+import os
+import sqlite3
+from datetime import datetime
+from typing import Iterator, List
+from dbmanager.backends.base import CLAIM_FETCH_SIZE, StorageBackend
+from dbmanager.connection_pool import ConnectionPool
+from dbmodels.fsd_message import FsdMessage
+
+# SQLite
+SQLITE_PATH = os.environ.get('FCOM_SQLITE_PATH', 'fcom.sqlite3')
+
+# Seconds to wait for another process's write lock before giving up
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('FCOM_SQLITE_BUSY_TIMEOUT', 5))
+
+# Connections are pooled, since opening one (and applying the pragmas) costs more than most queries.
+# Uses the same setting as the MariaDB backend.
+DB_POOL_SIZE = int(os.environ.get('FCOM_DB_POOL_SIZE', 8))
+
+# Applied to every connection.
+# WAL lets the bot read while an API worker writes; with WAL, synchronous=NORMAL is still crash-safe
+# (a power loss can only roll back the most recent commits, never corrupt the DB).
+PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',         # 16 MB
+    'PRAGMA mmap_size=67108864',        # 64 MB
+    'PRAGMA wal_autocheckpoint=1000',
+]
+
+# Bumped (via PRAGMA user_version) whenever SCHEMA changes.
+# New DBs are created from SCHEMA directly; existing ones are brought up to date via SCHEMA_UPGRADES.
+SCHEMA_VERSION = 4
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS messages
+      (
+         id            INTEGER PRIMARY KEY AUTOINCREMENT,
+         insert_time   TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+         token         VARCHAR(43) NOT NULL,
+         time_received TIMESTAMP NOT NULL,
+         sender        VARCHAR(20) NOT NULL,
+         receiver      VARCHAR(20) NOT NULL,
+         message       TEXT,
+         claim_id      INTEGER NULL DEFAULT NULL,
+         claimed_at    TIMESTAMP NULL DEFAULT NULL,
+         discord_id    BIGINT NULL DEFAULT NULL,
+         dedup_hash    BLOB NULL DEFAULT NULL
+      )
+    """,
+    'CREATE INDEX IF NOT EXISTS idx_messages_claim ON messages (claim_id, id)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_token ON messages (token)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_dedup ON messages (dedup_hash)',
+    """
+    CREATE TABLE IF NOT EXISTS registration
+      (
+         last_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+         token        VARCHAR(43) NOT NULL UNIQUE,
+         discord_id   BIGINT NOT NULL UNIQUE,
+         discord_name VARCHAR(32),
+         is_verified  BOOLEAN,
+         callsign     VARCHAR(20),
+         dm_failures  INTEGER NOT NULL DEFAULT 0,
+         quarantined_until TIMESTAMP NULL DEFAULT NULL,
+         PRIMARY KEY(token, discord_id)
+      )
+    """,
+    'CREATE INDEX IF NOT EXISTS idx_registration_expiry ON registration (is_verified, last_updated)',
+]
+
+# version -> statements that upgrade the previous version to it
+SCHEMA_UPGRADES = {
+    2: ['ALTER TABLE messages ADD COLUMN discord_id BIGINT NULL DEFAULT NULL'],
+    3: ['ALTER TABLE messages ADD COLUMN dedup_hash BLOB NULL DEFAULT NULL',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_dedup ON messages (dedup_hash)'],
+    4: ['ALTER TABLE registration ADD COLUMN dm_failures INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE registration ADD COLUMN quarantined_until TIMESTAMP NULL DEFAULT NULL',
+        'CREATE INDEX IF NOT EXISTS idx_messages_token ON messages (token)'],
+}
+
+# Columns of a registration record (see StorageBackend)
+USER_RECORD_COLUMNS = '''last_updated, token, discord_id, discord_name, is_verified, callsign, dm_failures,
+                         CAST(round((julianday(quarantined_until) - julianday('now')) * 86400) AS INTEGER)'''
+
+# Registrations that are unconfirmed and older than 5 minutes, or confirmed and older than 24 hours
+STALE_REGISTRATION = """(is_verified = 1 and last_updated < datetime('now', '-24 hours')) OR
+                        (is_verified = 0 and last_updated < datetime('now', '-5 minutes'))"""
+
+
+def _convert_timestamp(value: bytes) -> datetime:
+    # SQLite's CURRENT_TIMESTAMP and datetime() both produce 'YYYY-MM-DD HH:MM:SS' (UTC)
+    return datetime.fromisoformat(value.decode())
+
+
+sqlite3.register_converter('TIMESTAMP', _convert_timestamp)
+
+
+class SqliteBackend(StorageBackend):
+    """
+    Embedded SQLite storage backend, for single-host deployments, benchmarks and CI.
+    All timestamps are stored in UTC.
+    """
+
+    def __init__(self, path: str = SQLITE_PATH):
+        """
+
+        :param path:    Path to the DB file. It's created (along with the schema) if it doesn't exist.
+        """
+        self.path = path
+
+        # Local connections can't go stale, so they're never health-checked
+        self.pool = ConnectionPool(self._connect, max_size=DB_POOL_SIZE, health_check_interval=float('inf'))
+
+        with self.pool.connection() as conn:
+            # Holds the write lock throughout, since several processes (e.g. bot shards) may start at once
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version == 0:
+                    statements = SCHEMA
+                else:
+                    statements = [statement for upgrade_version in range(version + 1, SCHEMA_VERSION + 1)
+                                  for statement in SCHEMA_UPGRADES[upgrade_version]]
+
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: autocommit, with explicit BEGIN for multi-statement transactions.
+        # check_same_thread=False: pooled connections are handed to different threads (but never to two at once).
+        conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None,
+                               detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def get_user_record_tuple(self, param) -> tuple:
+        # discord_id provided
+        if isinstance(param, int):
+            cmd = f'SELECT {USER_RECORD_COLUMNS} FROM registration WHERE discord_id=?'
+
+        # token provided
+        else:
+            cmd = f'SELECT {USER_RECORD_COLUMNS} FROM registration WHERE token=?'
+
+        with self.pool.connection() as conn:
+            return conn.execute(cmd, (param,)).fetchone()
+
+    def add_user(self, token: str, discord_id: int, discord_name: str) -> bool:
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO registration(token, discord_id, discord_name, is_verified) VALUES (?,?,?,0)",
+                (token, discord_id, discord_name))
+            return cursor.rowcount == 1
+
+    def confirm_user(self, token: str, callsign: str) -> bool:
+        # Unlike MariaDB, SQLite doesn't automatically bump the timestamp on update
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "UPDATE registration SET callsign=?, is_verified=1, last_updated=CURRENT_TIMESTAMP WHERE token=?",
+                (callsign, token))
+            return cursor.rowcount == 1
+
+    def remove_user(self, param) -> tuple:
+        # Discord ID provided
+        if isinstance(param, int):
+            cmd = "DELETE FROM registration WHERE discord_id=? RETURNING token, discord_id"
+
+        # Discord code/token provided
+        else:
+            cmd = "DELETE FROM registration WHERE token=? RETURNING token, discord_id"
+
+        with self.pool.connection() as conn:
+            # Read to the end, since the statement (and its write lock) is only finished once all rows are read
+            removed = conn.execute(cmd, (param,)).fetchall()
+            return removed[0] if removed else None
+
+    def remove_expired_users(self, tokens: List[str]) -> List[tuple]:
+        placeholders = ', '.join(['?'] * len(tokens))
+
+        with self.pool.connection() as conn:
+            return conn.execute(f"""DELETE FROM registration
+                                    WHERE token IN ({placeholders}) AND ({STALE_REGISTRATION})
+                                    RETURNING token, discord_id""", tuple(tokens)).fetchall()
+
+    def get_registration_expiries(self, tokens: List[str] = None) -> List[tuple]:
+        cmd = """SELECT token,
+                        (julianday(last_updated, CASE WHEN is_verified = 1 THEN '+24 hours' ELSE '+5 minutes' END)
+                         - julianday('now')) * 86400
+                 FROM registration"""
+
+        with self.pool.connection() as conn:
+            if tokens is None:
+                return conn.execute(cmd).fetchall()
+            else:
+                placeholders = ', '.join(['?'] * len(tokens))
+                return conn.execute(f"{cmd} WHERE token IN ({placeholders})", tuple(tokens)).fetchall()
+
+    def record_dm_failure(self, token: str, quarantine_after: int, quarantine_seconds: int):
+        # Unlike MariaDB, every assignment sees the old values
+        cmd = '''UPDATE registration
+                 SET quarantined_until = CASE WHEN dm_failures + 1 >= ? THEN datetime('now', ?)
+                                              ELSE quarantined_until END,
+                     dm_failures = dm_failures + 1
+                 WHERE token=?'''
+
+        with self.pool.connection() as conn:
+            conn.execute(cmd, (quarantine_after, f'+{quarantine_seconds} seconds', token))
+
+    def clear_dm_failures(self, token: str):
+        with self.pool.connection() as conn:
+            conn.execute("UPDATE registration SET dm_failures = 0, quarantined_until = NULL WHERE token=?", (token,))
+
+    def get_verified_discord_ids(self) -> List[int]:
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT discord_id FROM registration WHERE is_verified = 1 ORDER BY last_updated DESC")
+            return [row[0] for row in rows.fetchall()]
+
+    def insert_messages(self, msgs: List[FsdMessage]) -> int:
+        with self.pool.connection() as conn:
+            # A single transaction, and therefore a single fsync.
+            # Messages already in the queue (i.e. with the same dedup_hash) are skipped, and don't count as changes.
+            # Unlike OR IGNORE, any other constraint violation still fails the batch.
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                cursor = conn.executemany("""INSERT INTO
+                                                 messages(token, time_received, sender, receiver, message, discord_id,
+                                                          dedup_hash)
+                                             VALUES
+                                                 (?, datetime(? / 1000.0, 'unixepoch'), ?, ?, ?, ?, ?)
+                                             ON CONFLICT(dedup_hash) DO NOTHING
+                                          """,
+                                          [(msg.token, msg.timestamp, msg.sender, msg.receiver, msg.message,
+                                            msg.discord_id, msg.dedup_hash) for msg in msgs])
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            return cursor.rowcount
+
+    def claim_messages(self, claim_id: int, limit: int, lease: int, partition: int = None,
+                       partition_count: int = 1) -> Iterator[tuple]:
+        if partition is None:
+            partition_filter = ''
+            params = (claim_id, f'-{lease} seconds', limit)
+        else:
+            partition_filter = 'AND COALESCE(discord_id, 0) % ? = ?'
+            params = (claim_id, f'-{lease} seconds', partition_count, partition, limit)
+
+        with self.pool.connection() as conn:
+            # Rows are claimed in PK order, so this only ever reads the head of the queue
+            cursor = conn.execute(f""" UPDATE messages
+                                       SET claim_id=?, claimed_at=CURRENT_TIMESTAMP
+                                       WHERE id IN (
+                                           SELECT id FROM messages
+                                           WHERE (claim_id IS NULL OR claimed_at < datetime('now', ?))
+                                               {partition_filter}
+                                           ORDER BY id
+                                           LIMIT ?
+                                       )
+                                  """, params)
+
+            if cursor.rowcount == 0:
+                return
+
+            # Covered by the (claim_id, id) index
+            cursor = conn.execute("""SELECT id, token, time_received, sender, receiver, message,
+                                            CAST(strftime('%s', insert_time) AS INTEGER)
+                                     FROM messages
+                                     WHERE claim_id=?
+                                     ORDER BY id
+                                  """, (claim_id,))
+
+            rows = cursor.fetchmany(CLAIM_FETCH_SIZE)
+            while rows:
+                yield from rows
+                rows = cursor.fetchmany(CLAIM_FETCH_SIZE)
+
+    def ack_messages(self, message_ids: List[int]):
+        placeholders = ', '.join(['?'] * len(message_ids))
+
+        with self.pool.connection() as conn:
+            conn.execute(f"DELETE FROM messages WHERE id IN ({placeholders})", tuple(message_ids))
+
+    def queue_depth(self) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def queued_messages(self, token: str) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM messages WHERE token=?", (token,)).fetchone()[0]
@@ -0,0 +1,169 @@
+import threading
+import time
+from contextlib import contextmanager
+from collections import deque
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes available within the configured timeout."""
+    pass
+
+
+class ConnectionPool:
+    """
+    Bounded pool of reusable DB connections.
+
+    Connections are created lazily, up to ``max_size``, and handed back to the pool once the caller is done with them.
+    Idle connections are health-checked before reuse, so that connections dropped by the server
+    (e.g. after ``wait_timeout``) are transparently replaced.
+    The same pool class is used by both the API workers and the bot.
+    """
+
+    def __init__(self, connect, max_size: int = 8, timeout: float = 10.0, health_check_interval: float = 30.0):
+        """
+
+        :param connect:                 Zero-argument callable returning a new DB connection
+        :param max_size:                Maximum number of open connections
+        :param timeout:                 Maximum number of seconds to wait for a free connection
+        :param health_check_interval:   Connections idle for longer than this (in seconds) are pinged before reuse
+        """
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        # Idle connections, as (connection, time returned to pool)
+        self._idle = deque()
+        self._num_open = 0
+        self._cond = threading.Condition()
+
+        # Pool-wait metrics
+        self.num_acquired = 0
+        self.num_waits = 0
+        self.num_timeouts = 0
+        self.num_replaced = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _acquire(self):
+        start = time.monotonic()
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+
+                if self._num_open < self.max_size:
+                    # Reserve the slot now, and connect outside of the lock
+                    self._num_open += 1
+                    conn, idle_since = None, None
+                    break
+
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self.num_timeouts += 1
+                    raise PoolTimeoutError(f'No DB connection available after {self.timeout}s '
+                                           f'(pool size: {self.max_size})')
+                waited = True
+                self._cond.wait(remaining)
+
+            wait_time = time.monotonic() - start
+            self.num_acquired += 1
+            if waited:
+                self.num_waits += 1
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif time.monotonic() - idle_since > self.health_check_interval and not self._is_healthy(conn):
+                self._close_quietly(conn)
+                self.num_replaced += 1
+                conn = self._connect()
+        except Exception:
+            self._discard()
+            raise
+
+        return conn
+
+    def _release(self, conn):
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self):
+        with self._cond:
+            self._num_open -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool for the duration of the ``with`` block.
+        If the block exits with any exception (including ``GeneratorExit`` from a generator closed early, task
+        cancellation and ``KeyboardInterrupt``), uncommitted work is rolled back and the connection is closed rather
+        than returned to the pool, since it may be left mid-statement or with unread results.
+
+        :return:    A DB connection
+        """
+        conn = self._acquire()
+        succeeded = False
+        try:
+            yield conn
+            succeeded = True
+        finally:
+            if succeeded:
+                self._release(conn)
+            else:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                self._close_quietly(conn)
+                self._discard()
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._close_quietly(conn)
+                self._num_open -= 1
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """
+        :return:    Snapshot of pool usage and pool-wait metrics
+        """
+        with self._cond:
+            return {
+                'max_size': self.max_size,
+                'open': self._num_open,
+                'idle': len(self._idle),
+                'acquired': self.num_acquired,
+                'waits': self.num_waits,
+                'timeouts': self.num_timeouts,
+                'replaced': self.num_replaced,
+                'total_wait_seconds': self.total_wait_time,
+                'max_wait_seconds': self.max_wait_time,
+            }
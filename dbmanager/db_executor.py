@@ -0,0 +1,24 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Number of DB calls that may be in flight at once.
+# Should not exceed the connection pool size, so that executor threads never queue up for a connection.
+DB_EXECUTOR_WORKERS = int(os.environ.get('FCOM_DB_EXECUTOR_WORKERS', 4))
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='fcom-db')
+
+
+async def run(func, *args, **kwargs):
+    """
+    Runs a blocking ``db_manager`` function on the dedicated DB executor, so that it doesn't block the event loop.
+
+    :param func:    The (synchronous) function to call
+    :param args:    Positional arguments for ``func``
+    :param kwargs:  Keyword arguments for ``func``
+    :return:        Whatever ``func`` returns
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
@@ -1,25 +1,111 @@
-import mysql.connector as mariadb
+import atexit
+import hashlib
+import json
 import secrets
 import os
+from dbmanager import db_executor, queue_notify
+from dbmanager.backends import load_backend
+from dbmanager.ttl_cache import TtlCache
+from dbmanager.write_buffer import WriteBuffer
 from dbmodels.user_registration import UserRegistration
 from dbmodels.fsd_message import FsdMessage
-from discord import DMChannel, Client
-from typing import List
-import discord_credentials
+from monitoring.metrics import REGISTRY
+from typing import List, TYPE_CHECKING
 
-# MariaDB
-DB_URI = 'localhost'
-DB_USERNAME = os.environ['FCOM_DB_USERNAME']
-DB_PASSWORD = os.environ['FCOM_DB_PASSWORD']
-DB_NAME = 'fcom'
+# Only needed for type hints, so that the API (and the round trip test) doesn't need discord.py installed
+if TYPE_CHECKING:
+    from discord import DMChannel, Client
 
+# Storage backend: 'mariadb' (default) or 'sqlite'.
+# See dbmanager/backends/ for backend-specific settings.
+DB_BACKEND = os.environ.get('FCOM_DB_BACKEND', 'mariadb')
 
-# Local cache for DMChannel objects.
-# This avoids the need to reach the Discord API every time a DM needs to be sent.
-pm_channels = {}
+backend = load_backend(DB_BACKEND)
+
+
+# Local cache for registration lookups by token (see get_user_registration()).
+# Tokens that don't exist are cached too, but for a shorter time, so that clients using an expired token
+# don't cause a DB lookup on every request.
+# Entries are invalidated whenever this process confirms or removes a registration;
+# changes made by other processes (e.g. the bot) become visible once the TTL expires.
+REGISTRATION_CACHE_SIZE = int(os.environ.get('FCOM_REGISTRATION_CACHE_SIZE', 10000))
+REGISTRATION_CACHE_TTL = float(os.environ.get('FCOM_REGISTRATION_CACHE_TTL', 60))
+REGISTRATION_CACHE_NEGATIVE_TTL = float(os.environ.get('FCOM_REGISTRATION_CACHE_NEGATIVE_TTL', 10))
+
+registration_cache = TtlCache(max_size=REGISTRATION_CACHE_SIZE, ttl=REGISTRATION_CACHE_TTL)
+
+# Message queue settings (see claim_messages())
+QUEUE_CLAIM_BATCH_SIZE = int(os.environ.get('FCOM_QUEUE_CLAIM_BATCH_SIZE', 500))
+QUEUE_CLAIM_LEASE = int(os.environ.get('FCOM_QUEUE_CLAIM_LEASE', 60))
+
+# Number of bot processes. The queue is partitioned between them by recipient (see queue_partition()),
+# so the API and every bot process must agree on this.
+QUEUE_PARTITION_COUNT = int(os.environ.get('FCOM_BOT_PROCESS_COUNT', 1))
+
+# Clients resend a batch if they time out waiting for the response, even though it may have been queued.
+# Messages are therefore identified by a hash of their contents (see message_hash()), and resubmissions are dropped:
+#   - within this process, if seen in the last FCOM_DEDUP_WINDOW seconds (bounded to FCOM_DEDUP_CACHE_SIZE hashes);
+#   - otherwise by the DB, for as long as the original is still queued (i.e. not yet delivered).
+DEDUP_WINDOW = float(os.environ.get('FCOM_DEDUP_WINDOW', 600))
+DEDUP_CACHE_SIZE = int(os.environ.get('FCOM_DEDUP_CACHE_SIZE', 100000))
+
+dedup_cache = TtlCache(max_size=DEDUP_CACHE_SIZE, ttl=DEDUP_WINDOW)
 
+# Group commit for message inserts (see write_buffer.py): messages queued by concurrent requests are inserted
+# together, in batches of up to FCOM_WRITE_BUFFER_MAX_ROWS. A message waits at most FCOM_WRITE_BUFFER_DELAY seconds
+# for others to join its batch (and while a batch is being written, the next one collects regardless).
+WRITE_BUFFER_DELAY = float(os.environ.get('FCOM_WRITE_BUFFER_DELAY', 0.002))
+WRITE_BUFFER_MAX_ROWS = int(os.environ.get('FCOM_WRITE_BUFFER_MAX_ROWS', 500))
 
-def add_discord_user(discord_id: int, discord_name: str, channel_object: DMChannel) -> str:
+# Per-token admission control (see api/admission.py).
+# The number of messages queued for a token is cached for FCOM_QUEUE_DEPTH_CACHE_TTL seconds (see queued_messages()).
+# A registration is quarantined for FCOM_DM_QUARANTINE_PERIOD seconds once FCOM_DM_QUARANTINE_AFTER consecutive DMs
+# to it are rejected by Discord (e.g. because the user doesn't accept DMs from the bot). The API refuses messages for
+# quarantined registrations, although a registration it has cached is only refreshed once its cache entry expires.
+QUEUE_DEPTH_CACHE_TTL = float(os.environ.get('FCOM_QUEUE_DEPTH_CACHE_TTL', 1))
+DM_QUARANTINE_AFTER = int(os.environ.get('FCOM_DM_QUARANTINE_AFTER', 3))
+DM_QUARANTINE_PERIOD = int(os.environ.get('FCOM_DM_QUARANTINE_PERIOD', 60 * 60))
+
+queue_depths = TtlCache(max_size=REGISTRATION_CACHE_SIZE, ttl=QUEUE_DEPTH_CACHE_TTL)
+
+# In-process message queue (see memory_queue.py), used in place of the DB's messages table
+# when the API and the bot run in the same process (see main_combined.py). None otherwise.
+message_queue = None
+
+# Sentinel for distinguishing "not cached" from a cached miss (None)
+_NOT_CACHED = object()
+
+# Local cache for DMChannel objects, by Discord ID.
+# This avoids the need to reach the Discord API every time a DM needs to be sent.
+# Entries are evicted when the registration is removed (or pruned by this process), and otherwise expire
+# after the lifetime of a verified registration.
+PM_CHANNEL_CACHE_SIZE = int(os.environ.get('FCOM_PM_CHANNEL_CACHE_SIZE', 10000))
+PM_CHANNEL_CACHE_TTL = float(os.environ.get('FCOM_PM_CHANNEL_CACHE_TTL', 24 * 60 * 60))
+
+pm_channels = TtlCache(max_size=PM_CHANNEL_CACHE_SIZE, ttl=PM_CHANNEL_CACHE_TTL)
+
+# Metrics (see monitoring/metrics.py)
+DB_CALL_DURATION = REGISTRY.histogram('fcom_db_call_duration_seconds',
+                                      'Time spent in db_manager calls (including waiting for a pooled connection)',
+                                      ('function',))
+REGISTRY.gauge('fcom_queue_depth', 'Number of queued messages').set_function(lambda: queue_backend().queue_depth())
+REGISTRY.gauge('fcom_db_pool', 'DB connection pool statistics', ('stat',)).set_function(
+    lambda: {(stat,): value for stat, value in backend.pool.stats().items()})
+REGISTRY.gauge('fcom_registration_cache', 'Registration cache statistics', ('stat',)).set_function(
+    lambda: {(stat,): value for stat, value in registration_cache.stats().items()})
+REGISTRY.gauge('fcom_dedup_cache', 'Message dedup cache statistics', ('stat',)).set_function(
+    lambda: {(stat,): value for stat, value in dedup_cache.stats().items()})
+DUPLICATE_MESSAGES = REGISTRY.counter('fcom_duplicate_messages_total', 'Number of resubmitted messages dropped',
+                                      ('layer',))
+REGISTRATIONS_EXPIRED = REGISTRY.counter('fcom_registrations_expired_total', 'Number of stale registrations removed')
+REGISTRY.gauge('fcom_queue_depth_cache', 'Per-token queue depth cache statistics', ('stat',)).set_function(
+    lambda: {(stat,): value for stat, value in queue_depths.stats().items()})
+REGISTRY.gauge('fcom_pm_channels_cache', 'DM channel cache statistics', ('stat',)).set_function(
+    lambda: {(stat,): value for stat, value in pm_channels.stats().items()})
+
+
+@DB_CALL_DURATION.time(function='add_discord_user')
+def add_discord_user(discord_id: int, discord_name: str, channel_object: 'DMChannel') -> str:
     """
     Adds the specified Discord user to the DB, and generates a token for it.
 
@@ -28,53 +114,39 @@ def add_discord_user(discord_id: int, discord_name: str, channel_object: DMChann
     :param channel_object:  DMChannel object for the specified Discord user
     :return:                Token, if the user isn't already in the DB
     """
-    conn = mariadb.connect(host=DB_URI, user=DB_USERNAME, password=DB_PASSWORD, database=DB_NAME)
+    token = secrets.token_urlsafe(32)
 
-    db = conn.cursor()
+    # NOTE: 32 bytes = 43 characters
+    token_length = 43
 
-    # First, check if the user is already registered
-    # TODO: replace this query with a SELECT COUNT(*) for optimization
-    cmd = "SELECT token FROM registration where discord_id=%s"
-    db.execute(cmd, (discord_id,))
-    user = db.fetchone()
+    # Replace all instances of the following with alphanumerics: _ - ~
+    token = token.replace('_','')
+    token = token.replace('-', '')
 
-    if user is not None:
-        conn.close()
-        return None
-    else:
-        token = secrets.token_urlsafe(32)
+    # How many characters to regenerate?
+    num_replacements = token_length - len(token)
 
-        # NOTE: 32 bytes = 43 characters
-        token_length = 43
+    # Having these characters in here ensures that the subsequent loop runs at least once
+    replacements = '_-'
 
-        # Replace all instances of the following with alphanumerics: _ - ~
-        token = token.replace('_','')
-        token = token.replace('-', '')
+    # Keep re-generating until there aren't any "_" or "-" 's
+    while '_' in replacements or '-' in replacements:
+        replacements = secrets.token_urlsafe(num_replacements)
 
-        # How many characters to regenerate?
-        num_replacements = token_length - len(token)
+    # token_urlsafe(n) produces a string of length n or higher (because n is in bytes),
+    # so lop off any extra characters as necessary
+    token = (token + replacements)[0:token_length]
 
-        # Having these characters in here ensures that the subsequent loop runs at least once
-        replacements = '_-'
-
-        # Keep re-generating until there aren't any "_" or "-" 's
-        while '_' in replacements or '-' in replacements:
-            replacements = secrets.token_urlsafe(num_replacements)
-
-        # token_urlsafe(n) produces a string of length n or higher (because n is in bytes),
-        # so lop off any extra characters as necessary
-        token = (token + replacements)[0:token_length]
-
-        cmd = "INSERT INTO registration(token, discord_id, discord_name, is_verified) VALUES (%s,%s,%s,0)"
-        db.execute(cmd, (token, discord_id, discord_name))
-        conn.commit()
-        conn.close()
+    # The backend refuses if the user is already registered
+    if not backend.add_user(token, discord_id, discord_name):
+        return None
 
-        # Save the channel object to the internal cache
-        pm_channels[discord_id] = channel_object
-        return token
+    # Save the channel object to the internal cache
+    pm_channels.set(discord_id, channel_object)
+    return token
 
 
+@DB_CALL_DURATION.time(function='confirm_discord_user')
 def confirm_discord_user(token: str, callsign: str) -> bool:
     """
     Marks the specified token as confirmed, and saves the callsign to the Discord user.
@@ -83,28 +155,14 @@ def confirm_discord_user(token: str, callsign: str) -> bool:
     :param callsign: the callsign that the Discord user wants to register
     :return:         True if success, False otherwise
     """
-    conn = mariadb.connect(host=DB_URI, user=DB_USERNAME, password=DB_PASSWORD, database=DB_NAME)
-
-    db = conn.cursor()
-
-    # First, check if the token exists
-    # TODO: replace this query with a SELECT COUNT(*) for optimization
-    cmd = "SELECT discord_id FROM registration WHERE token=%s"
-    db.execute(cmd, (token,))
-    user = db.fetchone()
-
-    if user is None:
-        conn.close()
-        return False
-    else:
-        cmd = "UPDATE registration SET callsign=%s, is_verified=1 WHERE token=%s"
-        db.execute(cmd, (callsign, token))
-        conn.commit()
-        conn.close()
+    if backend.confirm_user(token, callsign):
+        registration_cache.pop(token)
         return True
+    else:
+        return False
 
 
-async def get_user_record(param, client: Client = None) -> UserRegistration:
+async def get_user_record(param, client: 'Client' = None) -> UserRegistration:
     """
     Retrieves the specified user from the registration DB.
 
@@ -115,7 +173,7 @@ async def get_user_record(param, client: Client = None) -> UserRegistration:
     if not (isinstance(param, int) or isinstance(param, str)):
         return None
     else:
-        result = get_user_record_tuple(param)
+        result = await db_executor.run(get_user_record_tuple, param)
 
         if result is None:
             return None
@@ -126,6 +184,8 @@ async def get_user_record(param, client: Client = None) -> UserRegistration:
             discord_name = result[3]
             is_verified = result[4]
             callsign = result[5]
+            dm_failures = result[6]
+            quarantine_seconds = result[7]
 
             # If a client isn't provided, assume that this function is being called by the API,
             # and therefore doesn't required Discord-related features
@@ -134,21 +194,28 @@ async def get_user_record(param, client: Client = None) -> UserRegistration:
             else:
                 channel_object = None
 
-            return UserRegistration(last_updated, token, discord_id, discord_name, is_verified, callsign, channel_object)
+            return UserRegistration(last_updated, token, discord_id, discord_name, is_verified, callsign, channel_object,
+                                    dm_failures, quarantine_seconds)
 
 
 def get_user_registration(req_token: str) -> UserRegistration:
     """
     Retrieves the specified user from the registration DB.
     This function does not use ``asyncio``, and the corresponding ``DMChannel`` is not provided.
+    Results (including misses) are served from ``registration_cache`` where possible.
 
     :param req_token:   The token associated with the registered Discord user.
         :return:        User registration entry in the DB. Returns ``None`` if specified token doesn't exist.
                         ``UserRegistration.channel_object`` will be ``None``!
     """
+    cached = registration_cache.get(req_token, _NOT_CACHED)
+    if cached is not _NOT_CACHED:
+        return cached
+
     result = get_user_record_tuple(req_token)
 
     if result is None:
+        registration_cache.set(req_token, None, ttl=REGISTRATION_CACHE_NEGATIVE_TTL)
         return None
     else:
         # user = UserRegistration()
@@ -158,29 +225,61 @@ def get_user_registration(req_token: str) -> UserRegistration:
         discord_name = result[3]
         is_verified = result[4]
         callsign = result[5]
+        dm_failures = result[6]
+        quarantine_seconds = result[7]
+
+    user = UserRegistration(last_updated, token, discord_id, discord_name, is_verified, callsign, None,
+                            dm_failures, quarantine_seconds)
+    registration_cache.set(req_token, user)
+    return user
+
 
-    return UserRegistration(last_updated, token, discord_id, discord_name, is_verified, callsign, None)
+@DB_CALL_DURATION.time(function='expire_registrations')
+def expire_registrations(tokens: List[str]) -> List[tuple]:
+    """
+    Removes those of the given registrations that have expired (i.e. unconfirmed ones older than 5 minutes, and
+    confirmed ones older than 24 hours), along with their cache entries.
+
+    :param tokens:  Tokens of registrations that are due to expire
+    :return:        (token, seconds until expiry) of each registration that hasn't expired yet
+                    (e.g. because it's since been confirmed). Tokens no longer registered are omitted.
+    """
+    if len(tokens) == 0:
+        return []
+
+    removed = backend.remove_expired_users(tokens)
+    REGISTRATIONS_EXPIRED.inc(len(removed))
+
+    for token, discord_id in removed:
+        pm_channels.pop(discord_id)
+        registration_cache.pop(token)
+
+    removed_tokens = {token for token, discord_id in removed}
+    remaining = [token for token in tokens if token not in removed_tokens]
+
+    if len(remaining) == 0:
+        return []
+    else:
+        return backend.get_registration_expiries(remaining)
 
 
-def remove_stale_users():
+@DB_CALL_DURATION.time(function='get_registration_expiries')
+def get_registration_expiries() -> List[tuple]:
     """
-    Remove unconfirmed users older than 5 minutes, and confirmed users registered for over 24 hours
+    :return:    (token, seconds until expiry) of every registration
     """
-    conn = mariadb.connect(host=DB_URI, user=DB_USERNAME, password=DB_PASSWORD, database=DB_NAME)
-    db = conn.cursor()
+    return backend.get_registration_expiries()
 
-    db.execute("""
-        DELETE FROM 
-            registration
-        WHERE 
-            (is_verified is TRUE and last_updated < DATE_SUB(now(), interval 24 hour)) OR
-            (is_verified is false and last_updated < DATE_SUB(now(), interval 5 minute))
-        ;
-    """)
-    conn.commit()
-    conn.close()
 
+@DB_CALL_DURATION.time(function='get_verified_discord_ids')
+def get_verified_discord_ids() -> List[int]:
+    """
+    :return:    Discord IDs of all verified registrations, most recently updated first
+    """
+    return backend.get_verified_discord_ids()
 
+
+@DB_CALL_DURATION.time(function='remove_discord_user')
 def remove_discord_user(search_param: int) -> bool:
     """
     Removes the specified user from the DB.
@@ -188,213 +287,274 @@ def remove_discord_user(search_param: int) -> bool:
     :param search_param:    ID of the Discord user to de-register
     :return:                True on success, False otherwise
     """
-    if not user_exists(search_param):
+    # Both the token and Discord ID are returned, so that we can delete their cache entries
+    removed = backend.remove_user(search_param)
+
+    if removed is None:
         return False
     else:
-        # Discord ID provided
-        if isinstance(search_param, int):
-            cmd = "DELETE FROM registration WHERE discord_id=%s"
-            discord_id = search_param
+        token, discord_id = removed
 
-        # Discord code/token provided
-        elif isinstance(search_param, str):
-            cmd = "DELETE FROM registration WHERE token=%s"
+        # Delete from cache, if present
+        pm_channels.pop(discord_id)
+        registration_cache.pop(token)
+
+        return True
 
-            # If given token, retrieve Discord ID so we can delete cache entry
-            discord_id = get_user_registration(search_param).discord_id
 
-        # Neither provided
+def message_hash(msg: FsdMessage) -> bytes:
+    """
+    :param msg: Message being queued
+    :return:    SHA-256 of the message's token, timestamp, sender, receiver and contents
+    """
+    # JSON, so that field boundaries are unambiguous
+    key = json.dumps([msg.token, msg.timestamp, msg.sender, msg.receiver, msg.message])
+    return hashlib.sha256(key.encode()).digest()
+
+
+def filter_duplicates(msgs: List[FsdMessage]) -> List[FsdMessage]:
+    """
+    Sets ``FsdMessage.dedup_hash`` on the given messages, and drops those that this process has recently queued
+    (including repeats within ``msgs`` itself).
+
+    :param msgs:    Messages to queue, in arrival order
+    :return:        Messages not seen within the last ``DEDUP_WINDOW`` seconds, in arrival order
+    """
+    fresh = []
+    batch_hashes = set()
+
+    for msg in msgs:
+        msg.dedup_hash = message_hash(msg)
+
+        if msg.dedup_hash in batch_hashes or dedup_cache.get(msg.dedup_hash, False):
+            DUPLICATE_MESSAGES.inc(layer='memory')
         else:
-            return False
+            batch_hashes.add(msg.dedup_hash)
+            fresh.append(msg)
 
-        # Delete from cache, if present
-        try:
-            del pm_channels[discord_id]
-        except KeyError:
-            pass
+    return fresh
 
-        conn = mariadb.connect(host=DB_URI, user=DB_USERNAME, password=DB_PASSWORD, database=DB_NAME)
-        db = conn.cursor()
-        db.execute(cmd, (search_param,))
 
-        conn.commit()
-        conn.close()
+def remember_messages(msgs: List[FsdMessage], inserted: int):
+    """
+    Records the given messages as queued, so that resubmissions are dropped by ``filter_duplicates()``.
+    Only called once the messages have been committed.
 
-        return True
+    :param msgs:        Messages passed to the backend
+    :param inserted:    Number of them that the backend actually queued (the rest were already queued)
+    """
+    if inserted < len(msgs):
+        DUPLICATE_MESSAGES.inc(len(msgs) - inserted, layer='db')
+
+    for msg in msgs:
+        dedup_cache.set(msg.dedup_hash, True)
+
+
+def write_batch(msgs: List[FsdMessage]):
+    """
+    Inserts a batch of messages collected by ``write_buffer``, using a single multi-row INSERT
+    (and therefore a single commit). The bot is notified once the messages have been committed.
+
+    :param msgs:    Messages to queue, in arrival order
+    """
+    inserted = backend.insert_messages(msgs)
+    remember_messages(msgs, inserted)
+
+    if inserted > 0:
+        for partition in {queue_partition(msg.discord_id) for msg in msgs}:
+            queue_notify.notify(partition)
+
+
+write_buffer = WriteBuffer(write_batch, max_delay=WRITE_BUFFER_DELAY, max_rows=WRITE_BUFFER_MAX_ROWS)
+
+# Requests still waiting on a batch get their response, rather than an error
+atexit.register(write_buffer.close)
+
+REGISTRY.gauge('fcom_write_buffer', 'Message insert batching statistics', ('stat',)).set_function(
+    lambda: {(stat,): value for stat, value in write_buffer.stats().items()})
 
 
 def insert_message(msg: FsdMessage):
-    conn = mariadb.connect(host=DB_URI, user=DB_USERNAME, password=DB_PASSWORD, database=DB_NAME)
+    insert_messages([msg])
 
-    db = conn.cursor()
-    cmd = """   INSERT INTO 
-                    messages(token, time_received, sender, receiver, message) 
-                VALUES 
-                    (%s, FROM_UNIXTIME(%s / 1000), %s, %s, %s)
-            """
-    db.execute(cmd, (msg.token, msg.timestamp, msg.sender, msg.receiver, msg.message))
-    conn.commit()
-    conn.close()
 
+@DB_CALL_DURATION.time(function='insert_messages')
+def insert_messages(msgs: List[FsdMessage]):
+    """
+    Queues the given messages, returning once they've been committed.
+    They're inserted along with those of concurrent callers (see ``write_buffer``).
+    Resubmitted messages are silently dropped (see ``DEDUP_WINDOW``).
 
-def get_messages() -> List[FsdMessage]:
+    :param msgs:    Messages to queue, in arrival order
     """
-    Retrieve and dequeue messages from the DB queue.
-    Messages are aggregated if they share the same token and sender.
-    Individual message contents are separated by a newline ('\n');
-    e.g. 'contents of earlier message\ncontents of later message'
+    msgs = filter_duplicates(msgs)
+    if len(msgs) == 0:
+        return
 
-    :return:    Messages in DB queue, aggregated by token/sender,
-                and sorted by registration token, then by arrival order
-                (both in ascending order).
-    """
-
-    conn = mariadb.connect(host=DB_URI, user=DB_USERNAME, password=DB_PASSWORD, database=DB_NAME)
-    cursor = conn.cursor()
-
-    # TODO: implement a discord_id field in FsdMessage so that we don't need to make a separate query
-    # cursor.execute("""SELECT
-    #                         MAX(id),
-    #                         discord_id,
-    #                         messages.token,
-    #                         time_received,
-    #                         sender,
-    #                         receiver,
-    #                         GROUP_CONCAT(message ORDER BY id SEPARATOR ' / ') as message_contents
-    #                     FROM messages
-    #                     LEFT JOIN
-    #                         registration on messages.token = registration.token
-    #                     GROUP BY
-    #                         token, sender
-    #                     ORDER BY insert_time asc;
-    #                 """)
-
-    # NOTE: until we've implemented discord_id in FsdMessage, use NULL as a placeholder,
-    #       so that the tuple indexes remain constant.
-    cursor.execute("""SELECT 
-                                MAX(id),
-                                NULL,
-                                messages.token, 
-                                time_received, 
-                                sender, 
-                                receiver, 
-                                GROUP_CONCAT(message ORDER BY id SEPARATOR '\n') as message_contents
-                            FROM messages
-                            -- LEFT JOIN 
-                                -- registration on messages.token = registration.token
-                            GROUP BY 
-                                token, sender
-                            ORDER BY insert_time asc;
-                        """)
-
-    messages = cursor.fetchall()
-
-    # Default case: no messages retrieved
-    if len(messages) == 0:
-        most_recent_id = 0
+    # The in-process queue doesn't need batching, and wakes up the bot itself
+    if message_queue is not None:
+        remember_messages(msgs, message_queue.insert_messages(msgs))
     else:
-        most_recent_id = messages[-1][0]
+        write_buffer.submit(msgs).result()
 
-    cmd = "DELETE FROM messages WHERE id <= %s;"
-    cursor.execute(cmd, (most_recent_id,))
 
-    conn.commit()
-    conn.close()
+def queue_backend():
+    """
+    :return:    Where messages are queued: ``message_queue`` if set, otherwise the storage backend
+    """
+    if message_queue is not None:
+        return message_queue
+    else:
+        return backend
 
-    # This is the list that gets returned
-    message_list = []
 
-    # Parse returned results into FsdMessage objects
-    # MariaDB results schema:
-    #   (MAX(id), discord_id, messages.token, time_received, sender, receiver, message)
-    # FsdMessage:
-    #   (token, timestamp, sender, receiver, message)
-    for msg in messages:
+def queued_messages(token: str) -> int:
+    """
+    Number of messages queued (and not yet delivered) for the given token, for admission control.
+    Served from ``queue_depths`` where possible, so it may lag behind by up to ``QUEUE_DEPTH_CACHE_TTL`` seconds.
 
-        token = msg[2]
-        timestamp = msg[3]
-        sender = msg[4]
-        receiver = msg[5]
-        combined_contents = msg[6]
+    :param token:   Registration token
+    :return:        Number of queued messages
+    """
+    # Counted in memory, so always exact
+    if message_queue is not None:
+        return message_queue.queued_messages(token)
+
+    depth = queue_depths.get(token)
+    if depth is None:
+        depth = backend.queued_messages(token)
+        queue_depths.set(token, depth)
 
-        message_list.append(FsdMessage(token, timestamp, sender, receiver, combined_contents))
+    return depth
 
-    return message_list
 
+@DB_CALL_DURATION.time(function='record_dm_failure')
+def record_dm_failure(token: str):
+    """
+    Counts a DM rejected by Discord against the registration, quarantining it after ``DM_QUARANTINE_AFTER``
+    consecutive ones.
 
-def user_exists(search_param: int) -> bool:
+    :param token:   Registration token of the recipient
     """
-    Internal helper function for determining if a particular Discord ID is in the DB.
+    backend.record_dm_failure(token, DM_QUARANTINE_AFTER, DM_QUARANTINE_PERIOD)
+    registration_cache.pop(token)
 
-    :param search_param:  Discord ID or registration token
-    :return:            True if it exists, False otherwise
+
+@DB_CALL_DURATION.time(function='clear_dm_failures')
+def clear_dm_failures(token: str):
     """
-    conn = mariadb.connect(host=DB_URI, user=DB_USERNAME, password=DB_PASSWORD, database=DB_NAME)
-    cursor = conn.cursor()
-    # TODO: replace this query with a SELECT COUNT(*) for optimization
+    Resets the registration's rejected DM count (and lifts its quarantine), once a DM to it has gone through.
 
-    # Discord ID provided
-    if isinstance(search_param, int):
-        cmd = "SELECT token FROM registration WHERE discord_id=%s;"
+    :param token:   Registration token of the recipient
+    """
+    backend.clear_dm_failures(token)
+    registration_cache.pop(token)
 
-    # Discord code/token provided
-    elif isinstance(search_param, str):
-        cmd = "SELECT token FROM registration WHERE token=%s;"
 
-    # Neither provided
+def queue_partition(discord_id: int) -> int:
+    """
+    :param discord_id:  Discord ID of a message's recipient, or None if unknown
+    :return:            The queue partition (i.e. bot process) that messages for this recipient are delivered by
+    """
+    if discord_id is None:
+        return 0
     else:
-        return False
+        return discord_id % QUEUE_PARTITION_COUNT
 
-    cursor.execute(cmd, (search_param,))
-    user = cursor.fetchone()
 
-    conn.close()
+@DB_CALL_DURATION.time(function='claim_messages')
+def claim_messages(limit: int = None, partition: int = None) -> List[FsdMessage]:
+    """
+    Claims a batch of messages from the DB queue.
 
-    if user is None:
-        return False
-    else:
-        return True
+    Claimed messages are leased to the caller: they aren't handed out again unless they're still in the queue
+    ``QUEUE_CLAIM_LEASE`` seconds later (i.e. the caller crashed, or couldn't deliver them).
+    Once a message has been delivered (or can never be delivered), it must be removed via ``ack_messages()``.
+    This makes it safe for multiple consumers to drain the queue concurrently.
 
+    Messages are aggregated if they share the same token and sender.
+    Individual message contents are separated by a newline ('\n');
+    e.g. 'contents of earlier message\ncontents of later message'
 
-def get_user_record_tuple(param) -> ():
+    :param limit:       Maximum number of queued messages (before aggregation) to claim.
+                        Defaults to ``QUEUE_CLAIM_BATCH_SIZE``.
+    :param partition:   Only claim messages in this queue partition (see ``queue_partition()``).
+                        Defaults to all messages.
+    :return:            Claimed messages, aggregated by token/sender, and sorted by arrival order.
+                        ``FsdMessage.message_ids`` contains the IDs to pass to ``ack_messages()``.
     """
-    Internal method for retrieving the user registration record from the DB.
-    :return:
+    if limit is None:
+        limit = QUEUE_CLAIM_BATCH_SIZE
+
+    # Not partitioned, so skip the filter
+    if QUEUE_PARTITION_COUNT == 1:
+        partition = None
+
+    claim_id = secrets.randbits(63)
+
+    # Streamed from the DB, and aggregated as they arrive, so the raw rows are never all in memory at once
+    rows = queue_backend().claim_messages(claim_id, limit, QUEUE_CLAIM_LEASE, partition, QUEUE_PARTITION_COUNT)
+
+    # Aggregate by (token, sender), in order of each group's first message
+    # Backend results schema:
+    #   (id, token, time_received, sender, receiver, message, insert_time)
+    # FsdMessage:
+    #   (token, timestamp, sender, receiver, message, message_ids, insert_time)
+    aggregated = {}
+    for row in rows:
+        message_id = row[0]
+        token = row[1]
+        sender = row[3]
+
+        msg = aggregated.get((token, sender))
+        if msg is None:
+            aggregated[(token, sender)] = FsdMessage(token, row[2], sender, row[4], row[5], [message_id], row[6])
+        else:
+            msg.message = f'{msg.message}\n{row[5]}'
+            msg.message_ids.append(message_id)
+
+    return list(aggregated.values())
+
+
+@DB_CALL_DURATION.time(function='ack_messages')
+def ack_messages(message_ids: List[int]):
     """
-    conn = mariadb.connect(host=DB_URI, user=DB_USERNAME, password=DB_PASSWORD, database=DB_NAME)
+    Removes the specified messages from the DB queue. Used once claimed messages have been handled.
 
-    db = conn.cursor()
+    :param message_ids: IDs of the messages to remove (see ``FsdMessage.message_ids``)
+    """
+    if len(message_ids) == 0:
+        return
 
-    # discord_id provided
-    if isinstance(param, int):
-        cmd = '''SELECT last_updated, token, discord_id, discord_name, is_verified, callsign 
-                 FROM registration WHERE discord_id=%s'''
+    queue_backend().ack_messages(message_ids)
 
-    # token provided
-    # else:
-    elif isinstance(param, str):
-        cmd = '''SELECT last_updated, token, discord_id, discord_name, is_verified, callsign 
-                 FROM registration WHERE token=%s'''
-    else:
-        return None
 
-    db.execute(cmd, (param,))
-    result = db.fetchone()
+@DB_CALL_DURATION.time(function='get_user_record_tuple')
+def get_user_record_tuple(param) -> ():
+    """
+    Internal method for retrieving the user registration record from the DB.
 
-    return result
+    :param param:   Discord ID (int) or token (str)
+    :return:        (last_updated, token, discord_id, discord_name, is_verified, callsign, dm_failures,
+                    quarantine_seconds), or None if not in the DB
+    """
+    if isinstance(param, int) or isinstance(param, str):
+        return backend.get_user_record_tuple(param)
+    else:
+        return None
 
 
-async def get_channel(client: Client, discord_id: int) -> DMChannel:
+async def get_channel(client: 'Client', discord_id: int) -> 'DMChannel':
     """
     Internal method for retrieving the DMChannel for a particular user.
 
-    :param client:      The bot object
+    :param client:      The bot object (a ``BotClient``, whose send scheduler paces any API calls)
     :param discord_id:  Discord snowflake ID of the user
     :return:            DMChannel for the specified Discord user
     """
-    try:
-        channel = pm_channels[discord_id]
-    except KeyError:
+    channel = pm_channels.get(discord_id)
+
+    if channel is None:
         # (0.10.1 and earlier) Old implementation:
         #   This makes an API call.
         #   get_user_info() would fail silently, returning None instead of an exception.
@@ -406,15 +566,28 @@ async def get_channel(client: Client, discord_id: int) -> DMChannel:
         # ch = user.dm_channel
 
         # (0.11.0+) New implementation: this is a cache lookup
+        # Imported here, so that the API (which never calls this) doesn't need the bot's credentials
+        import discord_credentials
         fcom_discord_server = client.get_guild(discord_credentials.FCOM_DISCORD_SERVER_ID)
-        user = fcom_discord_server.get_member(discord_id)
+        user = fcom_discord_server.get_member(discord_id) if fcom_discord_server is not None else None
+
+        # When sharded, the FCOM server is only available to the process running its shard,
+        # so every other process has to look the user up via the API instead
+        # API calls are paced by the bot's send scheduler, since they count towards the same global rate limit as DMs
+        if user is None:
+            user = client.get_user(discord_id)
+            if user is None:
+                await client.send_scheduler.acquire_global()
+                user = await client.fetch_user(discord_id)
+
         ch = user.dm_channel
 
         if ch is None:
+            await client.send_scheduler.acquire_global()
             ch = await user.create_dm()
 
-        # Save to internal dictionary
-        pm_channels[discord_id] = ch
+        # Save to internal cache
+        pm_channels.set(discord_id, ch)
         channel = ch
 
     return channel
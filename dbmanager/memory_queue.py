@@ -0,0 +1,250 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Iterator, List
+from dbmodels.fsd_message import FsdMessage
+
+# Maximum number of queued (undelivered) messages. Further messages are rejected until the bot catches up.
+MEMORY_QUEUE_SIZE = int(os.environ.get('FCOM_MEMORY_QUEUE_SIZE', 100000))
+
+# Optional write-ahead journal, so that queued messages survive a crash or restart. Disabled if unset.
+MEMORY_QUEUE_JOURNAL = os.environ.get('FCOM_MEMORY_QUEUE_JOURNAL')
+
+# The journal is rewritten (without delivered messages) once it holds at least this many of them,
+# and more of them than undelivered ones
+JOURNAL_COMPACT_THRESHOLD = 10000
+
+
+class QueueFullError(Exception):
+    """Raised when messages can't be queued because the queue is full."""
+    pass
+
+
+class _Entry:
+    __slots__ = ('token', 'timestamp', 'time_received', 'sender', 'receiver', 'message', 'discord_id', 'dedup_hash',
+                 'insert_time', 'claim_id', 'claimed_at')
+
+    def __init__(self, token: str, timestamp: int, sender: str, receiver: str, message: str,
+                 discord_id: int, dedup_hash: bytes, insert_time: float):
+        self.token = token
+        self.timestamp = timestamp
+
+        # Converted once, up front, so that a bad timestamp is rejected when queued rather than failing every claim.
+        # Raises ValueError or OverflowError if out of range.
+        self.time_received = datetime.utcfromtimestamp(timestamp / 1000)
+
+        self.sender = sender
+        self.receiver = receiver
+        self.message = message
+        self.discord_id = discord_id
+        self.dedup_hash = dedup_hash
+        self.insert_time = insert_time
+        self.claim_id = None
+        self.claimed_at = None
+
+
+class MemoryQueue:
+    """
+    In-process message queue, for when the API and the bot run in the same process (see main_combined.py).
+    Implements the queue half of ``StorageBackend`` (with the same claim/lease/ack semantics), so that ``db_manager``
+    can use it in place of the DB.
+
+    Thread-safe, since the bot claims messages from the DB executor.
+    """
+
+    def __init__(self, max_size: int = MEMORY_QUEUE_SIZE, journal_path: str = MEMORY_QUEUE_JOURNAL,
+                 on_insert=None):
+        """
+
+        :param max_size:        Maximum number of queued messages
+        :param journal_path:    Path of the write-ahead journal, or None to keep messages in memory only.
+                                Messages still in the journal are queued again on startup.
+        :param on_insert:       Called (with no arguments) whenever messages are queued; e.g. to wake up the bot.
+                                May be called from any thread.
+        """
+        self.max_size = max_size
+        self.journal_path = journal_path
+        self.on_insert = on_insert
+
+        # id -> _Entry, in queue order
+        self._entries = {}
+        self._dedup_hashes = {}
+
+        # token -> number of queued messages
+        self._token_counts = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+        self._journal = None
+        self._journal_acked = 0
+        if journal_path is not None:
+            self._replay_journal()
+            self._journal = open(journal_path, 'a', encoding='utf-8')
+
+    def _replay_journal(self):
+        try:
+            journal = open(self.journal_path, encoding='utf-8')
+        except FileNotFoundError:
+            return
+
+        with journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A partially-written final line, from a crash mid-write
+                    continue
+
+                if 'ack' in record:
+                    for message_id in record['ack']:
+                        self._remove(message_id)
+                        self._journal_acked += 1
+                else:
+                    self._next_id = max(self._next_id, record['id'] + 1)
+                    try:
+                        entry = self._entry_from_record(record)
+                    except (ValueError, OverflowError):
+                        # Undeliverable (e.g. journalled by an older version that didn't check timestamps)
+                        continue
+                    self._add(record['id'], entry)
+
+    @staticmethod
+    def _entry_from_record(record: dict) -> _Entry:
+        dedup_hash = bytes.fromhex(record['dedup_hash']) if record['dedup_hash'] is not None else None
+        return _Entry(record['token'], record['timestamp'], record['sender'], record['receiver'], record['message'],
+                      record['discord_id'], dedup_hash, record['insert_time'])
+
+    @staticmethod
+    def _record_from_entry(message_id: int, entry: _Entry) -> dict:
+        return {'id': message_id, 'token': entry.token, 'timestamp': entry.timestamp, 'sender': entry.sender,
+                'receiver': entry.receiver, 'message': entry.message, 'discord_id': entry.discord_id,
+                'dedup_hash': entry.dedup_hash.hex() if entry.dedup_hash is not None else None,
+                'insert_time': entry.insert_time}
+
+    def _add(self, message_id: int, entry: _Entry):
+        self._entries[message_id] = entry
+        self._token_counts[entry.token] = self._token_counts.get(entry.token, 0) + 1
+        if entry.dedup_hash is not None:
+            self._dedup_hashes[entry.dedup_hash] = message_id
+
+    def _remove(self, message_id: int):
+        entry = self._entries.pop(message_id, None)
+        if entry is None:
+            return
+
+        count = self._token_counts.pop(entry.token) - 1
+        if count > 0:
+            self._token_counts[entry.token] = count
+
+        if entry.dedup_hash is not None:
+            self._dedup_hashes.pop(entry.dedup_hash, None)
+
+    def _write_journal(self, records: list, sync: bool):
+        self._journal.write(''.join(json.dumps(record) + '\n' for record in records))
+        self._journal.flush()
+        if sync:
+            os.fsync(self._journal.fileno())
+
+    def _compact_journal(self):
+        # Written to a new file first, so that a crash mid-compaction leaves the old journal intact
+        temp_path = f'{self.journal_path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as journal:
+            for message_id, entry in self._entries.items():
+                journal.write(json.dumps(self._record_from_entry(message_id, entry)) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        self._journal.close()
+        os.replace(temp_path, self.journal_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal_acked = 0
+
+    def insert_messages(self, msgs: List[FsdMessage]) -> int:
+        """
+        Same as ``StorageBackend.insert_messages()``. If a journal is used, returns once the messages are on disk.
+
+        :raises QueueFullError: if there isn't room for all of the messages (in which case none are queued)
+        :raises ValueError:     if a message's timestamp is out of range (in which case none are queued)
+        """
+        insert_time = time.time()
+
+        with self._lock:
+            msgs = [msg for msg in msgs if msg.dedup_hash is None or msg.dedup_hash not in self._dedup_hashes]
+
+            if len(self._entries) + len(msgs) > self.max_size:
+                raise QueueFullError(f'Message queue is full ({self.max_size} messages)')
+
+            # All built before any is queued, so that an invalid message leaves the queue untouched
+            entries = [_Entry(msg.token, msg.timestamp, msg.sender, msg.receiver, msg.message, msg.discord_id,
+                              msg.dedup_hash, insert_time) for msg in msgs]
+
+            records = []
+            for entry in entries:
+                message_id = self._next_id
+                self._next_id += 1
+
+                self._add(message_id, entry)
+                records.append(self._record_from_entry(message_id, entry))
+
+            if self._journal is not None and len(records) > 0:
+                self._write_journal(records, sync=True)
+
+        if len(msgs) > 0 and self.on_insert is not None:
+            self.on_insert()
+
+        return len(msgs)
+
+    def claim_messages(self, claim_id: int, limit: int, lease: int, partition: int = None,
+                       partition_count: int = 1) -> Iterator[tuple]:
+        """
+        Same as ``StorageBackend.claim_messages()``.
+        """
+        now = time.monotonic()
+        claimed = []
+
+        with self._lock:
+            for message_id, entry in self._entries.items():
+                if len(claimed) >= limit:
+                    break
+
+                if entry.claim_id is not None and now - entry.claimed_at < lease:
+                    continue
+                if partition is not None and (entry.discord_id or 0) % partition_count != partition:
+                    continue
+
+                entry.claim_id = claim_id
+                entry.claimed_at = now
+                claimed.append((message_id, entry.token, entry.time_received, entry.sender, entry.receiver,
+                                entry.message, entry.insert_time))
+
+        return iter(claimed)
+
+    def ack_messages(self, message_ids: List[int]):
+        """
+        Same as ``StorageBackend.ack_messages()``.
+        """
+        with self._lock:
+            for message_id in message_ids:
+                self._remove(message_id)
+
+            if self._journal is not None:
+                # Not synced: if an ack is lost, the message is just delivered again
+                self._write_journal([{'ack': message_ids}], sync=False)
+                self._journal_acked += len(message_ids)
+
+                if self._journal_acked >= max(JOURNAL_COMPACT_THRESHOLD, len(self._entries)):
+                    self._compact_journal()
+
+    def queue_depth(self) -> int:
+        return len(self._entries)
+
+    def queued_messages(self, token: str) -> int:
+        return self._token_counts.get(token, 0)
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
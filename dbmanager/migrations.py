@@ -0,0 +1,255 @@
+"""
+Versioned schema migrations.
+
+Usage (from the project root):
+    python -m dbmanager.migrations              Apply all pending migrations
+    python -m dbmanager.migrations --status     Show the current schema version
+    python -m dbmanager.migrations --check      EXPLAIN the hot queries, and fail if any of them scans a whole table
+                                                or index
+
+Every statement is idempotent (IF NOT EXISTS), so databases created from an older ``schema.sql``,
+or upgraded by hand, can be brought under version control by simply running the migrations.
+Index changes use ALGORITHM=INPLACE, LOCK=NONE, so they can be applied while the bot and API are running.
+
+Only applies to the MariaDB backend; the SQLite backend creates its own schema on startup.
+"""
+import sys
+from dbmanager.backends import mariadb_backend as sql
+from dbmanager.backends.mariadb_backend import MariaDbBackend
+
+# (version, description, statements), in the order in which they must be applied
+MIGRATIONS = [
+    (1, 'Initial schema', [
+        """
+        CREATE TABLE IF NOT EXISTS messages
+          (
+             id            INTEGER PRIMARY KEY auto_increment,
+             insert_time   TIMESTAMP NOT NULL,
+             token         VARCHAR(43) NOT NULL,
+             time_received TIMESTAMP NOT NULL,
+             sender        VARCHAR(20) NOT NULL,
+             receiver      VARCHAR(20) NOT NULL,
+             message       TEXT
+          )
+        CHARACTER SET utf8mb4
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS registration
+          (
+             last_updated TIMESTAMP,
+             token        VARCHAR(43),
+             discord_id   BIGINT(20) UNIQUE,
+             discord_name VARCHAR(32),
+             is_verified  BOOLEAN,
+             callsign     VARCHAR(20),
+             PRIMARY KEY(token, discord_id)
+          )
+        CHARACTER SET utf8mb4
+        """,
+    ]),
+    (2, 'Message queue claim columns', [
+        """
+        ALTER TABLE messages
+            ADD COLUMN IF NOT EXISTS claim_id BIGINT NULL DEFAULT NULL,
+            ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP NULL DEFAULT NULL
+        """,
+        """
+        ALTER TABLE messages
+            ADD INDEX IF NOT EXISTS idx_messages_claim (claim_id, id),
+            ALGORITHM=INPLACE, LOCK=NONE
+        """,
+    ]),
+    (3, 'Indexes for registration lookups and expiry', [
+        # Tokens are unique; declaring it lets token lookups resolve to a single row (const access)
+        # instead of a range scan over the (token, discord_id) primary key.
+        """
+        ALTER TABLE registration
+            ADD UNIQUE INDEX IF NOT EXISTS idx_registration_token (token),
+            ALGORITHM=INPLACE, LOCK=NONE
+        """,
+        # Used by the expiry condition in remove_expired_users(), and by get_verified_discord_ids()
+        """
+        ALTER TABLE registration
+            ADD INDEX IF NOT EXISTS idx_registration_expiry (is_verified, last_updated),
+            ALGORITHM=INPLACE, LOCK=NONE
+        """,
+    ]),
+    (4, 'Recipient Discord ID on queued messages, for partitioning the queue between bot processes', [
+        # Existing rows are left as NULL, and belong to the first partition
+        """
+        ALTER TABLE messages
+            ADD COLUMN IF NOT EXISTS discord_id BIGINT NULL DEFAULT NULL,
+            ALGORITHM=INPLACE, LOCK=NONE
+        """,
+    ]),
+    (5, 'Content hash on queued messages, for rejecting resubmitted messages', [
+        """
+        ALTER TABLE messages
+            ADD COLUMN IF NOT EXISTS dedup_hash BINARY(32) NULL DEFAULT NULL,
+            ALGORITHM=INPLACE, LOCK=NONE
+        """,
+        # NULLs don't conflict, so rows queued before this migration are unaffected
+        """
+        ALTER TABLE messages
+            ADD UNIQUE INDEX IF NOT EXISTS idx_messages_dedup (dedup_hash),
+            ALGORITHM=INPLACE, LOCK=NONE
+        """,
+    ]),
+    (6, 'Per-token admission control: rejected DM count and quarantine on registrations, token index on messages', [
+        """
+        ALTER TABLE registration
+            ADD COLUMN IF NOT EXISTS dm_failures INT NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS quarantined_until TIMESTAMP NULL DEFAULT NULL,
+            ALGORITHM=INPLACE, LOCK=NONE
+        """,
+        # Used by queued_messages()
+        """
+        ALTER TABLE messages
+            ADD INDEX IF NOT EXISTS idx_messages_token (token),
+            ALGORITHM=INPLACE, LOCK=NONE
+        """,
+    ]),
+]
+
+# Queries on the hot path, with representative parameters.
+# The statements themselves are the ones MariaDbBackend issues (see mariadb_backend.py).
+HOT_QUERIES = [
+    ('get_user_record_tuple (token)', sql.USER_RECORD_BY_TOKEN, ('0' * 43,)),
+    ('get_user_record_tuple (discord_id)', sql.USER_RECORD_BY_DISCORD_ID, (0,)),
+    ('add_user', sql.ADD_USER, ('0' * 43, 0, 'user#0001')),
+    ('confirm_user', sql.CONFIRM_USER, ('CALLSIGN', '0' * 43)),
+    ('remove_user (token)', sql.REMOVE_USER_BY_TOKEN, ('0' * 43,)),
+    ('remove_user (discord_id)', sql.REMOVE_USER_BY_DISCORD_ID, (0,)),
+    ('remove_expired_users', sql.REMOVE_EXPIRED_USERS.format(placeholders=sql.placeholders(1)), ('0' * 43,)),
+    ('get_registration_expiries (tokens)', f'{sql.REGISTRATION_EXPIRIES} WHERE token IN (%s)', ('0' * 43,)),
+    ('get_verified_discord_ids', sql.VERIFIED_DISCORD_IDS, ()),
+    ('insert_messages', sql.INSERT_MESSAGES.format(values=sql.INSERT_MESSAGES_ROW),
+     ('0' * 43, 0, 'SENDER', 'RECEIVER', 'message', 0, b'\0' * 32)),
+    ('claim_messages (claim)', sql.CLAIM_MESSAGES.format(partition_filter=''), (0, 60, 500)),
+    ('claim_messages (claim, partitioned)', sql.CLAIM_MESSAGES.format(partition_filter=sql.CLAIM_PARTITION_FILTER),
+     (0, 60, 2, 0, 500)),
+    ('claim_messages (read)', sql.READ_CLAIMED_MESSAGES, (0,)),
+    ('ack_messages', sql.ACK_MESSAGES.format(placeholders=sql.placeholders(2)), (0, 1)),
+    ('queued_messages', sql.QUEUED_MESSAGES, ('0' * 43,)),
+]
+
+# Tables small enough that scanning them is fine (see check_query_plans())
+SMALL_TABLES = {'schema_version'}
+
+# Scans that are expected, by hot query name: (table, index scanned in order) and why it's acceptable.
+# Any other scan of these tables (e.g. a full table scan plus a filesort) still fails the check.
+KNOWN_SCANS = {
+    # Claimed messages are acked (deleted) once handled, so the queue's head is the only part of the table that's
+    # ever read: the PK is read in order, and the scan stops after LIMIT matching rows.
+    # The claim condition can't be indexed, since whether a claim has expired depends on the current time.
+    'claim_messages (claim)': ('messages', 'PRIMARY'),
+    # As above, but also skips other partitions' messages at the head of the queue. Their number is bounded by the
+    # other bot processes' claims, so the partition isn't worth indexing: it depends on FCOM_BOT_PROCESS_COUNT,
+    # and would have to be recomputed for every queued message whenever that changes.
+    'claim_messages (claim, partitioned)': ('messages', 'PRIMARY'),
+}
+
+
+def get_schema_version(cursor) -> int:
+    """
+    :param cursor:  DB cursor
+    :return:        The most recently applied migration version, or 0 if none have been applied
+    """
+    cursor.execute("""  CREATE TABLE IF NOT EXISTS schema_version
+                          (
+                             version     INTEGER PRIMARY KEY,
+                             description VARCHAR(255),
+                             applied_at  TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                          )
+                    """)
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    version = cursor.fetchone()[0]
+
+    if version is None:
+        return 0
+    else:
+        return version
+
+
+def migrate(db_pool) -> int:
+    """
+    Applies all pending migrations, in order.
+
+    :param db_pool: Connection pool of the MariaDB backend
+    :return:        The schema version after migrating
+    """
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        version = get_schema_version(cursor)
+
+        for migration_version, description, statements in MIGRATIONS:
+            if migration_version <= version:
+                continue
+
+            print(f'Applying migration {migration_version}: {description}')
+
+            # NOTE: DDL statements implicitly commit, so a migration isn't atomic.
+            #       Since every statement is idempotent, a failed migration can simply be re-run.
+            for statement in statements:
+                cursor.execute(statement)
+
+            cursor.execute("INSERT INTO schema_version(version, description) VALUES (%s, %s)",
+                           (migration_version, description))
+            version = migration_version
+
+    return version
+
+
+def check_query_plans(db_pool) -> bool:
+    """
+    EXPLAINs every query in ``HOT_QUERIES``.
+    A query fails the check if any table in its plan is read with a full table scan (type ALL) or a full index scan
+    (type index), even if an index could have been used: the optimizer prefers scans on small tables, so a development
+    database can't tell whether a production-sized one would use the index. Only ``SMALL_TABLES`` and ``KNOWN_SCANS``
+    are exempt.
+
+    :param db_pool: Connection pool of the MariaDB backend
+    :return:        True if all queries pass, False otherwise
+    """
+    passed = True
+
+    with db_pool.connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+
+        for name, query, params in HOT_QUERIES:
+            cursor.execute(f'EXPLAIN {query}', params)
+
+            for row in cursor.fetchall():
+                if row['type'] not in ('ALL', 'index') or row['table'] in SMALL_TABLES:
+                    continue
+
+                if row['type'] == 'ALL':
+                    scan = f'full scan of {row["table"]}'
+                else:
+                    scan = f'full scan of {row["table"]}.{row["key"]}'
+
+                if KNOWN_SCANS.get(name) == (row['table'], row['key']) and row['type'] == 'index':
+                    print(f'[OK]   {name}: {scan} (known; stops at LIMIT)')
+                else:
+                    print(f'[FAIL] {name}: {scan} (possible keys: {row["possible_keys"]})')
+                    passed = False
+
+    return passed
+
+
+if __name__ == '__main__':
+    pool = MariaDbBackend().pool
+
+    if '--status' in sys.argv:
+        with pool.connection() as status_conn:
+            current_version = get_schema_version(status_conn.cursor())
+        print(f'Schema version: {current_version} (latest: {MIGRATIONS[-1][0]})')
+
+    elif '--check' in sys.argv:
+        if check_query_plans(pool):
+            print('All hot queries are index-backed.')
+        else:
+            sys.exit(1)
+
+    else:
+        print(f'Schema version: {migrate(pool)}')
@@ -0,0 +1,52 @@
+import asyncio
+import os
+import socket
+
+# The API notifies the bot of newly queued messages by sending a (contentless) UDP datagram over loopback.
+# Notifications are best-effort: if one is lost, the message is still picked up by the bot's fallback poll.
+# When the bot runs as several processes, each listens on its own port: QUEUE_NOTIFY_PORT + its queue partition.
+QUEUE_NOTIFY_HOST = '127.0.0.1'
+QUEUE_NOTIFY_PORT = int(os.environ.get('FCOM_QUEUE_NOTIFY_PORT', 47011))
+
+_notify_socket = None
+
+
+def notify(partition: int = 0):
+    """
+    Notifies the bot that new messages have been committed to the queue.
+    Never blocks, and never raises.
+
+    :param partition:   Queue partition that the messages were added to
+    """
+    global _notify_socket
+
+    try:
+        if _notify_socket is None:
+            _notify_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _notify_socket.setblocking(False)
+        _notify_socket.sendto(b'\x01', (QUEUE_NOTIFY_HOST, QUEUE_NOTIFY_PORT + partition))
+    except OSError:
+        pass
+
+
+class _WakeupProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, wakeup: asyncio.Event):
+        self.wakeup = wakeup
+
+    def datagram_received(self, data, addr):
+        self.wakeup.set()
+
+
+async def listen(wakeup: asyncio.Event, partition: int = 0) -> asyncio.DatagramTransport:
+    """
+    Starts listening for queue notifications.
+
+    :param wakeup:      Event that gets set whenever a notification is received
+    :param partition:   Queue partition to listen for
+    :return:            The listening transport. Call ``close()`` on it to stop listening.
+    """
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: _WakeupProtocol(wakeup),
+                                                       local_addr=(QUEUE_NOTIFY_HOST, QUEUE_NOTIFY_PORT + partition))
+    return transport
@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TtlCache:
+    """
+    Thread-safe, size-bounded LRU cache whose entries expire after a fixed time-to-live.
+
+    ``None`` is a valid value, which allows misses to be cached as well (i.e. negative caching).
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+
+        :param max_size:    Maximum number of entries. The least recently used entry is evicted when full.
+        :param ttl:         Default number of seconds an entry stays valid for
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # key -> (expiry time, value), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """
+        :param key:     Cache key
+        :param default: Returned if the key isn't cached, or has expired
+        :return:        The cached value, or ``default``
+        """
+        with self._lock:
+            try:
+                expiry, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expiry <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """
+        :param key:     Cache key
+        :param value:   Value to cache (may be ``None``)
+        :param ttl:     Time-to-live for this entry, in seconds. Defaults to the cache-wide TTL.
+        """
+        if ttl is None:
+            ttl = self.ttl
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """
+        Removes the specified entry, if present.
+
+        :param key:     Cache key
+        :param default: Returned if the key isn't cached
+        :return:        The removed value (even if expired), or ``default``
+        """
+        with self._lock:
+            try:
+                return self._entries.pop(key)[1]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > time.monotonic()
+
+    def stats(self) -> dict:
+        """
+        :return:    Snapshot of the cache's size and hit/miss counters
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import List
+from dbmodels.fsd_message import FsdMessage
+
+
+class WriteBuffer:
+    """
+    Group commit for message inserts: messages submitted by concurrent requests are collected, and written by a
+    background thread as a single multi-row INSERT (i.e. a single commit) covering all of them.
+
+    A batch is written once it has been collecting for ``max_delay`` seconds, or holds ``max_rows`` messages,
+    whichever comes first. While a batch is being written, the next one collects, so under load each commit covers
+    everything that arrived during the previous one.
+
+    If a batch fails, each of its submissions is retried on its own, so that one bad submission only fails the request
+    that made it.
+    """
+
+    def __init__(self, flush, max_delay: float, max_rows: int):
+        """
+
+        :param flush:       Called (on the writer thread) with each batch of messages, in submission order.
+                            Once it returns, the batch is considered durable. Must write either all of the messages,
+                            or (by raising) none of them.
+        :param max_delay:   Maximum number of seconds a message waits for others to join its batch
+        :param max_rows:    Maximum number of messages per batch. A single submission is never split across batches,
+                            so a batch can exceed this if one submission does.
+        """
+        self.flush = flush
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+
+        # (messages, future) for each submission not yet written
+        self._pending = deque()
+        self._pending_rows = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+        self.batches = 0
+        self.rows = 0
+
+    def submit(self, msgs: List[FsdMessage]) -> Future:
+        """
+        :param msgs:    Messages to write
+        :return:        Completed once the batch containing the messages has been written
+                        (with the exception raised by ``flush``, if it failed)
+        """
+        future = Future()
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('WriteBuffer is closed')
+
+            # Started on first use, rather than on import, so that it's never inherited by a forked worker
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='fcom-write-buffer', daemon=True)
+                self._thread.start()
+
+            self._pending.append((msgs, future))
+            self._pending_rows += len(msgs)
+            self._condition.notify()
+
+        return future
+
+    def _take_batch(self) -> list:
+        """
+        Waits for a batch to fill up (or for its delay to expire), then removes it from the pending submissions.
+
+        :return:    (messages, future) of each submission in the batch; empty once closed
+        """
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+
+            deadline = time.monotonic() + self.max_delay
+            while self._pending_rows < self.max_rows and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch = []
+            batch_rows = 0
+            while self._pending and (len(batch) == 0 or batch_rows + len(self._pending[0][0]) <= self.max_rows):
+                msgs, future = self._pending.popleft()
+                batch.append((msgs, future))
+                batch_rows += len(msgs)
+
+            self._pending_rows -= batch_rows
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if len(batch) == 0:
+                return
+
+            msgs = [msg for submission, future in batch for msg in submission]
+            try:
+                self.flush(msgs)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                else:
+                    self._flush_separately(batch)
+            else:
+                self.batches += 1
+                self.rows += len(msgs)
+                for submission, future in batch:
+                    future.set_result(None)
+
+    def _flush_separately(self, batch: list):
+        """
+        Writes each submission in a failed batch on its own, so that only the one(s) at fault fail.
+
+        :param batch:   (messages, future) of each submission in the batch
+        """
+        for submission, future in batch:
+            try:
+                self.flush(submission)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                self.batches += 1
+                self.rows += len(submission)
+                future.set_result(None)
+
+    def close(self):
+        """
+        Writes out any pending messages, then stops the writer thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+
+        if thread is not None:
+            thread.join()
+
+    def stats(self) -> dict:
+        """
+        :return:    Batching statistics, for monitoring
+        """
+        with self._condition:
+            pending = self._pending_rows
+
+        return {
+            'pending': pending,
+            'batches': self.batches,
+            'rows': self.rows,
+        }
@@ -1,7 +1,13 @@
 class FsdMessage:
     """Represents a private message sent over the FSD protocol, received over our API."""
 
-    def __init__(self, token: str, timestamp: int, sender: str, receiver: str, message: str):
+    # No per-instance __dict__, since there can be a whole claimed batch of these in memory at once
+    __slots__ = ('token', 'timestamp', 'sender', 'receiver', 'message', 'message_ids', 'insert_time', 'discord_id',
+                 'dedup_hash')
+
+    def __init__(self, token: str, timestamp: int, sender: str, receiver: str, message: str,
+                 message_ids: list = None, insert_time: float = None, discord_id: int = None,
+                 dedup_hash: bytes = None):
         """
 
         :param token:       Registration token
@@ -9,9 +15,21 @@ class FsdMessage:
         :param sender:      Callsign of sender
         :param receiver:    Callsign of receiver
         :param message:     Contents of received message
+        :param message_ids: IDs of the queued messages that this message consists of.
+                            Only set for messages retrieved from the queue.
+        :param insert_time: When the (oldest) message was queued, in seconds since Unix epoch.
+                            Only set for messages retrieved from the queue.
+        :param discord_id:  Discord ID of the recipient; determines which queue partition the message goes to.
+                            Only set for messages being queued.
+        :param dedup_hash:  Content hash used to detect resubmitted messages (see ``db_manager.message_hash()``).
+                            Only set for messages being queued.
         """
         self.token = token
         self.timestamp = timestamp
         self.sender = sender
         self.receiver = receiver
         self.message = message
+        self.message_ids = message_ids
+        self.insert_time = insert_time
+        self.discord_id = discord_id
+        self.dedup_hash = dedup_hash
@@ -1,11 +1,21 @@
-from discord import DMChannel
+import time
+from typing import TYPE_CHECKING
+
+# Only needed for type hints, so that the API doesn't need discord.py installed
+if TYPE_CHECKING:
+    from discord import DMChannel
 
 
 class UserRegistration:
     """Represents a Discord user in the registration DB"""
 
+    # No per-instance __dict__, since up to FCOM_REGISTRATION_CACHE_SIZE of these are cached
+    __slots__ = ('last_updated', 'token', 'discord_id', 'discord_name', 'is_verified', 'callsign', 'channel_object',
+                 'dm_failures', 'quarantined_until')
+
     def __init__(self, last_updated: str, token: str, discord_id: int, discord_name: str,
-                 is_verified, callsign: str, channel_object: DMChannel):
+                 is_verified, callsign: str, channel_object: 'DMChannel', dm_failures: int = 0,
+                 quarantine_seconds: int = None):
         """
 
         :param last_updated:    When the registration record was last updated.
@@ -15,6 +25,9 @@ class UserRegistration:
         :param is_verified:     Whether the registration is confirmed over the Message Forwarder API
         :param callsign:        Callsign that the user is logged into VATSIM/IVAO as
         :param channel_object:  The DMChannel associated with the Discord user
+        :param dm_failures:     Number of consecutive DMs to the user that were rejected (e.g. DMs are closed)
+        :param quarantine_seconds:  Seconds until the registration's quarantine ends (None or <= 0 if not
+                                    quarantined). Messages for a quarantined registration are refused by the API.
         """
         self.last_updated = last_updated
         self.token = token
@@ -31,3 +44,19 @@ class UserRegistration:
 
         self.callsign = callsign
         self.channel_object = channel_object
+        self.dm_failures = dm_failures
+
+        # As a time.monotonic() deadline, since the registration may be cached
+        if quarantine_seconds is not None and quarantine_seconds > 0:
+            self.quarantined_until = time.monotonic() + quarantine_seconds
+        else:
+            self.quarantined_until = None
+
+    def quarantine_remaining(self) -> float:
+        """
+        :return:    Seconds until the registration's quarantine ends, or 0 if it isn't quarantined
+        """
+        if self.quarantined_until is None:
+            return 0.0
+        else:
+            return max(0.0, self.quarantined_until - time.monotonic())
@@ -1,4 +1,16 @@
-from bot.discord_bot import start_bot
+import os
+import subprocess
+import sys
 
 if __name__ == "__main__":
+    process_count = int(os.environ.get('FCOM_BOT_PROCESS_COUNT', 1))
+
+    # Sharded: run one bot process per queue partition (see bot/discord_bot.py), and wait for all of them
+    if process_count > 1 and 'FCOM_BOT_PROCESS_INDEX' not in os.environ:
+        processes = [subprocess.Popen([sys.executable] + sys.argv,
+                                      env={**os.environ, 'FCOM_BOT_PROCESS_INDEX': str(index)})
+                     for index in range(process_count)]
+        sys.exit(max(process.wait() for process in processes))
+
+    from bot.discord_bot import start_bot
     start_bot()
@@ -0,0 +1,42 @@
+"""
+Runs the (ASGI) message API and the Discord bot in a single process, on a single event loop.
+
+Messages are handed from the API to the bot through an in-memory queue (see dbmanager/memory_queue.py) rather than
+the DB, which is then only used for registrations. This saves the DB writes, reads and deletes for every message,
+as well as the wait for the bot to be notified. Not compatible with FCOM_BOT_PROCESS_COUNT > 1.
+"""
+import asyncio
+import os
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from api.async_message_api import app
+from bot.discord_bot import BOT_PROCESS_COUNT, create_client, token
+from dbmanager import db_manager
+from dbmanager.memory_queue import MemoryQueue
+
+# Address the API listens on
+API_BIND = os.environ.get('FCOM_API_BIND', '0.0.0.0:5000')
+
+
+async def main():
+    if BOT_PROCESS_COUNT != 1:
+        raise ValueError('Combined mode only supports a single bot process (FCOM_BOT_PROCESS_COUNT=1)')
+
+    client = create_client()
+    loop = asyncio.get_running_loop()
+
+    # Messages may be queued from DB executor threads, when the queue has a journal
+    db_manager.message_queue = MemoryQueue(on_insert=lambda: loop.call_soon_threadsafe(client.queue_wakeup.set))
+
+    config = Config()
+    config.bind = [API_BIND]
+
+    try:
+        await asyncio.gather(serve(app, config), client.start(token))
+    finally:
+        await client.close()
+        db_manager.message_queue.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,191 @@
+"""
+Non-blocking, structured (JSON lines) logging.
+
+Records are handed to a bounded in-memory queue, and written to disk by a background thread,
+so that a slow disk (e.g. during log rotation) never stalls a request or a DM being forwarded.
+The thread is started by the first record logged in each process, so that workers forked after the logger was set
+up (e.g. by ``gunicorn --preload``) get their own. The queue is flushed when the process exits.
+
+High-volume lines can be rate limited by passing a ``rate_limit`` key, e.g.:
+
+    logger.info('Message: ...', extra={'rate_limit': 'message', 'token': token})
+
+Any other ``extra`` fields are included in the JSON record.
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from monitoring.metrics import REGISTRY
+
+# Maximum number of records waiting to be written. Further records are dropped until the writer catches up.
+LOG_QUEUE_SIZE = int(os.environ.get('FCOM_LOG_QUEUE_SIZE', 10000))
+
+# Records sharing a rate_limit key are limited to this many per second (with bursts of up to as many)
+LOG_RATE_LIMIT = float(os.environ.get('FCOM_LOG_RATE_LIMIT', 20))
+
+LOG_RECORDS_DROPPED = REGISTRY.counter('fcom_log_records_dropped_total', 'Number of log records not written',
+                                       ('reason',))
+
+# Attributes present on every LogRecord; anything else was passed via `extra`
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single-line JSON object."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage(),
+        }
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES:
+                entry[key] = value
+
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drops records whose ``rate_limit`` key has exceeded ``rate`` records per second.
+    The next record let through for that key reports how many were dropped in the meantime (as ``suppressed``).
+    """
+
+    def __init__(self, rate: float):
+        """
+
+        :param rate:    Records per second allowed for each key (also the burst size)
+        """
+        super().__init__()
+        self.rate = rate
+
+        # key -> [tokens, last refill, records suppressed since the last one let through]
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'rate_limit', None)
+        if key is None:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.setdefault(key, [self.rate, now, 0])
+            bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+            if bucket[0] < 1:
+                bucket[2] += 1
+                LOG_RECORDS_DROPPED.inc(reason='rate_limited')
+                return False
+
+            bucket[0] -= 1
+            if bucket[2] > 0:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+            return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    ``QueueHandler`` that drops records (rather than raising) when the queue is full.
+    Each process gets its own queue and ``QueueListener``, started by the first record it logs.
+    """
+
+    def __init__(self, maxsize: int, *handlers: logging.Handler):
+        """
+
+        :param maxsize:     Maximum number of records waiting to be written
+        :param handlers:    Handlers that the listener writes records to
+        """
+        super().__init__(None)
+        self.maxsize = maxsize
+        self.target_handlers = handlers
+        self.listener = None
+
+        # PID of the process the listener was started in
+        self._pid = None
+
+    def _start_listener(self):
+        # Under the handler's lock, which the logging module reinitializes in a forked child
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+
+            # Whatever a parent process left in its queue is its own to write
+            self.queue = queue.Queue(maxsize=self.maxsize)
+            self.listener = QueueListener(self.queue, *self.target_handlers)
+            self.listener.start()
+
+            # Registered once; a forked child inherits the registration
+            if self._pid is None:
+                atexit.register(self.stop_listener)
+            self._pid = os.getpid()
+
+    def stop_listener(self):
+        """
+        Writes out every queued record, then stops the listener (if it was started in this process).
+        """
+        with self.lock:
+            if self._pid == os.getpid() and self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Unlike QueueHandler.prepare(), the traceback is kept separate from the message (for JsonFormatter).
+        # Both are still rendered here, since the arguments (or frames) may have changed by the time it's written.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self._pid != os.getpid():
+            self._start_listener()
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(reason='queue_full')
+
+
+def setup_logging(logger_name: str, filename: str) -> logging.Logger:
+    """
+    Configures the given logger to write JSON lines to a daily-rotated file, via a background thread
+    (see ``DroppingQueueHandler``).
+
+    :param logger_name: Name of the logger to configure
+    :param filename:    Log file, relative to the ``logs`` directory (which is created if necessary)
+    :return:            The configured logger
+    """
+    os.makedirs('logs', exist_ok=True)
+
+    file_handler = TimedRotatingFileHandler(os.path.join('logs', filename), when='midnight', backupCount=15)
+    file_handler.setFormatter(JsonFormatter())
+
+    queue_handler = DroppingQueueHandler(LOG_QUEUE_SIZE, file_handler)
+    queue_handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT))
+
+    logger = logging.getLogger(logger_name)
+    logger.addHandler(queue_handler)
+    logger.setLevel(logging.INFO)
+    return logger
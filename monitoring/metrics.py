@@ -0,0 +1,234 @@
+import asyncio
+import threading
+import time
+from functools import wraps
+
+# Default histogram buckets (in seconds); suitable for both DB calls and HTTP requests
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labelnames: tuple, labelvalues: tuple, extra: str = None) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(labelnames, labelvalues)]
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+    """Base class for all metric types. Label values are passed as keyword arguments."""
+
+    type_name = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self) -> list:
+        """
+        :return:    List of (suffix, labels string, value)
+        """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        with self._lock:
+            return [('', _format_labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """
+    Value that can go up and down.
+    Either set explicitly, or computed at scrape time by a callback (see ``set_function()``).
+    """
+
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._function = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """
+        :param function:    Called at scrape time. Returns either a number,
+                            or (for labelled gauges) a dict of {label values tuple: number}.
+        """
+        self._function = function
+
+    def samples(self) -> list:
+        if self._function is not None:
+            try:
+                result = self._function()
+            except Exception:
+                # A failing callback (e.g. the DB is down) shouldn't break the rest of the scrape
+                return []
+
+            if isinstance(result, dict):
+                return [('', _format_labels(self.labelnames, key), value) for key, value in result.items()]
+            else:
+                return [('', '', result)]
+
+        with self._lock:
+            return [('', _format_labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values (e.g. latencies), in cumulative buckets."""
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+        # label values -> [bucket counts..., sum, count]
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = [0] * (len(self.buckets) + 2)
+                self._values[key] = state
+
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def time(self, **labels):
+        """
+        Decorator that observes the wall-clock duration of every call to the decorated function (or coroutine).
+        """
+        def decorator(function):
+            if asyncio.iscoroutinefunction(function):
+                @wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return await function(*args, **kwargs)
+                    finally:
+                        self.observe(time.perf_counter() - start, **labels)
+                return async_wrapper
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def samples(self) -> list:
+        samples = []
+        with self._lock:
+            for key, state in self._values.items():
+                for i, upper_bound in enumerate(self.buckets):
+                    samples.append(('_bucket', _format_labels(self.labelnames, key, f'le="{upper_bound}"'), state[i]))
+                samples.append(('_bucket', _format_labels(self.labelnames, key, 'le="+Inf"'), state[-1]))
+                samples.append(('_sum', _format_labels(self.labelnames, key), state[-2]))
+                samples.append(('_count', _format_labels(self.labelnames, key), state[-1]))
+        return samples
+
+
+class Registry:
+    """Collection of metrics, rendered together in the Prometheus text exposition format."""
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+# Process-wide registry; every metric in the API and the bot is registered here.
+REGISTRY = Registry()
+
+
+async def start_http_server(host: str, port: int, registry: Registry = REGISTRY):
+    """
+    Serves the registry's metrics over HTTP from the running event loop (for processes without a web framework).
+    Every request is answered with the metrics, regardless of path.
+
+    :param host:        Address to listen on
+    :param port:        Port to listen on
+    :param registry:    Metrics to serve
+    :return:            The ``asyncio.Server``
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Request line and headers; the contents don't matter
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            # Rendering may call back into the DB (e.g. for the queue depth), so keep it off the event loop
+            body = (await asyncio.get_running_loop().run_in_executor(None, registry.render)).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\n' +
+                         f'Content-Type: {Registry.CONTENT_TYPE}\r\n'.encode() +
+                         f'Content-Length: {len(body)}\r\n'.encode() +
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
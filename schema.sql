@@ -6,7 +6,14 @@
      time_received TIMESTAMP NOT NULL,
      sender        VARCHAR(20) NOT NULL,
      receiver      VARCHAR(20) NOT NULL,
-     message       TEXT
+     message       TEXT,
+     claim_id      BIGINT NULL DEFAULT NULL,
+     claimed_at    TIMESTAMP NULL DEFAULT NULL,
+     discord_id    BIGINT NULL DEFAULT NULL,
+     dedup_hash    BINARY(32) NULL DEFAULT NULL,
+     INDEX idx_messages_claim (claim_id, id),
+     INDEX idx_messages_token (token),
+     UNIQUE INDEX idx_messages_dedup (dedup_hash)
   )
 CHARACTER SET utf8mb4;
 
@@ -18,6 +25,10 @@ CREATE TABLE registration
      discord_name VARCHAR(32),
      is_verified  BOOLEAN,
      callsign     VARCHAR(20),
-     PRIMARY KEY(token, discord_id)
+     dm_failures  INT NOT NULL DEFAULT 0,
+     quarantined_until TIMESTAMP NULL DEFAULT NULL,
+     PRIMARY KEY(token, discord_id),
+     UNIQUE INDEX idx_registration_token (token),
+     INDEX idx_registration_expiry (is_verified, last_updated)
   )
 CHARACTER SET utf8mb4;  
\ No newline at end of file
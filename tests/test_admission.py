@@ -0,0 +1,41 @@
+import time
+
+from api.admission import TokenBucketLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_oversized_request_leaves_the_bucket_in_debt(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    limiter = TokenBucketLimiter(rate=10, burst=10, max_keys=100)
+
+    # Let through since the bucket is full, leaving it 20 units in debt
+    assert limiter.acquire('token', 30) == 0
+
+    # Longer than it takes to refill an empty bucket, but not long enough to pay off the debt
+    clock.now += 1.5
+    assert limiter.acquire('token', 1) == 0.6
+
+    clock.now += 1.5
+    assert limiter.acquire('token', 10) == 0
+
+
+def test_full_buckets_are_forgotten(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    limiter = TokenBucketLimiter(rate=10, burst=10, max_keys=100)
+
+    assert limiter.acquire('token', 5) == 0
+    assert len(limiter._buckets) == 1
+
+    # Refilled after 0.5s
+    clock.now += 0.6
+    assert limiter._buckets.get('token') is None
+    assert limiter.acquire('token', 10) == 0
@@ -0,0 +1,80 @@
+import pytest
+
+from api import common
+from api.common import ApiError
+from dbmodels.user_registration import UserRegistration
+
+
+def message(**fields) -> dict:
+    return {'timestamp': 1600000000000, 'sender': 'ACA123', 'receiver': 'CZVR_CTR', 'message': 'hello', **fields}
+
+
+def registration(token: str = 'token', quarantine_seconds: int = None) -> UserRegistration:
+    return UserRegistration(None, token, 1001, 'user#0001', True, 'ACA123', None, 0, quarantine_seconds)
+
+
+def test_register_requires_token_and_callsign():
+    with pytest.raises(ApiError) as error:
+        common.parse_register_request({'callsign': 'aca123'}, {})
+    assert error.value.response.status == 400
+
+    token, callsign, client_version = common.parse_register_request({'token': 'token', 'callsign': 'aca123'},
+                                                                    {'User-Agent': 'FcomClient/0.9.0'})
+    assert (token, callsign, client_version) == ('token', 'ACA123', '0.9.0')
+
+
+def test_messaging_rejects_malformed_requests():
+    for payload in (None, {'token': 'token'}, {'token': 'token', 'messages': []},
+                    {'token': 'token', 'messages': [message()] * (common.MAX_MESSAGES_PER_REQUEST + 1)}):
+        with pytest.raises(ApiError) as error:
+            common.parse_messaging_request(payload)
+        assert error.value.response.status == 400
+
+
+def test_single_message_keeps_the_original_response_format():
+    with pytest.raises(ApiError) as error:
+        common.parse_messaging_request({'token': 'token', 'messages': [message(sender='')]})
+    assert set(error.value.response.body) == {'status', 'detail'}
+
+    token, accepted, results = common.parse_messaging_request({'token': 'token', 'messages': [message()]})
+    assert common.messaging_response(accepted, results).body == 'ok'
+
+
+def test_batch_response_reports_each_message():
+    token, accepted, results = common.parse_messaging_request(
+        {'token': 'token', 'messages': [message(), message(sender='')]})
+
+    response = common.messaging_response(accepted, results)
+    assert response.status == 200
+    assert (response.body['accepted'], response.body['rejected']) == (1, 1)
+
+
+def test_admitted_messages_are_addressed_to_the_registration():
+    token, accepted, results = common.parse_messaging_request({'token': 'admitted', 'messages': [message()]})
+
+    common.admit_messages(registration('admitted'), 0, accepted)
+    assert accepted[0].discord_id == 1001
+
+
+def test_refused_messages_get_429_with_retry_after():
+    token, accepted, results = common.parse_messaging_request({'token': 'quarantined', 'messages': [message()]})
+
+    with pytest.raises(ApiError) as error:
+        common.admit_messages(registration('quarantined', quarantine_seconds=60), 0, accepted)
+
+    assert error.value.response.status == 429
+    assert 'Retry-After' in error.value.response.headers
+
+
+def test_unknown_deregistration_keeps_http_200():
+    with pytest.raises(ApiError) as error:
+        common.check_deregistration('token', None)
+
+    assert error.value.response.status == 200
+    assert error.value.response.body['status'] == 404
+
+
+def test_result_statuses_are_http_status_codes():
+    accepted, results = common.parse_messages('token', [message(), message(sender='')])
+
+    assert [result['status'] for result in results] == [200, 400]
@@ -0,0 +1,63 @@
+import pytest
+
+from dbmanager.connection_pool import ConnectionPool
+
+
+class FakeConnection:
+    def __init__(self):
+        self.rolled_back = False
+        self.closed = False
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def close(self):
+        self.closed = True
+
+
+def pool() -> ConnectionPool:
+    return ConnectionPool(FakeConnection, max_size=1, timeout=0.1)
+
+
+def test_connection_is_reused():
+    db_pool = pool()
+
+    with db_pool.connection() as first:
+        pass
+    with db_pool.connection() as second:
+        pass
+
+    assert second is first
+    assert db_pool.stats()['open'] == 1
+
+
+def test_connection_is_discarded_on_exception():
+    db_pool = pool()
+
+    with pytest.raises(ValueError):
+        with db_pool.connection() as conn:
+            raise ValueError()
+
+    assert conn.rolled_back and conn.closed
+    assert db_pool.stats()['open'] == 0
+
+    # The slot is free again
+    with db_pool.connection() as replacement:
+        assert replacement is not conn
+
+
+def test_connection_is_discarded_when_generator_is_closed_early():
+    db_pool = pool()
+
+    def rows():
+        with db_pool.connection():
+            yield 1
+            yield 2
+
+    generator = rows()
+    next(generator)
+    generator.close()
+
+    assert db_pool.stats()['open'] == 0
+    with db_pool.connection():
+        pass
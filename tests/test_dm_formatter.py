@@ -0,0 +1,92 @@
+from bot import dm_formatter
+from bot.dm_formatter import DM_MAX_LENGTH
+from dbmodels.fsd_message import FsdMessage
+
+
+def message(text: str, sender: str = 'ACA123', receiver: str = 'CZVR_CTR') -> FsdMessage:
+    return FsdMessage('token', 1600000000000, sender, receiver, text)
+
+
+def body_length(msg: FsdMessage, total: int) -> int:
+    # Length of a body which, along with its sender line, makes a block of exactly `total` characters
+    return total - len(dm_formatter.format_header(msg)) - 1
+
+
+def test_message_of_exactly_max_length_fits_in_one_dm():
+    msg = message('')
+    msg.message = 'x' * body_length(msg, DM_MAX_LENGTH)
+
+    dms = dm_formatter.pack_messages([msg])
+
+    assert len(dms) == 1
+    assert len(dms[0][0]) == DM_MAX_LENGTH
+    assert dms[0][1] == [msg]
+
+
+def test_message_one_over_max_length_is_split():
+    msg = message('')
+    msg.message = 'x' * (body_length(msg, DM_MAX_LENGTH) + 1)
+
+    dms = dm_formatter.pack_messages([msg])
+
+    assert len(dms) == 2
+    assert all(len(contents) <= DM_MAX_LENGTH for contents, completed in dms)
+
+
+def test_long_message_is_split_and_only_completed_by_its_last_dm():
+    msg = message('x' * 5000)
+
+    dms = dm_formatter.pack_messages([msg])
+
+    assert len(dms) == 3
+    assert all(len(contents) <= DM_MAX_LENGTH for contents, completed in dms)
+    assert [completed for contents, completed in dms] == [[], [], [msg]]
+
+    # Every part after the first is marked as a continuation, and nothing is lost
+    assert dms[1][0].startswith('**ACA123** (cont.):\n')
+    assert ''.join(contents.split('\n', 1)[1] for contents, completed in dms) == msg.message
+
+
+def test_long_message_is_split_at_spaces():
+    words = ['word'] * 1000
+    msg = message(' '.join(words))
+
+    dms = dm_formatter.pack_messages([msg])
+
+    parts = [contents.split('\n', 1)[1] for contents, completed in dms]
+    assert all(not part.startswith(' ') and not part.endswith(' ') for part in parts)
+    assert ' '.join(parts).split(' ') == words
+
+
+def test_multibyte_characters_count_as_one():
+    # Discord's limit is in characters, not bytes
+    msg = message('')
+    msg.message = '日本語🛫' * (body_length(msg, DM_MAX_LENGTH) // 4)
+
+    dms = dm_formatter.pack_messages([msg])
+
+    assert len(dms) == 1
+    assert len(dms[0][0]) <= DM_MAX_LENGTH < len(dms[0][0].encode())
+
+
+def test_messages_keep_their_order_and_senders():
+    msgs = [message(f'message {i}', sender=f'ACA{i}') for i in range(5)]
+    msgs.append(message('on frequency', sender='BAW1', receiver='@22800'))
+
+    dms = dm_formatter.pack_messages(msgs)
+
+    assert len(dms) == 1
+    blocks = dms[0][0].split(dm_formatter.MESSAGE_SEPARATOR)
+    assert blocks[:5] == [f'**ACA{i}**:\nmessage {i}' for i in range(5)]
+    assert blocks[5] == '**BAW1** (122.800 MHz):\non frequency'
+    assert dms[0][1] == msgs
+
+
+def test_messages_keep_their_order_across_dms():
+    msgs = [message(str(i) * 900, sender=f'ACA{i}') for i in range(6)]
+
+    dms = dm_formatter.pack_messages(msgs)
+
+    assert len(dms) > 1
+    assert all(len(contents) <= DM_MAX_LENGTH for contents, completed in dms)
+    assert [msg for contents, completed in dms for msg in completed] == msgs
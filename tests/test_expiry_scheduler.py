@@ -0,0 +1,73 @@
+from bot.expiry_scheduler import ExpiryScheduler
+
+
+def test_rescheduling_replaces_the_deadline():
+    scheduler = ExpiryScheduler()
+    scheduler.schedule('a', 10)
+    scheduler.schedule('b', 20)
+
+    # Later, then earlier than before
+    scheduler.schedule('a', 30)
+    scheduler.schedule('b', 5)
+
+    assert len(scheduler) == 2
+    assert scheduler.delay(0) == 5
+    assert scheduler.pop_due(10, 10) == ['b']
+    assert scheduler.pop_due(29, 10) == []
+    assert scheduler.pop_due(30, 10) == ['a']
+    assert scheduler.delay(30) is None
+
+
+def test_rescheduling_to_the_same_deadline_pops_once():
+    scheduler = ExpiryScheduler()
+    scheduler.schedule('a', 10)
+    scheduler.schedule('a', 10)
+
+    assert scheduler.pop_due(10, 10) == ['a']
+    assert scheduler.pop_due(10, 10) == []
+    assert len(scheduler) == 0
+
+
+def test_cancelled_keys_are_never_popped():
+    scheduler = ExpiryScheduler()
+    scheduler.schedule('a', 10)
+    scheduler.schedule('b', 20)
+
+    scheduler.cancel('a')
+    scheduler.cancel('missing')
+
+    assert len(scheduler) == 1
+    assert scheduler.delay(0) == 20
+    assert scheduler.pop_due(100, 10) == ['b']
+
+    # Scheduled again after being cancelled
+    scheduler.cancel('b')
+    scheduler.schedule('b', 200)
+    assert scheduler.pop_due(100, 10) == []
+    assert scheduler.pop_due(200, 10) == ['b']
+
+
+def test_due_keys_are_popped_in_batches_earliest_first():
+    scheduler = ExpiryScheduler()
+    for i, key in enumerate(['e', 'd', 'c', 'b', 'a']):
+        scheduler.schedule(key, 5 - i)
+    scheduler.schedule('later', 100)
+
+    assert scheduler.delay(10) == 0
+    assert scheduler.pop_due(10, 2) == ['a', 'b']
+    assert scheduler.pop_due(10, 2) == ['c', 'd']
+    assert scheduler.pop_due(10, 2) == ['e']
+    assert scheduler.pop_due(10, 2) == []
+    assert scheduler.delay(10) == 90
+    assert len(scheduler) == 1
+
+
+def test_repeated_rescheduling_keeps_every_key():
+    scheduler = ExpiryScheduler()
+    for deadline in range(5000):
+        scheduler.schedule(deadline % 3, deadline)
+
+    # Only the last deadline of each key counts
+    assert len(scheduler) == 3
+    assert scheduler.pop_due(4996, 10) == []
+    assert scheduler.pop_due(5000, 10) == [4997 % 3, 4998 % 3, 4999 % 3]
@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+import threading
+
+import pytest
+
+from monitoring.log_pipeline import DroppingQueueHandler, JsonFormatter
+
+
+def make_logger(path, name: str) -> (logging.Logger, DroppingQueueHandler):
+    file_handler = logging.FileHandler(path)
+    file_handler.setFormatter(JsonFormatter())
+    handler = DroppingQueueHandler(100, file_handler)
+
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return logger, handler
+
+
+def read_messages(path) -> list:
+    with open(path) as log_file:
+        return [json.loads(line)['message'] for line in log_file]
+
+
+def test_listener_starts_on_first_record(tmp_path):
+    path = tmp_path / 'test.log'
+    threads_before = threading.active_count()
+    logger, handler = make_logger(path, 'test_listener_starts_on_first_record')
+
+    assert handler.listener is None
+    assert threading.active_count() == threads_before
+
+    logger.info('first')
+    logger.info('second')
+    handler.stop_listener()
+
+    assert read_messages(path) == ['first', 'second']
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork()')
+def test_forked_child_gets_its_own_listener(tmp_path):
+    path = tmp_path / 'test.log'
+    logger, handler = make_logger(path, 'test_forked_child_gets_its_own_listener')
+    logger.info('parent')
+
+    pid = os.fork()
+    if pid == 0:
+        # The parent's listener thread doesn't exist here, so the record is only written by a new one
+        logger.info('child')
+        handler.stop_listener()
+        os._exit(0)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+
+    handler.stop_listener()
+    assert sorted(read_messages(path)) == ['child', 'parent']
@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from dbmanager.memory_queue import MemoryQueue
+from dbmodels.fsd_message import FsdMessage
+
+
+def message(timestamp: int = 1600000000000, text: str = 'hello') -> FsdMessage:
+    return FsdMessage('token', timestamp, 'ACA123', 'CZVR_CTR', text, discord_id=1)
+
+
+def test_out_of_range_timestamp_is_rejected_on_insert():
+    queue = MemoryQueue()
+
+    with pytest.raises((ValueError, OverflowError)):
+        queue.insert_messages([message(text='good'), message(timestamp=10 ** 18, text='bad')])
+
+    # Nothing from the rejected batch is queued, and claiming still works
+    assert queue.queue_depth() == 0
+    queue.insert_messages([message()])
+    assert len(list(queue.claim_messages(1, 10, 60))) == 1
+
+
+def test_out_of_range_timestamp_is_skipped_on_replay(tmp_path):
+    journal_path = str(tmp_path / 'queue.journal')
+    with open(journal_path, 'w', encoding='utf-8') as journal:
+        journal.write(json.dumps({'id': 1, 'token': 'token', 'timestamp': 10 ** 18, 'sender': 'ACA123',
+                                  'receiver': 'CZVR_CTR', 'message': 'bad', 'discord_id': 1, 'dedup_hash': None,
+                                  'insert_time': 0}) + '\n')
+
+    queue = MemoryQueue(journal_path=journal_path)
+    queue.insert_messages([message()])
+
+    claimed = list(queue.claim_messages(1, 10, 60))
+    assert [row[5] for row in claimed] == ['hello']
+    queue.close()
@@ -0,0 +1,34 @@
+from api.common import parse_message
+
+
+def message(**fields) -> dict:
+    return {'timestamp': 1600000000000, 'sender': 'ACA123', 'receiver': 'CZVR_CTR', 'message': 'hello', **fields}
+
+
+def test_valid_message():
+    msg, error_detail = parse_message('token', message(receiver='@22800'))
+
+    assert error_detail is None
+    assert (msg.sender, msg.receiver, msg.message) == ('ACA123', '@22800', 'hello')
+
+
+def test_contents_must_be_a_string():
+    for contents in ({'text': 'hello'}, ['hello'], 123, None):
+        msg, error_detail = parse_message('token', message(message=contents))
+        assert msg is None and error_detail is not None
+
+
+def test_sender_and_receiver_must_fully_match():
+    for fields in ({'sender': 'A' * 21}, {'sender': 'ACA123 extra'}, {'sender': ''},
+                   {'receiver': 'B' * 21}, {'receiver': '@228000'}, {'receiver': 'CZVR_CTR;'}):
+        msg, error_detail = parse_message('token', message(**fields))
+        assert msg is None and error_detail is not None
+
+    msg, error_detail = parse_message('token', message(sender='A' * 20, receiver='B' * 20))
+    assert error_detail is None
+
+
+def test_timestamp_must_be_in_range():
+    for timestamp in (-1, 0, 10 ** 18, (2 ** 31) * 1000):
+        msg, error_detail = parse_message('token', message(timestamp=timestamp))
+        assert msg is None and error_detail is not None
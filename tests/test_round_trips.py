@@ -0,0 +1,13 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_flows_within_budget():
+    # In a fresh interpreter, since the benchmark configures its own (SQLite) backend before db_manager is imported
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.round_trips'], cwd=ROOT, capture_output=True,
+                            text=True, timeout=120)
+
+    assert result.returncode == 0, f'{result.stdout}\n{result.stderr}'
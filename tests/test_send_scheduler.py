@@ -0,0 +1,91 @@
+import asyncio
+
+from bot.send_scheduler import SendScheduler
+
+
+class FakeClock:
+    """Clock that only moves when something sleeps on it."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        await asyncio.sleep(0)
+
+
+def make_scheduler(clock: FakeClock, global_rate: float = 100, channel_rate: float = 100,
+                   channel_burst: float = 100) -> SendScheduler:
+    return SendScheduler(global_rate, channel_rate, channel_burst, max_concurrency=10, clock=clock, sleep=clock.sleep)
+
+
+def acquire_all(scheduler: SendScheduler, channel_ids: list):
+    async def run():
+        for channel_id in channel_ids:
+            await scheduler.acquire(channel_id)
+
+    asyncio.run(run())
+
+
+def test_global_rate_is_shared_by_all_channels():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock, global_rate=2)
+
+    # A full second's worth goes out at once, then one send every 1/rate seconds
+    acquire_all(scheduler, [1, 2, 3, 4])
+
+    assert clock.sleeps == [0.5, 0.5]
+    assert clock.now == 1.0
+    assert scheduler.stats()['throttled'] == 2
+
+
+def test_channel_burst_only_holds_back_that_channel():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock, channel_rate=1, channel_burst=3)
+
+    acquire_all(scheduler, [1, 1, 1])
+    assert clock.now == 0
+
+    acquire_all(scheduler, [2, 2, 2])
+    assert clock.now == 0
+
+    # The burst is used up, so the next send to channel 1 waits for a token
+    acquire_all(scheduler, [1])
+    assert clock.now == 1.0
+    assert scheduler.stats()['throttled'] == 1
+
+
+def test_rate_limited_channel_backs_off_for_retry_after():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock, channel_rate=1, channel_burst=5)
+
+    acquire_all(scheduler, [1])
+    scheduler.rate_limited_for(1, 5.0)
+
+    # Other channels are unaffected
+    acquire_all(scheduler, [2])
+    assert clock.now == 0
+
+    acquire_all(scheduler, [1])
+    assert clock.now == 5.0
+    assert scheduler.stats()['rate_limited'] == 1
+
+
+def test_other_requests_share_the_global_rate():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock, global_rate=2)
+
+    async def run():
+        await scheduler.acquire_global()
+        await scheduler.acquire(1)
+        await scheduler.acquire_global()
+
+    asyncio.run(run())
+
+    assert clock.now == 0.5
+    assert scheduler.stats()['other_requests'] == 2
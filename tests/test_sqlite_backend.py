@@ -0,0 +1,27 @@
+import sqlite3
+
+import pytest
+
+from dbmanager.backends.sqlite_backend import SqliteBackend
+from dbmodels.fsd_message import FsdMessage
+
+
+def message(dedup_hash: bytes, sender: str = 'ACA123') -> FsdMessage:
+    return FsdMessage('token', 1600000000000, sender, 'CZVR_CTR', 'hello', discord_id=1, dedup_hash=dedup_hash)
+
+
+def test_resubmitted_messages_are_skipped(tmp_path):
+    backend = SqliteBackend(str(tmp_path / 'fcom.sqlite3'))
+
+    assert backend.insert_messages([message(b'a'), message(b'b')]) == 2
+    assert backend.insert_messages([message(b'a'), message(b'c')]) == 1
+    assert backend.queued_messages('token') == 3
+
+
+def test_other_constraint_violations_fail_the_batch(tmp_path):
+    backend = SqliteBackend(str(tmp_path / 'fcom.sqlite3'))
+
+    with pytest.raises(sqlite3.IntegrityError):
+        backend.insert_messages([message(b'a'), message(b'b', sender=None)])
+
+    assert backend.queued_messages('token') == 0
@@ -0,0 +1,31 @@
+import pytest
+
+from dbmanager.write_buffer import WriteBuffer
+from dbmodels.fsd_message import FsdMessage
+
+
+def message(text: str) -> FsdMessage:
+    return FsdMessage('token', 1600000000000, 'ACA123', 'CZVR_CTR', text)
+
+
+def test_bad_submission_only_fails_itself():
+    written = []
+
+    def flush(msgs):
+        # All or nothing, like a multi-row INSERT
+        if any(msg.message == 'bad' for msg in msgs):
+            raise ValueError('bad message')
+        written.extend(msg.message for msg in msgs)
+
+    # Long enough for both submissions to end up in the same batch
+    buffer = WriteBuffer(flush, max_delay=0.5, max_rows=100)
+    good = buffer.submit([message('good 1'), message('good 2')])
+    bad = buffer.submit([message('bad')])
+    buffer.close()
+
+    assert good.result(timeout=5) is None
+    with pytest.raises(ValueError):
+        bad.result(timeout=5)
+
+    assert written == ['good 1', 'good 2']
+    assert buffer.stats()['rows'] == 2